@@ -6,14 +6,39 @@ from dotenv import load_dotenv
 from openai import OpenAI
 import json
 import re
+import unicodedata
+import copy
 import streamlit as st
 import pandas as pd
-import tempfile
-from nexarClient import NexarClient
+import numpy as np
+import threading
+import hashlib
+import io
+import itertools
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from nexarClient import NexarClient, NexarQueryError
+from result_cache import ResultCache, normalize_mpn
+from single_flight import SingleFlight
+import event_log
+
+# 依赖检查只需在每个进程中执行一次
+_dependencies_checked = False
 
 # 检查并安装必要的依赖库
 def check_and_install_dependencies():
-    """检查并安装处理Excel文件所需的依赖库"""
+    """检查并安装处理Excel文件所需的依赖库
+    
+    不在导入时执行，仅在首次处理BOM文件时调用，避免阻塞应用启动。
+    """
+    global _dependencies_checked
+    if _dependencies_checked:
+        return
+    _dependencies_checked = True
+    
     dependencies = {
         'xlrd': 'xlrd>=2.0.1',      # 处理旧版 .xls 文件
         'openpyxl': 'openpyxl',     # 处理新版 .xlsx 文件
@@ -22,37 +47,171 @@ def check_and_install_dependencies():
     for module, package in dependencies.items():
         if importlib.util.find_spec(module) is None:
             try:
-                st.info(f"正在安装依赖: {package}...")
+                event_log.info(f"正在安装依赖: {package}...")
                 subprocess.check_call([sys.executable, "-m", "pip", "install", package])
-                st.success(f"{package} 安装完成")
+                event_log.success(f"{package} 安装完成")
             except Exception as e:
-                st.error(f"安装 {package} 失败: {e}")
-                st.info(f"请手动安装: pip install {package}")
-
-# 在导入pandas之前检查依赖
-check_and_install_dependencies()
+                event_log.error(f"安装 {package} 失败: {e}，请手动安装: pip install {package}")
 
 # 加载环境变量
 load_dotenv()
 
+# 后台任务线程中代替会话设置的选项（如 use_dummy_data），由 run_bom_batch 设置并传递给工作线程
+_thread_settings = threading.local()
+
+def _use_dummy_data(default=False):
+    """当前会话是否使用测试数据
+
+    后台任务使用提交任务时会话的设置；没有页面会话的其他调用方（命令行）从不使用测试数据。
+    """
+    override = getattr(_thread_settings, "use_dummy_data", None)
+    if override is not None:
+        return override
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return False
+    return bool(st.session_state.get("use_dummy_data", default))
+
 # DeepSeek API 配置
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
-if not DEEPSEEK_API_KEY:
-    raise ValueError("错误：未找到 DEEPSEEK_API_KEY 环境变量。")
-deepseek_client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL)
+DEEPSEEK_MODEL = "deepseek-chat"
+# 单次 DeepSeek 请求的超时（秒）；合并多个元器件的批量请求输出更长，按 BATCH_PROMPT_TIMEOUT_FACTOR 倍放宽
+DEEPSEEK_TIMEOUT = float(os.getenv("DEEPSEEK_TIMEOUT", "120"))
+BATCH_PROMPT_TIMEOUT_FACTOR = 4
+# 等待其他会话进行中的相同查询的最长时间：一次查询最多包含首次调用和国产方案二次查询两次请求
+INFLIGHT_WAIT_TIMEOUT = 2 * DEEPSEEK_TIMEOUT
+
+# 提示词版本号，修改提示词后需递增，使旧的缓存结果失效
+PROMPT_VERSION = "1"
+
+# 替代方案查询使用的系统提示词
+EXPERT_SYSTEM_PROMPT = "你是一个精通中国电子元器件行业的专家，擅长为各种元器件寻找合适的替代方案，尤其专注于中国大陆本土生产的国产元器件。始终以有效的JSON格式回复，不添加任何额外说明。"
+
+# 模型和提示词版本，结果缓存、批量断点和后台任务都按此区分，换模型或改提示词后不再复用旧结果
+QUERY_VERSION = f"{DEEPSEEK_MODEL}:{PROMPT_VERSION}"
+
+# 替代方案查询结果缓存，单个查询与批量查询共用
+result_cache = ResultCache.from_env(version=QUERY_VERSION)
+
+def batch_query_version(use_dummy_data=False):
+    """批量断点和后台任务使用的查询版本：模型和提示词版本，测试数据单独区分"""
+    return f"{QUERY_VERSION}:dummy" if use_dummy_data else QUERY_VERSION
+
+# 进程级请求合并：多个会话同时查询同一型号时只执行一次查询
+inflight_queries = SingleFlight()
+
+# 批量查询的默认并发数，可根据 API 限流情况调整
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "4"))
+
+# 批量提示词：一次 DeepSeek 请求查询多个元器件，设为 1 则逐个查询
+BATCH_PROMPT_MAX_PARTS = int(os.getenv("BATCH_PROMPT_MAX_PARTS", "8"))
+BATCH_PROMPT_MAX_INPUT_TOKENS = int(os.getenv("BATCH_PROMPT_MAX_INPUT_TOKENS", "12000"))
+BATCH_PROMPT_MAX_OUTPUT_TOKENS = int(os.getenv("BATCH_PROMPT_MAX_OUTPUT_TOKENS", "8000"))
+# 每个元器件 3 个推荐方案大约需要的输出 token 数
+BATCH_PROMPT_TOKENS_PER_PART = 450
+
+# 批量查询时是否同时用 Nexar 批量查询补充替代元器件数据
+BATCH_NEXAR_ENRICH = os.getenv("BATCH_NEXAR_ENRICH", "0") == "1"
+
+# 单个查询时并行发起 Nexar 查询和首次 DeepSeek 调用，设为 0 则按原顺序串行执行
+PIPELINE_SINGLE_QUERY = os.getenv("PIPELINE_SINGLE_QUERY", "1") == "1"
+
+# 国产方案二次查询的对冲策略：
+#   latency     - 首次调用超过近期 p90 耗时仍未返回时，提前发起国产方案查询（默认）
+#   speculative - 与首次调用同时发起国产方案查询
+#   off         - 仅在首次结果缺少国产方案时才发起查询
+DOMESTIC_HEDGE_MODE = os.getenv("DOMESTIC_HEDGE_MODE", "latency")
+# 对冲等待时间默认取首次调用近期耗时的 p90；样本不足时不对冲，
+# 除非通过该环境变量指定固定的等待时间（秒）
+DOMESTIC_HEDGE_DELAY = float(os.getenv("DOMESTIC_HEDGE_DELAY")) if os.getenv("DOMESTIC_HEDGE_DELAY") else None
+# 国产方案查询并行发起的变体数，取第一个有效结果，其余放弃
+DOMESTIC_QUERY_VARIANTS = int(os.getenv("DOMESTIC_QUERY_VARIANTS", "3"))
+# 各变体使用不同的采样温度，避免并行请求返回完全相同的结果
+DOMESTIC_QUERY_TEMPERATURES = (1.0, 0.7, 1.3)
+# 计算 p90 所需的最少样本数及保留的最近样本数
+DOMESTIC_HEDGE_MIN_SAMPLES = 10
+_primary_latencies = deque(maxlen=50)
+_primary_latencies_lock = threading.Lock()
 
 # Nexar API 配置
 NEXAR_CLIENT_ID = os.getenv("NEXAR_CLIENT_ID")
 NEXAR_CLIENT_SECRET = os.getenv("NEXAR_CLIENT_SECRET")
-if not NEXAR_CLIENT_ID or not NEXAR_CLIENT_SECRET:
-    raise ValueError("错误：未找到 NEXAR_CLIENT_ID 或 NEXAR_CLIENT_SECRET 环境变量。")
-nexar_client = NexarClient(NEXAR_CLIENT_ID, NEXAR_CLIENT_SECRET)
+
+# API 客户端在首次使用时创建，并在所有会话和线程之间共享，
+# 导入本模块时不进行任何网络请求
+_client_lock = threading.Lock()
+_deepseek_client = None
+_nexar_client = None
+
+def get_deepseek_client():
+    """获取共享的 DeepSeek 客户端，首次调用时创建"""
+    global _deepseek_client
+    if _deepseek_client is None:
+        with _client_lock:
+            if _deepseek_client is None:
+                if not DEEPSEEK_API_KEY:
+                    raise ValueError("错误：未找到 DEEPSEEK_API_KEY 环境变量。")
+                _deepseek_client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL, timeout=DEEPSEEK_TIMEOUT)
+    return _deepseek_client
+
+def get_nexar_client():
+    """获取共享的 Nexar 客户端，首次调用时创建（会请求访问令牌）"""
+    global _nexar_client
+    if _nexar_client is None:
+        with _client_lock:
+            if _nexar_client is None:
+                if not NEXAR_CLIENT_ID or not NEXAR_CLIENT_SECRET:
+                    raise ValueError("错误：未找到 NEXAR_CLIENT_ID 或 NEXAR_CLIENT_SECRET 环境变量。")
+                _nexar_client = NexarClient(NEXAR_CLIENT_ID, NEXAR_CLIENT_SECRET)
+    return _nexar_client
 
 # GraphQL 查询
-QUERY_ALTERNATIVE_PARTS = '''
-query findAlternativeParts($q: String!, $limit: Int = 10) {
-  supSearchMpn(q: $q, limit: $limit) {
+# supSearchMpn 字段的查询内容按用途分为几档，字段越少响应越小、Nexar 服务端开销越低：
+#   minimal:    仅替代件的型号/名称/链接，供单个查询的提示词上下文使用
+#   enrichment: 另含替代件的制造商、价格和交期，供批量补充数据使用
+#   full:       完整字段（规格参数、图片等）
+NEXAR_QUERY_PROFILES = {
+    "minimal": '''
+    hits
+    results {
+      part {
+        mpn
+        similarParts {
+          name
+          mpn
+          manufacturer {
+            name
+          }
+          octopartUrl
+        }
+      }
+    }
+''',
+    "enrichment": '''
+    hits
+    results {
+      part {
+        mpn
+        manufacturer {
+          name
+        }
+        similarParts {
+          name
+          mpn
+          manufacturer {
+            name
+          }
+          medianPrice1000 {
+            price
+            currency
+          }
+          octopartUrl
+          estimatedFactoryLeadDays
+        }
+      }
+    }
+''',
+    "full": '''
     hits
     results {
       part {
@@ -89,158 +248,241 @@ query findAlternativeParts($q: String!, $limit: Int = 10) {
         }
       }
     }
-  }
+''',
 }
+
+def build_alternatives_query(profile="full"):
+    """构造单个型号的替代元器件查询"""
+    selection = NEXAR_QUERY_PROFILES[profile]
+    return f'''
+query findAlternativeParts($q: String!, $start: Int = 0, $limit: Int = 10) {{
+  supSearchMpn(q: $q, start: $start, limit: $limit) {{{selection}  }}
+}}
 '''
 
-def get_nexar_alternatives(mpn: str, limit: int = 10):
-    variables = {"q": mpn, "limit": limit}
-    try:
-        data = nexar_client.get_query(QUERY_ALTERNATIVE_PARTS, variables)
-        alternative_parts = []
+QUERY_ALTERNATIVE_PARTS = build_alternatives_query("full")
+
+# 批量查询时每个 GraphQL 请求包含的型号数，受 Nexar 单次查询复杂度限制
+NEXAR_BULK_CHUNK_SIZE = int(os.getenv("NEXAR_BULK_CHUNK_SIZE", "20"))
+
+# 自适应查询首次请求的结果数，命中完全匹配的型号时不再继续查询
+NEXAR_ADAPTIVE_FIRST_LIMIT = int(os.getenv("NEXAR_ADAPTIVE_FIRST_LIMIT", "2"))
+
+def build_bulk_alternatives_query(count, profile="enrichment"):
+    """构造批量查询：每个型号对应一个带别名的 supSearchMpn 字段（q0、q1 ...）"""
+    selection = NEXAR_QUERY_PROFILES[profile]
+    variable_defs = ", ".join(f"$q{i}: String!" for i in range(count))
+    fields = "".join(
+        f"  q{i}: supSearchMpn(q: $q{i}, limit: $limit) {{{selection}  }}\n"
+        for i in range(count)
+    )
+    return f"query findAlternativePartsBulk({variable_defs}, $limit: Int = 10) {{\n{fields}}}\n"
+
+def _trim_at_exact_match(data, mpn):
+    """截断 supSearchMpn 结果，只保留到第一个与查询型号完全匹配的结果为止
+    
+    Returns:
+        是否找到了完全匹配的结果
+    """
+    sup_search = data.get("supSearchMpn") if isinstance(data, dict) else None
+    results = sup_search.get("results") if isinstance(sup_search, dict) else None
+    if not isinstance(results, list):
+        return False
+    target = normalize_mpn(mpn)
+    for i, result in enumerate(results):
+        part = result.get("part") if isinstance(result, dict) else None
+        if isinstance(part, dict) and normalize_mpn(part.get("mpn", "")) == target:
+            sup_search["results"] = results[:i + 1]
+            return True
+    return False
+
+def _query_nexar_alternatives(mpn, limit, profile, adaptive):
+    """执行 Nexar 替代元器件查询；adaptive 模式先查少量结果，找到完全匹配的型号即停止"""
+    query = build_alternatives_query(profile)
+    client = get_nexar_client()
+    if not adaptive or limit <= NEXAR_ADAPTIVE_FIRST_LIMIT:
+        return client.get_query(query, {"q": mpn, "limit": limit})
+    
+    data = client.get_query(query, {"q": mpn, "start": 0, "limit": NEXAR_ADAPTIVE_FIRST_LIMIT})
+    if not data or _trim_at_exact_match(data, mpn):
+        return data
+    
+    # 首批结果中没有完全匹配的型号，继续获取剩余结果
+    rest = client.get_query(query, {"q": mpn, "start": NEXAR_ADAPTIVE_FIRST_LIMIT,
+                                    "limit": limit - NEXAR_ADAPTIVE_FIRST_LIMIT})
+    sup_search = data.get("supSearchMpn")
+    if not isinstance(sup_search, dict):
+        return rest
+    rest_results = ((rest or {}).get("supSearchMpn") or {}).get("results") or []
+    sup_search["results"] = (sup_search.get("results") or []) + rest_results
+    _trim_at_exact_match(data, mpn)
+    return data
+
+def _parse_nexar_alternatives(data):
+    """从 Nexar supSearchMpn 响应中提取并规范化替代元器件列表
+    
+    Args:
+        data: 包含 supSearchMpn 字段的响应字典
         
-        # 添加数据有效性检查与调试信息
-        if not data:
-            st.warning(f"Nexar API 未返回有效数据，可能是查询 '{mpn}' 无结果")
-            return []
-            
-        # 显示调试信息
-        with st.sidebar.expander(f"Nexar API 调试信息 - {mpn}", expanded=False):
-            st.write(f"**原始Nexar API响应结构:**")
-            st.write(data)
-            
-        # 完全重写数据提取逻辑，以更健壮的方式处理各种可能的结构
-        if isinstance(data, dict):
-            # 尝试从不同位置提取数据
-            sup_search = data.get("supSearchMpn", {})
-            
-            # 如果supSearchMpn是字典
-            if isinstance(sup_search, dict):
-                results = sup_search.get("results", [])
-                
-                # 如果results是列表
-                if isinstance(results, list):
-                    # 正常处理
-                    for result in results:
-                        if not isinstance(result, dict):
-                            continue
-                            
-                        part = result.get("part", {})
-                        if not isinstance(part, dict):
-                            continue
-                            
-                        similar_parts = part.get("similarParts", [])
-                        if not isinstance(similar_parts, list):
+    Returns:
+        替代元器件字典列表
+    """
+    alternative_parts = []
+    
+    # 完全重写数据提取逻辑，以更健壮的方式处理各种可能的结构
+    if isinstance(data, dict):
+        # 尝试从不同位置提取数据
+        sup_search = data.get("supSearchMpn", {})
+
+        # 如果supSearchMpn是字典
+        if isinstance(sup_search, dict):
+            results = sup_search.get("results", [])
+
+            # 如果results是列表
+            if isinstance(results, list):
+                # 正常处理
+                for result in results:
+                    if not isinstance(result, dict):
+                        continue
+
+                    part = result.get("part", {})
+                    if not isinstance(part, dict):
+                        continue
+
+                    similar_parts = part.get("similarParts", [])
+                    if not isinstance(similar_parts, list):
+                        continue
+
+                    for similar in similar_parts:
+                        if not isinstance(similar, dict):
                             continue
-                            
-                        for similar in similar_parts:
-                            if not isinstance(similar, dict):
-                                continue
-                                
-                            # 提取价格信息
-                            price_info = similar.get("medianPrice1000", {})
-                            price = "未知"
-                            if isinstance(price_info, dict):
-                                price_value = price_info.get("price")
-                                currency = price_info.get("currency", "USD")
-                                if price_value:
-                                    price = f"{price_value:.4f} {currency}"
-                            
-                            # 提取生命周期和库存状态
-                            life_cycle = similar.get("lifeCycle", "未知")
-                            obsolete = similar.get("obsolete", False)
-                            lead_days = similar.get("estimatedFactoryLeadDays")
-                            
-                            # 确定产品状态
-                            status = "未知"
-                            if obsolete:
+
+                        # 提取价格信息
+                        price_info = similar.get("medianPrice1000", {})
+                        price = "未知"
+                        if isinstance(price_info, dict):
+                            price_value = price_info.get("price")
+                            currency = price_info.get("currency", "USD")
+                            if price_value:
+                                price = f"{price_value:.4f} {currency}"
+
+                        # 提取生命周期和库存状态
+                        life_cycle = similar.get("lifeCycle", "未知")
+                        obsolete = similar.get("obsolete", False)
+                        lead_days = similar.get("estimatedFactoryLeadDays")
+
+                        # 确定产品状态
+                        status = "未知"
+                        if obsolete:
+                            status = "已停产"
+                        elif life_cycle:
+                            if "OBSOLETE" in life_cycle or "END OF LIFE" in life_cycle.upper():
                                 status = "已停产"
-                            elif life_cycle:
-                                if "OBSOLETE" in life_cycle or "END OF LIFE" in life_cycle.upper():
-                                    status = "已停产"
-                                elif "ACTIVE" in life_cycle.upper() or "PRODUCTION" in life_cycle.upper():
-                                    status = "量产中"
-                                elif "NEW" in life_cycle.upper() or "INTRO" in life_cycle.upper():
-                                    status = "新产品"
-                                elif "NOT RECOMMENDED" in life_cycle.upper():
-                                    status = "不推荐使用"
-                                else:
-                                    status = life_cycle
-                            
-                            # 提取制造商信息
-                            manufacturer = similar.get("manufacturer", {})
-                            manufacturer_name = ""
-                            if isinstance(manufacturer, dict):
-                                manufacturer_name = manufacturer.get("name", "")
-                            
-                            # 构建替代元器件信息
-                            alternative_parts.append({
-                                "name": similar.get("name", ""),
-                                "mpn": similar.get("mpn", ""),
-                                "manufacturer": manufacturer_name,
-                                "price": price,
-                                "status": status,
-                                "leadTime": f"{lead_days} 天" if lead_days else "未知",
-                                "octopartUrl": similar.get("octopartUrl", "")
-                            })
-                else:
-                    # 如果results不是列表，尝试其他数据结构
-                    with st.sidebar.expander("调试信息 - API结构错误", expanded=False):
-                        st.warning(f"Nexar API 返回了非标准结构的数据 (results不是列表)")
-                    
-                    # 尝试直接从顶层提取数据
-                    parts_data = []
-                    
-                    # 检查是否有直接的part字段
-                    if "part" in sup_search:
-                        part = sup_search.get("part", {})
-                        if isinstance(part, dict) and "similarParts" in part:
-                            parts_data = part.get("similarParts", [])
-                    
-                    # 如果找到疑似部件数据
-                    if isinstance(parts_data, list):
-                        for part_item in parts_data:
-                            if not isinstance(part_item, dict):
+                            elif "ACTIVE" in life_cycle.upper() or "PRODUCTION" in life_cycle.upper():
+                                status = "量产中"
+                            elif "NEW" in life_cycle.upper() or "INTRO" in life_cycle.upper():
+                                status = "新产品"
+                            elif "NOT RECOMMENDED" in life_cycle.upper():
+                                status = "不推荐使用"
+                            else:
+                                status = life_cycle
+
+                        # 提取制造商信息
+                        manufacturer = similar.get("manufacturer", {})
+                        manufacturer_name = ""
+                        if isinstance(manufacturer, dict):
+                            manufacturer_name = manufacturer.get("name", "")
+
+                        # 构建替代元器件信息
+                        alternative_parts.append({
+                            "name": similar.get("name", ""),
+                            "mpn": similar.get("mpn", ""),
+                            "manufacturer": manufacturer_name,
+                            "price": price,
+                            "status": status,
+                            "leadTime": f"{lead_days} 天" if lead_days else "未知",
+                            "octopartUrl": similar.get("octopartUrl", "")
+                        })
+            else:
+                # 如果results不是列表，尝试其他数据结构
+                event_log.warning("Nexar API 返回了非标准结构的数据 (results不是列表)", payload=sup_search)
+
+                # 尝试直接从顶层提取数据
+                parts_data = []
+
+                # 检查是否有直接的part字段
+                if "part" in sup_search:
+                    part = sup_search.get("part", {})
+                    if isinstance(part, dict) and "similarParts" in part:
+                        parts_data = part.get("similarParts", [])
+
+                # 如果找到疑似部件数据
+                if isinstance(parts_data, list):
+                    for part_item in parts_data:
+                        if not isinstance(part_item, dict):
+                            continue
+
+                        alternative_parts.append({
+                            "name": part_item.get("name", "未知名称"),
+                            "mpn": part_item.get("mpn", "未知型号"),
+                            "manufacturer": part_item.get("manufacturer", {}).get("name", "未知"),
+                            "price": "未知",
+                            "status": "未知",
+                            "leadTime": "未知",
+                            "octopartUrl": part_item.get("octopartUrl", "https://example.com")
+                        })
+        else:
+            event_log.warning("Nexar API 返回了非标准结构 (supSearchMpn不是字典)", payload=data)
+            # 尝试从整个响应中找到任何可能的部件信息
+            for key, value in data.items():
+                if isinstance(value, dict) and "parts" in value:
+                    parts = value.get("parts", [])
+                    if isinstance(parts, list):
+                        for part in parts:
+                            if not isinstance(part, dict):
                                 continue
-                                
                             alternative_parts.append({
-                                "name": part_item.get("name", "未知名称"),
-                                "mpn": part_item.get("mpn", "未知型号"),
-                                "manufacturer": part_item.get("manufacturer", {}).get("name", "未知"),
+                                "name": part.get("name", "未知名称"),
+                                "mpn": part.get("mpn", "未知型号"),
+                                "manufacturer": "未知制造商",
                                 "price": "未知",
                                 "status": "未知",
                                 "leadTime": "未知",
-                                "octopartUrl": part_item.get("octopartUrl", "https://example.com")
+                                "octopartUrl": "https://example.com"
                             })
-            else:
-                with st.sidebar.expander("调试信息 - API结构错误", expanded=False):
-                    st.warning(f"Nexar API 返回了非标准结构 (supSearchMpn不是字典)")
-                # 尝试从整个响应中找到任何可能的部件信息
-                for key, value in data.items():
-                    if isinstance(value, dict) and "parts" in value:
-                        parts = value.get("parts", [])
-                        if isinstance(parts, list):
-                            for part in parts:
-                                if not isinstance(part, dict):
-                                    continue
-                                alternative_parts.append({
-                                    "name": part.get("name", "未知名称"),
-                                    "mpn": part.get("mpn", "未知型号"),
-                                    "manufacturer": "未知制造商",
-                                    "price": "未知",
-                                    "status": "未知",
-                                    "leadTime": "未知",
-                                    "octopartUrl": "https://example.com"
-                                })
+    
+    return alternative_parts
+
+def get_nexar_alternatives(mpn: str, limit: int = 10, profile: str = "full", adaptive: bool = False):
+    """查询单个型号的 Nexar 替代元器件
+    
+    Args:
+        mpn: 元器件型号
+        limit: supSearchMpn 最多返回的结果数
+        profile: 查询字段档位，见 NEXAR_QUERY_PROFILES
+        adaptive: 是否先查询少量结果，找到完全匹配的型号即停止
+    """
+    try:
+        data = _query_nexar_alternatives(mpn, limit, profile, adaptive)
+        
+        # 添加数据有效性检查与调试信息
+        if not data:
+            event_log.warning(f"Nexar API 未返回有效数据，可能是查询 '{mpn}' 无结果")
+            return []
+            
+        # 记录原始响应（仅调试模式）
+        event_log.debug(f"Nexar API 原始响应 - {mpn}", payload=data)
+            
+        alternative_parts = _parse_nexar_alternatives(data)
         
         # 如果无法找到任何替代件
         if not alternative_parts:
             # 只在侧边栏显示错误信息，而不在主界面显示
-            st.sidebar.info(f"Nexar API 未能为 '{mpn}' 找到替代元器件")
+            event_log.info(f"Nexar API 未能为 '{mpn}' 找到替代元器件")
             
             # 创建一个假数据用于测试其他部分的功能
-            if st.session_state.get("use_dummy_data", False):
-                st.sidebar.info("使用测试数据继续查询")
+            if _use_dummy_data():
+                event_log.info("使用测试数据继续查询")
                 alternative_parts = [
                     {
                         "name": f"类似元件: {mpn}替代品1",
@@ -265,12 +507,69 @@ def get_nexar_alternatives(mpn: str, limit: int = 10):
         return alternative_parts
         
     except Exception as e:
-        st.error(f"Nexar API 查询失败: {e}")
         import traceback
-        with st.sidebar.expander("Nexar API错误详情", expanded=False):
-            st.code(traceback.format_exc())
+        event_log.error(f"Nexar API 查询失败: {e}", payload=traceback.format_exc())
         return []
 
+def get_nexar_alternatives_bulk(mpns, limit: int = 5, chunk_size: int = None, profile: str = "enrichment"):
+    """批量获取多个型号的 Nexar 替代元器件，每个 GraphQL 请求查询一组型号
+    
+    Args:
+        mpns: 型号列表
+        limit: 每个型号的 supSearchMpn 结果数
+        chunk_size: 每个请求包含的型号数，默认读取环境变量 NEXAR_BULK_CHUNK_SIZE
+        profile: 查询字段档位，见 NEXAR_QUERY_PROFILES
+        
+    Returns:
+        {mpn: 替代元器件字典列表}，格式与 get_nexar_alternatives 的返回值相同
+    """
+    chunk_size = max(1, chunk_size or NEXAR_BULK_CHUNK_SIZE)
+    
+    # 同一型号只查询一次
+    unique_mpns = []
+    seen = set()
+    for mpn in mpns:
+        key = normalize_mpn(mpn)
+        if mpn and key not in seen:
+            seen.add(key)
+            unique_mpns.append(mpn)
+    
+    results = {}
+    pending = [unique_mpns[i:i + chunk_size] for i in range(0, len(unique_mpns), chunk_size)]
+    request_count = 0
+    while pending:
+        chunk = pending.pop(0)
+        variables = {f"q{i}": mpn for i, mpn in enumerate(chunk)}
+        variables["limit"] = limit
+        try:
+            request_count += 1
+            data = get_nexar_client().get_query(build_bulk_alternatives_query(len(chunk), profile), variables) or {}
+        # GraphQL 报错通常由个别型号引起：拆成两半重试，定位到出错的型号
+        except NexarQueryError as e:
+            if len(chunk) > 1:
+                middle = len(chunk) // 2
+                pending[:0] = [chunk[:middle], chunk[middle:]]
+            else:
+                event_log.warning(f"Nexar 批量查询 '{chunk[0]}' 失败: {e}")
+                results[chunk[0]] = []
+            continue
+        # 超时、连接错误或 5xx（传输层已按 NEXAR_MAX_RETRIES 重试过）：拆分只会放大请求数，整组直接放弃
+        except Exception as e:
+            event_log.warning(f"Nexar 批量查询失败，{len(chunk)} 个型号不附加 Nexar 数据: {e}")
+            for mpn in chunk:
+                results[mpn] = []
+            continue
+        
+        for i, mpn in enumerate(chunk):
+            results[mpn] = _parse_nexar_alternatives({"supSearchMpn": data.get(f"q{i}") or {}})
+    
+    found_count = sum(1 for alts in results.values() if alts)
+    event_log.info(f"Nexar 批量查询完成：{len(unique_mpns)} 个型号，{request_count} 次请求，{found_count} 个型号找到替代元器件")
+    
+    # 重复或仅大小写不同的型号共用查询结果
+    by_key = {normalize_mpn(mpn): alts for mpn, alts in results.items()}
+    return {mpn: by_key.get(normalize_mpn(mpn), []) for mpn in mpns if mpn}
+
 def is_domestic_brand(model_name):
     domestic_brands = [
         "GigaDevice", "兆易创新", "WCH", "沁恒", "Fudan Micro", "复旦微电子",
@@ -282,371 +581,468 @@ def is_domestic_brand(model_name):
     return any(model_name.lower().startswith(brand.lower()) for brand in domestic_brands) or \
            any(brand.lower() in model_name.lower() for brand in domestic_brands)
 
+# 单次扫描后最多尝试解析的候选片段数，保证畸形输入下的耗时有上界
+MAX_JSON_CANDIDATES = 16
+
+# 扫描时只关心括号、双引号和反斜杠，其余字符直接跳过
+_JSON_TOKEN_PATTERN = re.compile(r'[\[\]{}"\\]')
+
+def _find_json_spans(text, opener):
+    """单次线性扫描文本，找出所有括号配对完整的 JSON 片段
+    
+    字符串内的括号会被忽略，不匹配的开括号会被丢弃（容忍被截断或残缺的内容）。
+    
+    Args:
+        text: 待扫描的文本
+        opener: "[" 查找数组，"{" 查找对象
+        
+    Returns:
+        [(起始位置, 结束位置)]，按起始位置排序，外层片段在前
+    """
+    spans = []
+    stack = []
+    in_string = False
+    skip_until = -1
+    for match in _JSON_TOKEN_PATTERN.finditer(text):
+        pos = match.start()
+        if pos < skip_until:
+            continue  # 被反斜杠转义的字符
+        ch = match.group()
+        if ch == '\\':
+            skip_until = pos + 2
+        elif ch == '"':
+            in_string = not in_string
+        elif in_string:
+            continue
+        elif ch in '[{':
+            stack.append((ch, pos))
+        else:
+            expected = '[' if ch == ']' else '{'
+            while stack and stack[-1][0] != expected:
+                stack.pop()
+            if stack:
+                start_ch, start = stack.pop()
+                if start_ch == opener:
+                    spans.append((start, pos + 1))
+    spans.sort(key=lambda span: (span[0], -span[1]))
+    return spans
+
+def _repair_json(text):
+    """线性修复 LLM 输出中常见的 JSON 格式问题：单引号字符串、尾部多余逗号、Python 字面量"""
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch == '"' or ch == "'":
+            # 复制整个字符串，单引号字符串转换为双引号字符串
+            j = i + 1
+            chars = []
+            while j < n and text[j] != ch:
+                if text[j] == '\\' and j + 1 < n:
+                    chars.append(text[j:j + 2])
+                    j += 2
+                    continue
+                chars.append('\\"' if ch == "'" and text[j] == '"' else text[j])
+                j += 1
+            out.append('"' + "".join(chars) + '"')
+            i = j + 1
+        elif ch == ',':
+            # 跳过紧跟在 ] 或 } 之前的逗号
+            j = i + 1
+            while j < n and text[j] in ' \t\r\n':
+                j += 1
+            if j < n and text[j] in ']}':
+                i = j
+            else:
+                out.append(ch)
+                i += 1
+        elif ch.isalpha():
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == '_'):
+                j += 1
+            word = text[i:j]
+            out.append({"True": "true", "False": "false", "None": "null"}.get(word, word))
+            i = j
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+def _loads_lenient(text):
+    """先按标准 JSON 解析，失败后修复常见格式问题再解析一次；均失败时返回 None"""
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return json.loads(_repair_json(text))
+    except ValueError:
+        return None
+
+def extract_json_value(content, expected=list):
+    """从 LLM 响应中提取第一个有效的 JSON 数组或对象
+    
+    对文本只做一次线性扫描，可容忍 Markdown 代码块、前后说明文字、尾部逗号和单引号。
+    
+    Args:
+        content: LLM 返回的文本
+        expected: list 提取对象数组，dict 提取对象
+        
+    Returns:
+        解析结果，未找到时返回 None
+    """
+    if not isinstance(content, str) or not content.strip():
+        return None
+    
+    opener = '[' if expected is list else '{'
+    attempts = 0
+    for start, end in _find_json_spans(content, opener):
+        fragment = content[start:end]
+        # 推荐结果必须是对象数组，跳过类似 "[注]" 的普通方括号
+        if expected is list and '{' not in fragment:
+            continue
+        parsed = _loads_lenient(fragment)
+        if isinstance(parsed, expected) and (expected is not list or any(isinstance(item, dict) for item in parsed)):
+            return parsed
+        attempts += 1
+        if attempts >= MAX_JSON_CANDIDATES:
+            break
+    return None
+
+class JsonArrayStreamParser:
+    """增量解析流式返回的 JSON 数组，每当一个数组元素（对象）完整时立即返回
+    
+    每个字符只扫描一次；数组之前的说明文字和代码块标记会被跳过，
+    不含任何对象的方括号（如 "[注]"）不会被当作结果数组。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._element_start = None
+        self._element_count = 0
+        self.done = False
+
+    def feed(self, text):
+        """追加一段文本，返回其中新完成的数组元素列表"""
+        if self.done or not text:
+            return []
+        self._buffer += text
+        elements = []
+        buffer = self._buffer
+        for pos in range(self._pos, len(buffer)):
+            ch = buffer[pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if self._depth == 0:
+                if ch == '[':
+                    self._depth = 1
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in '[{':
+                if self._depth == 1 and ch == '{':
+                    self._element_start = pos
+                self._depth += 1
+            elif ch in ']}':
+                self._depth -= 1
+                if self._depth == 1 and ch == '}' and self._element_start is not None:
+                    element = _loads_lenient(buffer[self._element_start:pos + 1])
+                    self._element_start = None
+                    if element is not None:
+                        self._element_count += 1
+                        elements.append(element)
+                elif self._depth == 0:
+                    if self._element_count:
+                        self.done = True
+                        break
+                    # 不含对象的方括号，继续寻找真正的结果数组
+                    self._element_start = None
+        self._pos = len(buffer)
+        return elements
+
+def _normalize_recommendation(item):
+    """补全推荐结果的缺失字段，并确保价格包含货币符号"""
+    # 确保基本字段存在
+    item["model"] = item.get("model", "未知型号")
+    item["brand"] = item.get("brand", "未知品牌")
+    item["parameters"] = item.get("parameters", "参数未知")
+    item["type"] = item.get("type", "未知")
+    item["datasheet"] = item.get("datasheet", "https://www.example.com/datasheet")
+    
+    # 确保新增字段存在
+    item["category"] = item.get("category", "未知类别")
+    item["package"] = item.get("package", "未知封装")
+    
+    # 添加价格信息（如果没有）并确保价格包含货币符号
+    price = item.get("price", "未知")
+    if not isinstance(price, str):
+        price = str(price)
+    # 检查价格是否已包含货币符号
+    if price != "未知" and not any(symbol in price for symbol in ["¥", "￥", "$"]):
+        # 如果是纯数字或数字范围，添加美元符号
+        if re.match(r'^[\d\.\-\s]+$', price):
+            # 处理类似 "1.8-2.5" 的价格范围
+            if "-" in price:
+                price_parts = price.split("-")
+                price = f"${price_parts[0].strip()}-${price_parts[1].strip()}"
+            else:
+                price = f"${price.strip()}"
+    item["price"] = price
+    
+    # 添加物料状态信息
+    item["status"] = item.get("status", "未知")
+    item["leadTime"] = item.get("leadTime", "未知")
+    
+    # 添加 pin-to-pin 替代相关信息
+    item["pinToPin"] = item.get("pinToPin", False)
+    item["compatibility"] = item.get("compatibility", "兼容性未知")
+    return item
+
 def extract_json_content(content, call_type="初次调用"):
     # 检查输入是否为字符串类型
     if not isinstance(content, str):
-        st.error(f"{call_type} - 输入内容不是字符串: {type(content)}")
+        event_log.error(f"{call_type} - 输入内容不是字符串: {type(content)}")
         return []
         
-    # 记录原始内容以便调试
-    with st.sidebar.expander(f"调试信息 - 原始响应 ({call_type})", expanded=False):
-        st.write(f"**尝试解析的原始响应内容 ({call_type}):**")
-        st.code(content, language="text")
+    # 记录原始内容以便调试（仅调试模式）
+    event_log.debug(f"DeepSeek 原始响应 ({call_type})", payload=content)
 
     # 处理空响应
     if not content or content.strip() == "":
-        st.warning(f"{call_type} 返回了空响应")
+        event_log.warning(f"{call_type} 返回了空响应")
         return []
 
-    # 直接尝试解析 JSON
-    try:
-        parsed = json.loads(content)
-        # 检查是否为列表
-        if not isinstance(parsed, list):
-            raise ValueError("响应不是 JSON 数组")
-        # 补全缺少的字段
-        for item in parsed:
-            # 确保item是字典类型
-            if not isinstance(item, dict):
-                continue
-                
-            # 确保基本字段存在
-            item["model"] = item.get("model", "未知型号")
-            item["brand"] = item.get("brand", "未知品牌")
-            item["parameters"] = item.get("parameters", "参数未知")
-            item["type"] = item.get("type", "未知")
-            item["datasheet"] = item.get("datasheet", "https://www.example.com/datasheet")
-            
-            # 确保新增字段存在
-            item["category"] = item.get("category", "未知类别")
-            item["package"] = item.get("package", "未知封装")
-            
-            # 添加价格信息（如果没有）并确保价格包含货币符号
-            price = item.get("price", "未知")
-            # 检查价格是否已包含货币符号
-            if price != "未知" and not any(symbol in price for symbol in ["¥", "￥", "$"]):
-                # 如果是纯数字或数字范围，添加美元符号
-                if re.match(r'^[\d\.\-\s]+$', price):
-                    # 处理类似 "1.8-2.5" 的价格范围
-                    if "-" in price:
-                        price_parts = price.split("-")
-                        price = f"${price_parts[0].strip()}-${price_parts[1].strip()}"
-                    else:
-                        price = f"${price.strip()}"
-            item["price"] = price
-            
-            # 添加物料状态信息
-            item["status"] = item.get("status", "未知")
-            item["leadTime"] = item.get("leadTime", "未知")
-            
-            # 添加 pin-to-pin 替代相关信息
-            item["pinToPin"] = item.get("pinToPin", False)
-            item["compatibility"] = item.get("compatibility", "兼容性未知")
-            
-        return parsed
-    except json.JSONDecodeError:
-        pass
+    parsed = extract_json_value(content, list)
+    if parsed is not None:
+        # 每个推荐项只补全一次字段，忽略非字典元素
+        return [_normalize_recommendation(item) for item in parsed if isinstance(item, dict)]
 
-    # 尝试提取代码块中的 JSON
-    code_block_pattern = r"```(?:json)?\s*\n?([\s\S]*?)\n?```"
-    code_match = re.search(code_block_pattern, content, re.DOTALL)
-    if (code_match):
-        json_content = code_match.group(1).strip()
-        try:
-            parsed = json.loads(json_content)
-            for item in parsed:
-                # 确保item是字典类型
-                if not isinstance(item, dict):
-                    continue
-                    
-                # 确保基本字段存在
-                item["model"] = item.get("model", "未知型号")
-                item["brand"] = item.get("brand", "未知品牌")
-                item["parameters"] = item.get("parameters", "参数未知")
-                item["type"] = item.get("type", "未知")
-                item["datasheet"] = item.get("datasheet", "https://www.example.com/datasheet")
-                
-                # 确保新增字段存在
-                item["category"] = item.get("category", "未知类别")
-                item["package"] = item.get("package", "未知封装")
-                
-                # 添加价格信息（如果没有）并确保价格包含货币符号
-                price = item.get("price", "未知")
-                # 检查价格是否已包含货币符号
-                if price != "未知" and not any(symbol in price for symbol in ["¥", "￥", "$"]):
-                    # 如果是纯数字或数字范围，添加美元符号
-                    if re.match(r'^[\d\.\-\s]+$', price):
-                        # 处理类似 "1.8-2.5" 的价格范围
-                        if "-" in price:
-                            price_parts = price.split("-")
-                            price = f"${price_parts[0].strip()}-${price_parts[1].strip()}"
-                        else:
-                            price = f"${price.strip()}"
-                item["price"] = price
-                
-                # 添加物料状态信息
-                item["status"] = item.get("status", "未知")
-                item["leadTime"] = item.get("leadTime", "未知")
-                
-                # 添加 pin-to-pin 替代相关信息
-                item["pinToPin"] = item.get("pinToPin", False)
-                item["compatibility"] = item.get("compatibility", "兼容性未知")
-                
-            return parsed
-        except json.JSONDecodeError:
-            pass
+    # 处理可能的非标准JSON格式
+    # 如果内容看起来包含元器件信息但不是有效JSON，构造一个基本响应
+    if "型号" in content and ("国产" in content or "进口" in content):
+        event_log.warning(f"DeepSeek API返回了非标准JSON格式，尝试构建基本替代方案 ({call_type})")
+        # 构造一个基本的替代方案
+        basic_alt = [{
+            "model": "未能解析出型号",
+            "brand": "未知品牌",
+            "category": "未知类别",
+            "package": "未知封装",
+            "parameters": "无法解析参数，请查看API原始响应",
+            "type": "未知",
+            "price": "未知",
+            "status": "未知",
+            "leadTime": "未知",
+            "pinToPin": False,
+            "compatibility": "未知",
+            "datasheet": "https://www.example.com"
+        }]
+        return basic_alt
 
-    # 尝试提取裸 JSON 数组
-    json_match = re.search(r'\[\s*\{.*\}\s*\]', content, re.DOTALL)
-    if json_match:
-        try:
-            parsed = json.loads(json_match.group(0))
-            for item in parsed:
-                # 确保item是字典类型
-                if not isinstance(item, dict):
-                    continue
-                    
-                if not all(key in item for key in ["model", "parameters", "type", "datasheet"]):
-                    item["model"] = item.get("model", "未知型号")
-                    item["parameters"] = item.get("parameters", "参数未知")
-                    item["type"] = item.get("type", "未知")
-                    item["datasheet"] = item.get("datasheet", "https://www.example.com/datasheet")
-                # 确保品牌字段存在
-                if "brand" not in item:
-                    item["brand"] = item.get("brand", "未知品牌")
-                # 确保新增字段存在
-                item["category"] = item.get("category", "未知类别")
-                item["package"] = item.get("package", "未知封装")
-                
-                # 添加价格信息（如果没有）并确保价格包含货币符号
-                price = item.get("price", "未知")
-                # 检查价格是否已包含货币符号
-                if price != "未知" and not any(symbol in price for symbol in ["¥", "￥", "$"]):
-                    # 如果是纯数字或数字范围，添加美元符号
-                    if re.match(r'^[\d\.\-\s]+$', price):
-                        # 处理类似 "1.8-2.5" 的价格范围
-                        if "-" in price:
-                            price_parts = price.split("-")
-                            price = f"${price_parts[0].strip()}-${price_parts[1].strip()}"
-                        else:
-                            price = f"${price.strip()}"
-                item["price"] = price
-                
-                # 添加物料状态信息
-                item["status"] = item.get("status", "未知")
-                item["leadTime"] = item.get("leadTime", "未知")
-                
-                # 添加 pin-to-pin 替代相关信息
-                item["pinToPin"] = item.get("pinToPin", False)
-                item["compatibility"] = item.get("compatibility", "兼容性未知")
-                
-            return parsed
-        except json.JSONDecodeError:
-            pass
+    event_log.error(f"无法从API响应中提取有效的JSON内容 ({call_type})")
+    return []
 
-    # 尝试逐行解析，处理可能的多行 JSON
-    lines = content.strip().split('\n')
-    json_content = ''
-    in_json = False
-    for line in lines:
-        line = line.strip()
-        if line.startswith('[') or in_json:
-            json_content += line
-            in_json = True
-        if line.endswith(']'):
-            break
-    if json_content:
-        try:
-            parsed = json.loads(json_content)
-            for item in parsed:
-                # 确保item是字典类型
-                if not isinstance(item, dict):
-                    continue
-                    
-                if not all(key in item for key in ["model", "parameters", "type", "datasheet"]):
-                    item["model"] = item.get("model", "未知型号")
-                    item["parameters"] = item.get("parameters", "参数未知")
-                    item["type"] = item.get("type", "未知")
-                    item["datasheet"] = item.get("datasheet", "https://www.example.com/datasheet")
-                # 确保品牌字段存在
-                if "brand" not in item:
-                    item["brand"] = item.get("brand", "未知品牌")
-                # 确保新增字段存在
-                item["category"] = item.get("category", "未知类别")
-                item["package"] = item.get("package", "未知封装")
-                
-                # 添加价格信息（如果没有）并确保价格包含货币符号
-                price = item.get("price", "未知")
-                # 检查价格是否已包含货币符号
-                if price != "未知" and not any(symbol in price for symbol in ["¥", "￥", "$"]):
-                    # 如果是纯数字或数字范围，添加美元符号
-                    if re.match(r'^[\d\.\-\s]+$', price):
-                        # 处理类似 "1.8-2.5" 的价格范围
-                        if "-" in price:
-                            price_parts = price.split("-")
-                            price = f"${price_parts[0].strip()}-${price_parts[1].strip()}"
-                        else:
-                            price = f"${price.strip()}"
-                item["price"] = price
-                
-                # 添加物料状态信息
-                item["status"] = item.get("status", "未知")
-                item["leadTime"] = item.get("leadTime", "未知")
-                
-                # 添加 pin-to-pin 替代相关信息
-                item["pinToPin"] = item.get("pinToPin", False)
-                item["compatibility"] = item.get("compatibility", "兼容性未知")
-                
-            return parsed
-        except json.JSONDecodeError:
-            pass
+def _extract_json_object(content):
+    """从 API 响应中提取 JSON 对象（用于批量提示词的按型号分组结果），失败时返回空字典"""
+    return extract_json_value(content, dict) or {}
+
+# 紧挨在数组前面的 "键": 部分（在数组起始位置处截止匹配）
+_JSON_KEY_BEFORE_ARRAY_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"\s*:\s*$')
+# 向前查找键名的最大字符数
+_JSON_KEY_LOOKBEHIND = 300
 
-    # 添加更强大的JSON提取处理，处理更多边缘情况
-    # 尝试从文本中抽取任何看起来像JSON对象的内容
-    possible_json_pattern = r'\[\s*\{\s*"model"\s*:.*?\}\s*\]'
-    json_fragments = re.findall(possible_json_pattern, content, re.DOTALL)
+def _salvage_keyed_arrays(content):
+    """从被截断的 JSON 对象中找回已经完整输出的 "键": [...] 条目
     
-    for fragment in json_fragments:
-        try:
-            parsed = json.loads(fragment)
-            # 补全缺少的字段
-            for item in parsed:
-                # 确保item是字典类型
-                if not isinstance(item, dict):
-                    continue
-                    
-                if not all(key in item for key in ["model", "parameters", "type", "datasheet"]):
-                    item["model"] = item.get("model", "未知型号")
-                    item["parameters"] = item.get("parameters", "参数未知")
-                    item["type"] = item.get("type", "未知")
-                    item["datasheet"] = item.get("datasheet", "https://www.example.com/datasheet")
-                # 确保品牌字段存在
-                if "brand" not in item:
-                    item["brand"] = item.get("brand", "未知品牌")
-                # 确保新增字段存在
-                item["category"] = item.get("category", "未知类别")
-                item["package"] = item.get("package", "未知封装")
-                
-                # 添加价格信息（如果没有）并确保价格包含货币符号
-                price = item.get("price", "未知")
-                # 检查价格是否已包含货币符号
-                if price != "未知" and not any(symbol in price for symbol in ["¥", "￥", "$"]):
-                    # 如果是纯数字或数字范围，添加美元符号
-                    if re.match(r'^[\d\.\-\s]+$', price):
-                        # 处理类似 "1.8-2.5" 的价格范围
-                        if "-" in price:
-                            price_parts = price.split("-")
-                            price = f"${price_parts[0].strip()}-${price_parts[1].strip()}"
-                        else:
-                            price = f"${price.strip()}"
-                item["price"] = price
-                
-                # 添加物料状态信息
-                item["status"] = item.get("status", "未知")
-                item["leadTime"] = item.get("leadTime", "未知")
-                
-                # 添加 pin-to-pin 替代相关信息
-                item["pinToPin"] = item.get("pinToPin", False)
-                item["compatibility"] = item.get("compatibility", "兼容性未知")
-                
-            return parsed
-        except json.JSONDecodeError:
-            pass
-            
-    # 如果上面方法都失败，尝试手动修复常见的JSON格式错误
-    for fix_attempt in [
-        lambda c: c.replace("'", '"'),  # 单引号替换为双引号
-        lambda c: re.sub(r'",\s*\}', '"}', c),  # 修复尾部多余逗号
-        lambda c: re.sub(r',\s*]', ']', c)  # 修复数组尾部多余逗号
-    ]:
-        try:
-            fixed_content = fix_attempt(content)
-            parsed = json.loads(fixed_content)
-            if isinstance(parsed, list):
-                for item in parsed:
-                    # 确保item是字典类型
-                    if not isinstance(item, dict):
-                        continue
-                        
-                    if not all(key in item for key in ["model", "parameters", "type", "datasheet"]):
-                        item["model"] = item.get("model", "未知型号")
-                        item["parameters"] = item.get("parameters", "参数未知")
-                        item["type"] = item.get("type", "未知")
-                        item["datasheet"] = item.get("datasheet", "https://www.example.com/datasheet")
-                    # 确保品牌字段存在
-                    if "brand" not in item:
-                        item["brand"] = item.get("brand", "未知品牌")
-                    # 确保新增字段存在
-                    item["category"] = item.get("category", "未知类别")
-                    item["package"] = item.get("package", "未知封装")
-                    
-                    # 添加价格信息（如果没有）并确保价格包含货币符号
-                    price = item.get("price", "未知")
-                    # 检查价格是否已包含货币符号
-                    if price != "未知" and not any(symbol in price for symbol in ["¥", "￥", "$"]):
-                        # 如果是纯数字或数字范围，添加美元符号
-                        if re.match(r'^[\d\.\-\s]+$', price):
-                            # 处理类似 "1.8-2.5" 的价格范围
-                            if "-" in price:
-                                price_parts = price.split("-")
-                                price = f"${price_parts[0].strip()}-${price_parts[1].strip()}"
-                            else:
-                                price = f"${price.strip()}"
-                    item["price"] = price
-                    
-                    # 添加物料状态信息
-                    item["status"] = item.get("status", "未知")
-                    item["leadTime"] = item.get("leadTime", "未知")
-                    
-                    # 添加 pin-to-pin 替代相关信息
-                    item["pinToPin"] = item.get("pinToPin", False)
-                    item["compatibility"] = item.get("compatibility", "兼容性未知")
-                    
-                return parsed
-        except:
-            pass
+    批量响应达到 max_tokens 时最外层对象不完整，但前面各型号的数组通常已经完整，
+    只有最后一个型号的数组被截断（不会被返回）。
+    
+    Returns:
+        {键: 数组}，没有可用条目时返回空字典
+    """
+    if not isinstance(content, str):
+        return {}
+    salvaged = {}
+    covered_end = -1
+    for start, end in _find_json_spans(content, '['):
+        if start < covered_end:
+            continue  # 嵌套在已处理数组中的数组
+        covered_end = end
+        match = _JSON_KEY_BEFORE_ARRAY_PATTERN.search(content, max(0, start - _JSON_KEY_LOOKBEHIND), start)
+        if not match:
+            continue
+        value = _loads_lenient(content[start:end])
+        if isinstance(value, list):
+            salvaged[match.group(1)] = value
+    return salvaged
 
-    # 处理可能的非标准JSON格式
+def get_alternative_parts(part_number):
+    """查询单个元器件的替代方案，优先使用缓存结果"""
+    cached = result_cache.get("single", part_number)
+    if cached is not None:
+        return cached
+
+    key = _flight_key("single", part_number)
+    future, leader = inflight_queries.begin(key)
+    if not leader:
+        return _wait_for_flight(part_number, future, lambda: _query_alternative_parts(part_number))
+
+    recommendations = []
     try:
-        # 最后尝试一种更宽松的解析方法，直接从文本构建数据
-        # 如果内容看起来包含元器件信息但不是有效JSON，构造一个基本响应
-        if "型号" in content and ("国产" in content or "进口" in content):
-            st.sidebar.warning(f"DeepSeek API返回了非标准JSON格式，尝试构建基本替代方案 ({call_type})")
-            # 构造一个基本的替代方案
-            basic_alt = [{
-                "model": "未能解析出型号",
-                "brand": "未知品牌",
-                "category": "未知类别",
-                "package": "未知封装",
-                "parameters": "无法解析参数，请查看API原始响应",
-                "type": "未知",
-                "price": "未知",
-                "status": "未知",
-                "leadTime": "未知",
-                "pinToPin": False,
-                "compatibility": "未知",
-                "datasheet": "https://www.example.com"
-            }]
-            return basic_alt
-    except:
-        pass
+        recommendations = _query_alternative_parts(part_number)
+        # 测试数据不写入缓存
+        if recommendations and not _use_dummy_data():
+            result_cache.set("single", part_number, recommendations)
+    finally:
+        inflight_queries.finish(key, result=recommendations)
+    return recommendations
 
-    st.sidebar.error(f"无法从API响应中提取有效的JSON内容 ({call_type})")
-    return []
+def _flight_key(mode, part_number):
+    """请求合并的键：查询模式 + 规范化型号；测试数据模式单独合并，避免混入真实结果"""
+    return (mode, normalize_mpn(part_number), _use_dummy_data())
 
-def get_alternative_parts(part_number):
-    # Step 1: 获取 Nexar API 的替代元器件数据
-    nexar_alternatives = get_nexar_alternatives(part_number, limit=10)
+def _wait_for_flight(part_number, future, fallback):
+    """等待其他会话正在进行的相同查询，并共享其结果
+    
+    最多等待 INFLIGHT_WAIT_TIMEOUT 秒，超时（进行中的查询卡住）后调用 fallback 自行查询。
+    """
+    event_log.info(f"ℹ️ '{part_number}' 正在被其他查询处理，等待共享结果")
+    try:
+        return inflight_queries.wait(future, timeout=INFLIGHT_WAIT_TIMEOUT)
+    except FutureTimeoutError:
+        event_log.warning(f"等待 '{part_number}' 的共享查询超过 {INFLIGHT_WAIT_TIMEOUT:.0f} 秒，改为直接查询")
+        return fallback()
+    except Exception as e:
+        event_log.error(f"共享查询失败：{e}")
+        return []
+
+def stream_alternative_parts(part_number):
+    """流式查询单个元器件的替代方案，每解析出一个推荐方案就立即返回
+    
+    DeepSeek 以流式方式生成结果，界面可以在后续方案仍在生成时先显示已完成的方案。
+    最终返回的结果（包括 Nexar 补充和二次查询得到的方案）与 get_alternative_parts 一致，并同样写入缓存。
+    
+    Yields:
+        推荐方案字典，最多 3 个
+    """
+    cached = result_cache.get("single", part_number)
+    if cached is not None:
+        yield from cached
+        return
+    
+    # 与相同型号的进行中查询（无论是否流式）合并
+    key = _flight_key("single", part_number)
+    future, leader = inflight_queries.begin(key)
+    if not leader:
+        yield from _wait_for_flight(part_number, future, lambda: _query_alternative_parts(part_number))
+        return
+    
+    final_recommendations = []
+    try:
+        yield from _stream_alternative_parts(part_number, final_recommendations)
+    finally:
+        inflight_queries.finish(key, result=final_recommendations)
+
+def _stream_alternative_parts(part_number, final_recommendations):
+    """stream_alternative_parts 的实际查询过程，最终结果写入 final_recommendations"""
+    nexar_future = None
+    executor = _make_executor(2, thread_name_prefix="single-query")
+    if PIPELINE_SINGLE_QUERY:
+        # Nexar 查询在后台进行，与流式 DeepSeek 调用重叠
+        nexar_future = executor.submit(_get_pipeline_nexar_alternatives, part_number)
+        prompt = _build_single_part_prompt(part_number, PIPELINE_NEXAR_CONTEXT)
+    else:
+        nexar_alternatives = get_nexar_alternatives(part_number, limit=10, profile="minimal", adaptive=True)
+        prompt = _build_single_part_prompt(part_number, _build_nexar_context(part_number, nexar_alternatives))
+    
+    # 流式调用结束时置位；对冲查询在延迟到期且首次调用仍未结束时才发起
+    primary_done = threading.Event()
+    domestic_query = _schedule_domestic_hedge(executor, part_number, primary_done)
+    executor.shutdown(wait=False)
+    
+    streamed = []
+    started = time.monotonic()
+    try:
+        response = get_deepseek_client().chat.completions.create(
+            model=DEEPSEEK_MODEL,
+            messages=[
+                {"role": "system", "content": EXPERT_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            stream=True,
+            max_tokens=1000
+        )
+        parser = JsonArrayStreamParser()
+        raw_chunks = []
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            content = getattr(chunk.choices[0].delta, "content", None)
+            if not content:
+                continue
+            raw_chunks.append(content)
+            for item in parser.feed(content):
+                if not isinstance(item, dict) or len(streamed) >= 3:
+                    continue
+                rec = _normalize_recommendation(item)
+                if str(rec["model"]).lower() == part_number.lower():
+                    continue
+                if rec["type"] == "未知" and is_domestic_brand(str(rec["model"])):
+                    rec["type"] = "国产"
+                streamed.append(rec)
+                yield rec
+        primary_done.set()
+        _record_primary_latency(time.monotonic() - started)
+        
+        if streamed:
+            recommendations = list(streamed)
+        else:
+            # 流式解析未得到结果（例如响应格式不规范），回退为解析完整响应
+            recommendations = extract_json_content("".join(raw_chunks), "流式调用")
+        if nexar_future is not None:
+            nexar_alternatives = nexar_future.result()
+        final_recommendations.extend(
+            _finalize_recommendations(part_number, recommendations, nexar_alternatives, domestic_query))
+    except Exception as e:
+        event_log.error(f"DeepSeek API 调用失败：{e}")
+        return
+    finally:
+        # 调用失败或界面提前停止读取时，放弃尚未使用的对冲查询
+        primary_done.set()
+        if domestic_query is not None:
+            domestic_query[1].set()
+    
+    # 已经返回过的方案位于结果列表最前面，只需补充返回其余方案
+    for rec in final_recommendations[len(streamed):]:
+        yield rec
+    
+    if final_recommendations and not _use_dummy_data():
+        result_cache.set("single", part_number, final_recommendations)
+
+def _build_nexar_context(part_number, nexar_alternatives):
+    """将 Nexar 替代元器件数据整理为提示词上下文"""
     context = "Nexar API 提供的替代元器件数据：\n"
     if (nexar_alternatives):
         for i, alt in enumerate(nexar_alternatives, 1):
             context += f"{i}. 型号: {alt['mpn']}, 名称: {alt['name']}, 链接: {alt['octopartUrl']}\n"
     else:
         # 将警告移到侧边栏
-        st.sidebar.warning(f"Nexar API 未能为 '{part_number}' 找到替代元件")
+        event_log.warning(f"Nexar API 未能为 '{part_number}' 找到替代元件")
         context = "无 Nexar API 数据可用，请直接推荐替代元器件。\n"
+    return context
 
-    # Step 2: 构造 DeepSeek API 的提示词
+def _build_single_part_prompt(part_number, context):
+    """构造单个元器件查询的 DeepSeek 提示词"""
     prompt = f"""
     任务：你是一个专业的电子元器件顾问，专精于国产替代方案。以下是 Nexar API 提供的替代元器件数据，请结合这些数据为输入元器件推荐替代产品。推荐的替代方案必须与输入型号 {part_number} 不同（绝对不能推荐 {part_number} 或其变体，如 {part_number} 的不同封装）。
 
@@ -692,34 +1088,232 @@ def get_alternative_parts(part_number):
         {{"model": "MP2307DN", "brand": "MPS/芯源系统", "category": "DCDC", "package": "SOIC-8", "parameters": "输入电压: 4.75-23V, 输出电压: 0.925-20V, 输出电流: 3A, 效率: 95%", "type": "进口", "status": "即将停产", "price": "$0.8-$1.2", "leadTime": "6-8周", "pinToPin": false, "compatibility": "需要重新设计PCB布局", "datasheet": "https://www.monolithicpower.com/datasheet", "releaseDate": "2010年", "lifecycle": "将于2025年停产，建议寻找替代方案"}}
     ]
     """
+    return prompt
+
+def _build_domestic_prompt(part_number, count):
+    """构造强调国产替代方案的二次查询提示词"""
+    prompt = f"""
+    任务：为以下元器件推荐替代产品，推荐的替代方案必须与输入型号 {part_number} 不同（绝对不能推荐 {part_number} 或其变体，如 {part_number} 的不同封装）。
+    输入元器件型号：{part_number}
+    
+    之前的推荐结果未包含国产方案或数量不足，请重新推荐，重点关注国产替代方案。
+    
+    要求：
+    1. 必须推荐至少一种中国大陆本土品牌的替代方案（如 GigaDevice/兆易创新、WCH/沁恒、复旦微电子、中颖电子、圣邦微电子、3PEAK、Chipsea 等）
+    2. 优先推荐国产芯片，推荐的国产方案数量越多越好
+    3. 如果找不到足够的国产方案，可以补充进口方案，但必须明确标注
+    4. 总共推荐 {count} 种替代方案
+    5. 提供每种型号的品牌名称、封装信息和元器件类目（例如：MCU、DCDC、LDO、传感器等）
+    6. 根据元器件类型提供不同的关键参数：
+       - 若是MCU/单片机：提供CPU内核、主频、程序存储容量、RAM大小、IO数量
+       - 若是DCDC：提供输入电压范围、输出电压、最大输出电流、效率
+       - 若是LDO：提供输入电压范围、输出电压、最大输出电流、压差
+       - 若是存储器：提供容量、接口类型、读写速度
+       - 若是传感器：提供测量范围、精度、接口类型
+       - 其他类型提供对应的关键参数
+    7. 在每个推荐方案中明确标注是"国产"还是"进口"产品
+    8. 提供产品官网链接（若无真实链接，可提供示例链接，如 https://www.example.com/datasheet）
+    9. 推荐的型号不能与输入型号 {part_number} 相同
+    10. 必须严格返回以下 JSON 格式的结果，不允许添加任何额外说明、Markdown 格式或代码块标记，直接返回裸 JSON：
+    [
+        {{"model": "型号1", "brand": "品牌1", "category": "类别1", "package": "封装1", "parameters": "参数1", "type": "国产/进口", "datasheet": "链接1"}},
+        {{"model": "型号2", "brand": "品牌2", "category": "类别2", "package": "封装2", "parameters": "参数2", "type": "国产/进口", "datasheet": "链接2"}}
+    ]
+    11. 每个推荐项必须包含 "model"、"brand"、"category"、"package"、"parameters"、"type" 和 "datasheet" 七个字段
+    12. 如果无法找到合适的替代方案，返回空的 JSON 数组：[]
+    """
+    return prompt
 
+def _query_domestic_variants(part_number, count, cancelled=None, variants=None):
+    """并行发起多个国产方案查询变体，采用第一个有效结果
+    
+    原先的 3 次顺序重试改为同时发起，第一个返回有效推荐的变体胜出，
+    届时已完成的其他变体结果合并去重，尚未完成的请求立即断开连接（不再继续生成和计费）。
+    
+    Args:
+        part_number: 元器件型号
+        count: 需要推荐的方案数
+        cancelled: 可选的 threading.Event，置位后断开进行中的请求，不再等待结果也不再输出提示
+        variants: 并行变体数，默认读取环境变量 DOMESTIC_QUERY_VARIANTS
+        
+    Returns:
+        过滤掉原型号后的推荐列表，全部失败时返回空列表
+    """
+    prompt = _build_domestic_prompt(part_number, count)
+    variants = max(1, variants or DOMESTIC_QUERY_VARIANTS)
+    # 胜出变体产生后置位，使其余变体断开连接
+    finished = threading.Event()
+    stop_events = (finished,) if cancelled is None else (finished, cancelled)
+    executor = _make_executor(variants, thread_name_prefix="domestic-query")
+    futures = {
+        executor.submit(_request_domestic_variant, prompt, index, stop_events): index
+        for index in range(variants)
+    }
+    results = {}
+    winner = None
     try:
-        response = deepseek_client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "你是一个精通中国电子元器件行业的专家，擅长为各种元器件寻找合适的替代方案，尤其专注于中国大陆本土生产的国产元器件。始终以有效的JSON格式回复，不添加任何额外说明。"},
-                {"role": "user", "content": prompt}
-            ],
-            stream=False,
-            max_tokens=1000
-        )
-        raw_content = response.choices[0].message.content
-        recommendations = extract_json_content(raw_content, "初次调用")
+        for future in as_completed(futures):
+            if cancelled is not None and cancelled.is_set():
+                return []
+            index = futures[future]
+            try:
+                recommendations = _filter_domestic_recommendations(part_number, future.result())
+            except Exception as e:
+                event_log.warning(f"⚠️ 重新调用 DeepSeek API 第 {index + 1} 个并行查询失败：{e}")
+                continue
+            if recommendations:
+                winner = index
+                results[index] = recommendations
+                break
+            event_log.warning(f"⚠️ 重新调用 DeepSeek API 第 {index + 1} 个并行查询未返回有效推荐。")
+        if not results:
+            return []
+        finished.set()
+
+        # 合并同时已经完成的其他变体
+        for future, index in futures.items():
+            if index in results or not future.done() or future.cancelled() or future.exception() is not None:
+                continue
+            results[index] = _filter_domestic_recommendations(part_number, future.result())
+    finally:
+        finished.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # 胜出变体的结果在前，其余按变体顺序合并并按型号去重
+    merged = []
+    seen = set()
+    for index in [winner] + sorted(i for i in results if i != winner):
+        for rec in results[index]:
+            model = str(rec.get("model", "")).lower()
+            if model not in seen:
+                seen.add(model)
+                merged.append(rec)
+    return merged
+
+def _request_domestic_variant(prompt, index, stop_events=()):
+    """发送一个国产方案查询变体，各变体仅采样温度不同
+    
+    以流式方式接收回复，stop_events 中任一标志置位后立即关闭连接并返回空列表，
+    服务端随之停止生成，被放弃的请求不会按完整回复计费。
+    """
+    temperature = DOMESTIC_QUERY_TEMPERATURES[index % len(DOMESTIC_QUERY_TEMPERATURES)]
+    response = get_deepseek_client().chat.completions.create(
+        model=DEEPSEEK_MODEL,
+        messages=[
+            {"role": "system", "content": EXPERT_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+        max_tokens=1000,
+        temperature=temperature
+    )
+    raw_chunks = []
+    try:
+        for chunk in response:
+            if any(event.is_set() for event in stop_events):
+                return []
+            if chunk.choices:
+                raw_chunks.append(getattr(chunk.choices[0].delta, "content", None) or "")
+    finally:
+        response.close()
+    return extract_json_content("".join(raw_chunks), f"重新调用，并行查询 {index + 1}")
 
-        # Step 3: 过滤掉与输入型号相同的推荐
-        filtered_recommendations = []
-        for rec in recommendations:
-            if isinstance(rec, dict) and rec.get("model", "").lower() != part_number.lower():
-                filtered_recommendations.append(rec)
-        recommendations = filtered_recommendations
+def _filter_domestic_recommendations(part_number, recommendations):
+    """过滤掉与原型号相同的推荐，并识别国产方案"""
+    filtered = []
+    for rec in recommendations or []:
+        if not isinstance(rec, dict) or rec.get("model", "").lower() == part_number.lower():
+            continue
+        if rec.get("type") == "未知" and is_domestic_brand(rec.get("model", "")):
+            rec["type"] = "国产"
+        filtered.append(rec)
+    return filtered
 
-        # Step 4: 如果推荐数量不足，从 Nexar 数据中补充
-        if len(recommendations) < 3 and nexar_alternatives:
+def _finalize_recommendations(part_number, recommendations, nexar_alternatives, domestic_query=None):
+    """对首次 DeepSeek 推荐结果做后处理：过滤、Nexar 补充、识别国产方案，必要时重新调用 DeepSeek
+    
+    Args:
+        domestic_query: 已提前发起的国产方案查询 (future, 取消标志)，为 None 时按需发起
+        
+    Returns:
+        最多 3 个推荐方案
+    """
+    # Step 3: 过滤掉与输入型号相同的推荐
+    filtered_recommendations = []
+    for rec in recommendations:
+        if isinstance(rec, dict) and rec.get("model", "").lower() != part_number.lower():
+            filtered_recommendations.append(rec)
+    recommendations = filtered_recommendations
+    
+    # Step 4: 如果推荐数量不足，从 Nexar 数据中补充
+    if len(recommendations) < 3 and nexar_alternatives:
+        for alt in nexar_alternatives:
+            if len(recommendations) >= 3:
+                break
+            if alt["mpn"].lower() != part_number.lower():
+                recommendations.append({
+                    "model": alt["mpn"],
+                    "brand": alt.get("name", "未知品牌").split(' ')[0] if alt.get("name") else "未知品牌",
+                    "category": "未知类别",
+                    "package": "未知封装",
+                    "parameters": "参数未知",
+                    "type": "未知",
+                    "datasheet": alt["octopartUrl"]
+                })
+    
+    # Step 5: 后处理，识别国产方案
+    for rec in recommendations:
+        if isinstance(rec, dict) and rec.get("type") == "未知" and is_domestic_brand(rec.get("model", "")):
+            rec["type"] = "国产"
+    
+    # Step 6: 如果仍然不足 3 个，或缺少国产方案，重新调用 DeepSeek 强调国产优先
+    need_second_query = len(recommendations) < 3 or not any(isinstance(rec, dict) and rec.get("type") == "国产" for rec in recommendations)
+    
+    if not need_second_query and domestic_query is not None:
+        # 首次结果已满足要求，放弃提前发起的国产方案查询
+        domestic_query[1].set()
+        domestic_query[0].cancel()
+    
+    if need_second_query:
+        event_log.warning("⚠️ 推荐结果不足或未包含国产方案，将重新调用 DeepSeek 推荐。")
+    
+        if domestic_query is not None:
+            # 提前发起的对冲查询只有一个变体，未返回有效结果时再按常规方式并行查询
+            additional_recommendations = (domestic_query[0].result()
+                                          or _query_domestic_variants(part_number, 3 - len(recommendations)))
+        else:
+            additional_recommendations = _query_domestic_variants(part_number, 3 - len(recommendations))
+        second_query_success = bool(additional_recommendations)
+    
+        if second_query_success:
+            found_domestic = any(rec.get("type") == "国产" for rec in additional_recommendations)
+    
+            # 记录二次查询结果
+            if found_domestic:
+                event_log.success(f"✅ 二次查询成功！找到了 {len(additional_recommendations)} 个替代方案，其中包含国产方案。")
+            else:
+                event_log.info(f"ℹ️ 二次查询返回了 {len(additional_recommendations)} 个替代方案，但未找到国产方案。")
+    
+            # 添加到推荐列表，跳过已有的型号
+            existing_models = {str(rec.get("model", "")).lower() for rec in recommendations if isinstance(rec, dict)}
+            for rec in additional_recommendations:
+                if len(recommendations) >= 3:
+                    break
+                if str(rec.get("model", "")).lower() not in existing_models:
+                    recommendations.append(rec)
+        else:
+            event_log.error("❌ 重新调用 DeepSeek API 未能返回有效推荐，将使用默认替代方案。")
+    
+        # 如果二次查询失败且结果仍然不足，从 Nexar 数据中补充
+        if not second_query_success or len(recommendations) < 3:
             for alt in nexar_alternatives:
                 if len(recommendations) >= 3:
                     break
-                if alt["mpn"].lower() != part_number.lower():
-                    recommendations.append({
+                # 检查是否已经包含此型号
+                if alt["mpn"].lower() != part_number.lower() and not any(
+                        isinstance(rec, dict) and rec.get("model", "").lower() == alt["mpn"].lower() 
+                        for rec in recommendations):
+                    new_rec = {
                         "model": alt["mpn"],
                         "brand": alt.get("name", "未知品牌").split(' ')[0] if alt.get("name") else "未知品牌",
                         "category": "未知类别",
@@ -727,287 +1321,475 @@ def get_alternative_parts(part_number):
                         "parameters": "参数未知",
                         "type": "未知",
                         "datasheet": alt["octopartUrl"]
-                    })
-
-        # Step 5: 后处理，识别国产方案
-        for rec in recommendations:
-            if isinstance(rec, dict) and rec.get("type") == "未知" and is_domestic_brand(rec.get("model", "")):
-                rec["type"] = "国产"
-
-        # Step 6: 如果仍然不足 3 个，或缺少国产方案，重新调用 DeepSeek 强调国产优先
-        need_second_query = len(recommendations) < 3 or not any(isinstance(rec, dict) and rec.get("type") == "国产" for rec in recommendations)
-        
+                    }
+                    # 识别国产方案
+                    if is_domestic_brand(new_rec["model"]):
+                        new_rec["type"] = "国产"
+                    recommendations.append(new_rec)
+    
+        # 在二次查询完成后再做一次最终统计
         if need_second_query:
-            st.sidebar.warning("⚠️ 推荐结果不足或未包含国产方案，将重新调用 DeepSeek 推荐。")
-            
-            prompt_retry = f"""
-            任务：为以下元器件推荐替代产品，推荐的替代方案必须与输入型号 {part_number} 不同（绝对不能推荐 {part_number} 或其变体，如 {part_number} 的不同封装）。
-            输入元器件型号：{part_number}
-
-            之前的推荐结果未包含国产方案或数量不足，请重新推荐，重点关注国产替代方案。
-
-            要求：
-            1. 必须推荐至少一种中国大陆本土品牌的替代方案（如 GigaDevice/兆易创新、WCH/沁恒、复旦微电子、中颖电子、圣邦微电子、3PEAK、Chipsea 等）
-            2. 优先推荐国产芯片，推荐的国产方案数量越多越好
-            3. 如果找不到足够的国产方案，可以补充进口方案，但必须明确标注
-            4. 总共推荐 {3 - len(recommendations)} 种替代方案
-            5. 提供每种型号的品牌名称、封装信息和元器件类目（例如：MCU、DCDC、LDO、传感器等）
-            6. 根据元器件类型提供不同的关键参数：
-               - 若是MCU/单片机：提供CPU内核、主频、程序存储容量、RAM大小、IO数量
-               - 若是DCDC：提供输入电压范围、输出电压、最大输出电流、效率
-               - 若是LDO：提供输入电压范围、输出电压、最大输出电流、压差
-               - 若是存储器：提供容量、接口类型、读写速度
-               - 若是传感器：提供测量范围、精度、接口类型
-               - 其他类型提供对应的关键参数
-            7. 在每个推荐方案中明确标注是"国产"还是"进口"产品
-            8. 提供产品官网链接（若无真实链接，可提供示例链接，如 https://www.example.com/datasheet）
-            9. 推荐的型号不能与输入型号 {part_number} 相同
-            10. 必须严格返回以下 JSON 格式的结果，不允许添加任何额外说明、Markdown 格式或代码块标记，直接返回裸 JSON：
-            [
-                {{"model": "型号1", "brand": "品牌1", "category": "类别1", "package": "封装1", "parameters": "参数1", "type": "国产/进口", "datasheet": "链接1"}},
-                {{"model": "型号2", "brand": "品牌2", "category": "类别2", "package": "封装2", "parameters": "参数2", "type": "国产/进口", "datasheet": "链接2"}}
-            ]
-            11. 每个推荐项必须包含 "model"、"brand"、"category"、"package"、"parameters"、"type" 和 "datasheet" 七个字段
-            12. 如果无法找到合适的替代方案，返回空的 JSON 数组：[]
-            """
-            
-            second_query_success = False
-            max_retries = 3
-            additional_recommendations = []
-            
-            for attempt in range(max_retries):
-                try:
-                    response_retry = deepseek_client.chat.completions.create(
-                        model="deepseek-chat",
-                        messages=[
-                            {"role": "system", "content": "你是一个精通中国电子元器件行业的专家，擅长为各种元器件寻找合适的替代方案，尤其专注于中国大陆本土生产的国产元器件。始终以有效的JSON格式回复，不添加任何额外说明。"},
-                            {"role": "user", "content": prompt_retry}
-                        ],
-                        stream=False,
-                        max_tokens=1000
-                    )
-                    raw_content_retry = response_retry.choices[0].message.content
-                    
-                    with st.spinner(f"正在解析第 {attempt + 1} 次二次查询结果..."):
-                        additional_recommendations = extract_json_content(raw_content_retry, f"重新调用，第 {attempt + 1} 次")
-                    
-                    if additional_recommendations:
-                        second_query_success = True
-                        # 过滤掉与原型号相同的推荐
-                        filtered_additional_recommendations = []
-                        for rec in additional_recommendations:
-                            if isinstance(rec, dict) and rec.get("model", "").lower() != part_number.lower():
-                                filtered_additional_recommendations.append(rec)
-                        additional_recommendations = filtered_additional_recommendations
-                        
-                        # 快速检查是否找到了国产方案
-                        found_domestic = False
-                        for rec in additional_recommendations:
-                            if not isinstance(rec, dict):
-                                continue
-                            if rec.get("type") == "未知" and is_domestic_brand(rec.get("model", "")):
-                                rec["type"] = "国产"
-                            if rec.get("type") == "国产":
-                                found_domestic = True
-                        
-                        # 记录二次查询结果
-                        if found_domestic:
-                            st.sidebar.success(f"✅ 二次查询成功！找到了 {len(additional_recommendations)} 个替代方案，其中包含国产方案。")
-                        else:
-                            st.sidebar.info(f"ℹ️ 二次查询返回了 {len(additional_recommendations)} 个替代方案，但未找到国产方案。")
-                        
-                        # 添加到推荐列表
-                        for rec in additional_recommendations:
-                            if len(recommendations) >= 3:
-                                break
-                            recommendations.append(rec)
-                        break
-                    else:
-                        st.sidebar.warning(f"⚠️ 重新调用 DeepSeek API 第 {attempt + 1} 次未返回有效推荐。")
-                        if attempt == max_retries - 1:
-                            st.sidebar.error("❌ 重新调用 DeepSeek API 未能返回有效推荐，将使用默认替代方案。")
-                except Exception as e:
-                    st.sidebar.warning(f"⚠️ 重新调用 DeepSeek API 第 {attempt + 1} 次失败：{e}")
-                    if attempt == max_retries - 1:
-                        st.sidebar.error("❌ 重新调用 DeepSeek API 失败，将使用默认替代方案。")
-            
-            # 如果二次查询失败且结果仍然不足，从 Nexar 数据中补充
-            if not second_query_success or len(recommendations) < 3:
-                for alt in nexar_alternatives:
-                    if len(recommendations) >= 3:
-                        break
-                    # 检查是否已经包含此型号
-                    if alt["mpn"].lower() != part_number.lower() and not any(
-                            isinstance(rec, dict) and rec.get("model", "").lower() == alt["mpn"].lower() 
-                            for rec in recommendations):
-                        new_rec = {
-                            "model": alt["mpn"],
-                            "brand": alt.get("name", "未知品牌").split(' ')[0] if alt.get("name") else "未知品牌",
-                            "category": "未知类别",
-                            "package": "未知封装",
-                            "parameters": "参数未知",
-                            "type": "未知",
-                            "datasheet": alt["octopartUrl"]
-                        }
-                        # 识别国产方案
-                        if is_domestic_brand(new_rec["model"]):
-                            new_rec["type"] = "国产"
-                        recommendations.append(new_rec)
-            
-            # 在二次查询完成后再做一次最终统计
-            if need_second_query:
-                domestic_count = sum(1 for rec in recommendations if isinstance(rec, dict) and rec.get("type") == "国产")
-                import_count = sum(1 for rec in recommendations if isinstance(rec, dict) and (rec.get("type") == "进口" or rec.get("type") == "未知"))
-                st.sidebar.info(f"🔍 查找完成，共找到 {len(recommendations)} 个替代方案，其中国产方案 {domestic_count} 个，进口/未知方案 {import_count} 个。")
-
-        # Step 7: 再次后处理，识别国产方案
-        for rec in recommendations:
-            if isinstance(rec, dict) and rec.get("type") == "未知" and is_domestic_brand(rec.get("model", "")):
-                rec["type"] = "国产"
-
-        # 确保recommendations是可切片类型并安全执行切片
-        try:
-            # 确保输出结果是列表类型
-            if not isinstance(recommendations, list):
-                st.sidebar.warning(f"推荐结果不是列表类型: {type(recommendations)}")
-                if recommendations:
-                    if isinstance(recommendations, dict):
-                        recommendations = [recommendations]
-                    else:
-                        try:
-                            recommendations = list(recommendations)
-                        except:
-                            st.sidebar.error("无法将推荐结果转换为列表")
-                            return []
-                else:
-                    return []
-                    
-            # 安全地执行切片
-            return recommendations[:3] if recommendations else []
-        except Exception as slice_error:
-            st.sidebar.error(f"切片操作失败: {slice_error}")
-            # 处理非常规情况，确保返回一个列表
+            domestic_count = sum(1 for rec in recommendations if isinstance(rec, dict) and rec.get("type") == "国产")
+            import_count = sum(1 for rec in recommendations if isinstance(rec, dict) and (rec.get("type") == "进口" or rec.get("type") == "未知"))
+            event_log.info(f"🔍 查找完成，共找到 {len(recommendations)} 个替代方案，其中国产方案 {domestic_count} 个，进口/未知方案 {import_count} 个。")
+    
+    # Step 7: 再次后处理，识别国产方案
+    for rec in recommendations:
+        if isinstance(rec, dict) and rec.get("type") == "未知" and is_domestic_brand(rec.get("model", "")):
+            rec["type"] = "国产"
+    
+    # 确保recommendations是可切片类型并安全执行切片
+    try:
+        # 确保输出结果是列表类型
+        if not isinstance(recommendations, list):
+            event_log.warning(f"推荐结果不是列表类型: {type(recommendations)}")
             if recommendations:
-                if isinstance(recommendations, (list, tuple)):
-                    return list(recommendations)[:3] if len(recommendations) >= 3 else list(recommendations)
+                if isinstance(recommendations, dict):
+                    recommendations = [recommendations]
                 else:
-                    return [recommendations]
+                    try:
+                        recommendations = list(recommendations)
+                    except:
+                        event_log.error("无法将推荐结果转换为列表")
+                        return []
             else:
                 return []
+    
+        # 安全地执行切片
+        return recommendations[:3] if recommendations else []
+    except Exception as slice_error:
+        event_log.error(f"切片操作失败: {slice_error}")
+        # 处理非常规情况，确保返回一个列表
+        if recommendations:
+            if isinstance(recommendations, (list, tuple)):
+                return list(recommendations)[:3] if len(recommendations) >= 3 else list(recommendations)
+            else:
+                return [recommendations]
+        else:
+            return []
+
+# 并行模式下首次 DeepSeek 调用拿不到 Nexar 数据，Nexar 结果在合并阶段用于补充推荐
+PIPELINE_NEXAR_CONTEXT = "Nexar API 数据与本次推荐同时查询，此处不提供，请直接推荐替代元器件。\n"
+
+def _query_alternative_parts(part_number):
+    if PIPELINE_SINGLE_QUERY:
+        return _query_alternative_parts_pipelined(part_number)
+
+    # Step 1: 获取 Nexar API 的替代元器件数据
+    # 提示词上下文只用到型号、名称和链接，使用精简查询
+    nexar_alternatives = get_nexar_alternatives(part_number, limit=10, profile="minimal", adaptive=True)
+    context = _build_nexar_context(part_number, nexar_alternatives)
+
+    # Step 2: 构造 DeepSeek API 的提示词
+    prompt = _build_single_part_prompt(part_number, context)
+
+    executor = _make_executor(2, thread_name_prefix="single-query")
+    try:
+        primary_future = executor.submit(_request_recommendations, prompt, "初次调用")
+        recommendations, domestic_query = _await_primary_with_hedge(part_number, primary_future, executor)
+        return _finalize_recommendations(part_number, recommendations, nexar_alternatives, domestic_query)
     except Exception as e:
-        st.sidebar.error(f"DeepSeek API 调用失败：{e}")
+        event_log.error(f"DeepSeek API 调用失败：{e}")
         return []
+    finally:
+        # 未使用的对冲查询直接放弃，不等待其返回
+        executor.shutdown(wait=False, cancel_futures=True)
 
-def process_bom_file(uploaded_file):
-    """处理上传的BOM文件并返回元器件列表"""
-    # 再次检查依赖，确保已安装
-    check_and_install_dependencies()
+def _query_alternative_parts_pipelined(part_number):
+    """两阶段查询：Nexar 查询与不依赖 Nexar 数据的首次 DeepSeek 调用同时进行，
+    两者都返回后再合并结果，并决定是否需要二次查询国产方案
+    """
+    prompt = _build_single_part_prompt(part_number, PIPELINE_NEXAR_CONTEXT)
+
+    # 阶段一：并行发起两个请求（必要时还有国产方案对冲查询）
+    executor = _make_executor(3, thread_name_prefix="single-query")
+    try:
+        nexar_future = executor.submit(_get_pipeline_nexar_alternatives, part_number)
+        primary_future = executor.submit(_request_recommendations, prompt, "初次调用")
+
+        # 阶段二：合并结果
+        try:
+            recommendations, domestic_query = _await_primary_with_hedge(part_number, primary_future, executor)
+        except Exception as e:
+            event_log.error(f"DeepSeek API 调用失败：{e}")
+            return []
+        nexar_alternatives = nexar_future.result()
+
+        try:
+            return _finalize_recommendations(part_number, recommendations, nexar_alternatives, domestic_query)
+        except Exception as e:
+            event_log.error(f"DeepSeek API 调用失败：{e}")
+            return []
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _await_primary_with_hedge(part_number, primary_future, executor):
+    """等待首次 DeepSeek 调用结果，并按 DOMESTIC_HEDGE_MODE 提前发起国产方案查询
     
-    # 创建临时文件
-    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        tmp_filepath = tmp_file.name
+    对冲查询只发起一个变体；首次结果已满足要求时 _finalize_recommendations 会将其取消（断开连接）。
+    latency 模式下耗时样本不足且未指定 DOMESTIC_HEDGE_DELAY 时不对冲。
     
+    Returns:
+        (首次调用的推荐列表, 已发起的国产方案查询或 None)
+    """
+    started = time.monotonic()
+    domestic_query = None
+    if DOMESTIC_HEDGE_MODE == "speculative":
+        domestic_query = _start_domestic_query(executor, part_number)
+    elif DOMESTIC_HEDGE_MODE == "latency":
+        delay = _domestic_hedge_delay()
+        if delay is not None:
+            done, _ = wait([primary_future], timeout=delay)
+            if not done:
+                domestic_query = _start_domestic_query(executor, part_number)
+
     try:
-        # 根据文件扩展名读取文件
-        file_ext = os.path.splitext(uploaded_file.name)[1].lower()
-        if file_ext == '.csv':
-            df = pd.read_csv(tmp_filepath)
-        elif file_ext == '.xls':
-            # 专门处理旧版Excel文件
-            try:
-                df = pd.read_excel(tmp_filepath, engine='xlrd')
-            except Exception as e:
-                st.error(f"无法使用xlrd读取.xls文件: {e}")
-                st.warning("尝试使用openpyxl引擎...")
-                df = pd.read_excel(tmp_filepath, engine='openpyxl')
-        elif file_ext == '.xlsx':
-            # 处理新版Excel文件
-            df = pd.read_excel(tmp_filepath, engine='openpyxl')
-        else:
-            raise ValueError(f"不支持的文件格式: {file_ext}")
+        recommendations = primary_future.result()
+    except Exception:
+        if domestic_query is not None:
+            domestic_query[1].set()
+        raise
+    _record_primary_latency(time.monotonic() - started)
+    return recommendations, domestic_query
+
+def _record_primary_latency(seconds):
+    with _primary_latencies_lock:
+        _primary_latencies.append(seconds)
+
+def _domestic_hedge_delay():
+    """首次调用的 p90 耗时，样本不足时使用 DOMESTIC_HEDGE_DELAY（未设置时为 None，即不对冲）"""
+    with _primary_latencies_lock:
+        samples = sorted(_primary_latencies)
+    if len(samples) < DOMESTIC_HEDGE_MIN_SAMPLES:
+        return DOMESTIC_HEDGE_DELAY
+    return samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+
+def _start_domestic_query(executor, part_number):
+    """在后台发起单个变体的国产方案查询，返回 (future, 取消标志)"""
+    cancelled = threading.Event()
+    future = executor.submit(_query_domestic_variants, part_number, 3, cancelled, 1)
+    return future, cancelled
+
+def _schedule_domestic_hedge(executor, part_number, primary_done):
+    """流式调用版本的 _await_primary_with_hedge：首次调用以流式返回，无法边等待边计时，
+    由后台任务等待对冲延迟，到期时首次调用仍未结束（primary_done 未置位）才发起国产方案查询
+    
+    Returns:
+        (future, 取消标志) 或 None；首次调用先结束时 future 的结果为 None
+    """
+    if DOMESTIC_HEDGE_MODE == "speculative":
+        return _start_domestic_query(executor, part_number)
+    if DOMESTIC_HEDGE_MODE != "latency":
+        return None
+    delay = _domestic_hedge_delay()
+    if delay is None:
+        return None
+    
+    cancelled = threading.Event()
+    
+    def delayed_query():
+        if primary_done.wait(delay) or cancelled.is_set():
+            return None
+        return _query_domestic_variants(part_number, 3, cancelled, 1)
+    
+    return executor.submit(delayed_query), cancelled
+
+def _get_pipeline_nexar_alternatives(part_number):
+    """并行模式下的 Nexar 查询，与串行模式一样在无结果时给出提示"""
+    nexar_alternatives = get_nexar_alternatives(part_number, limit=10, profile="minimal", adaptive=True)
+    if not nexar_alternatives:
+        event_log.warning(f"Nexar API 未能为 '{part_number}' 找到替代元件")
+    return nexar_alternatives
+
+def _request_recommendations(prompt, call_type):
+    """调用 DeepSeek 获取推荐方案并解析为列表"""
+    response = get_deepseek_client().chat.completions.create(
+        model=DEEPSEEK_MODEL,
+        messages=[
+            {"role": "system", "content": EXPERT_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=False,
+        max_tokens=1000
+    )
+    raw_content = response.choices[0].message.content
+    return extract_json_content(raw_content, call_type)
+
+# 常见的包装/编带后缀，同一颗芯片的卷带、切带、散装版本只查询一次
+# 仅收录不会改变器件本身的后缀；TI 的 R/T 等含义不唯一的单字母后缀不做处理
+MPN_PACKAGING_SUFFIX_PATTERNS = [
+    re.compile(r'(?<=#)TR(?=PBF$)'),         # LT/ADI: #TRPBF -> #PBF
+    re.compile(r'[/\-,#](?:TAPE|REEL|CUT)(?:7|13)?$'),  # -REEL、-REEL7、/TAPE（必须带分隔符，STM32F4CUT 不变）
+    re.compile(r'[/\-,#]TR$'),               # /TR、-TR、#TR
+    re.compile(r'(?<=\d)TR$'),               # STM32F103C8T6TR
+    re.compile(r'-(?:7|13)(?=-F$)'),         # Diodes: -7-F、-13-F -> -F
+    re.compile(r'(?<=^G[RCJ][MT]\w{14})[BCDJKL]$'),  # Murata 片容第 18 位为包装代码
+]
+
+def canonicalize_mpn(part_number):
+    """将元器件型号转换为用于去重的规范形式
+    
+    统一全角/半角（NFKC）、去除全部空白并转为大写，再去掉已知的包装/编带后缀。
+    例如 "ＳＴＭ32F103C8T6TR" 与 "stm32f103c8t6 " 得到相同的规范型号。
+    
+    Args:
+        part_number: 原始型号字符串
         
-        # 尝试识别关键列：型号列、名称列、描述列
-        # 可能的列名
-        mpn_columns = []  # 型号列
-        name_columns = []  # 名称列
-        desc_columns = []  # 描述列
+    Returns:
+        规范型号
+    """
+    canonical = unicodedata.normalize("NFKC", str(part_number))
+    canonical = "".join(canonical.split()).upper()
+    changed = True
+    while changed:
+        changed = False
+        for pattern in MPN_PACKAGING_SUFFIX_PATTERNS:
+            stripped = pattern.sub("", canonical, count=1)
+            # 不允许把型号删空或只剩过短的前缀
+            if stripped != canonical and len(stripped) >= 3:
+                canonical = stripped
+                changed = True
+    return canonical
+
+def expand_alias_results(results, component_list):
+    """将按规范型号查询得到的结果分发给 BOM 中的每个原始型号写法
+    
+    别名条目是结果的副本，并带有 alias_of 字段指向实际查询的型号；
+    名称和描述使用该写法所在行的值（alias_info），所在行没有填写时沿用合并后的值。
+    
+    Args:
+        results: batch_get_alternative_parts 返回的结果字典
+        component_list: process_bom_file 返回的元器件列表（含 aliases 字段）
         
-        mpn_keywords = ['mpn', 'part', 'part_number', 'part number', 'partnumber', '型号', '规格型号', '器件型号']
-        name_keywords = ['name', 'component', 'component_name', '名称', '元件名称', '器件名称']
-        desc_keywords = ['description', 'desc', '描述', '规格', '说明', '特性']
+    Returns:
+        包含所有原始型号写法的结果字典，顺序与 BOM 中首次出现的顺序一致
+    """
+    expanded = {}
+    for component in component_list:
+        mpn = component.get('mpn', '')
+        if mpn not in results:
+            continue
+        expanded[mpn] = results[mpn]
+        alias_info = component.get('alias_info') or {}
+        for alias in component.get('aliases', []):
+            if alias == mpn or alias in expanded:
+                continue
+            alias_result = copy.deepcopy(results[mpn])
+            alias_result['alias_of'] = mpn
+            for field, value in alias_info.get(alias, {}).items():
+                if value:
+                    alias_result[field] = value
+            expanded[alias] = alias_result
+    # 保留不在元器件列表中的结果
+    for mpn, result in results.items():
+        expanded.setdefault(mpn, result)
+    return expanded
+
+# 已解析的 BOM 表格缓存（按文件内容哈希），文件预览与批量处理共用同一次解析
+BOM_FRAME_CACHE_SIZE = 4
+_bom_frame_cache = OrderedDict()
+_bom_frame_cache_lock = threading.Lock()
+
+def read_bom_dataframe(uploaded_file):
+    """直接从上传文件的内存缓冲区解析 BOM 表格
+    
+    解析结果按文件内容的哈希缓存，同一文件的预览和批量处理只解析一次。
+    返回的 DataFrame 为共享对象，调用方不应原地修改。
+    
+    Args:
+        uploaded_file: Streamlit 上传的文件对象（需提供 name 和 getvalue()）
         
-        # 遍历所有列，尝试匹配关键词
+    Returns:
+        解析得到的 DataFrame
+    """
+    check_and_install_dependencies()
+    
+    content = uploaded_file.getvalue()
+    file_ext = os.path.splitext(uploaded_file.name)[1].lower()
+    cache_key = (hashlib.sha256(content).hexdigest(), file_ext)
+    with _bom_frame_cache_lock:
+        df = _bom_frame_cache.get(cache_key)
+        if df is not None:
+            _bom_frame_cache.move_to_end(cache_key)
+            return df
+    
+    # 根据文件扩展名读取文件
+    buffer = io.BytesIO(content)
+    if file_ext == '.csv':
+        # 与流式读取一致，各列按文本读取，纯数字型号不会变成 "12345.0"
+        df = pd.read_csv(buffer, dtype=str)
+    elif file_ext == '.xls':
+        # 专门处理旧版Excel文件
+        try:
+            df = pd.read_excel(buffer, engine='xlrd')
+        except Exception as e:
+            event_log.warning(f"无法使用xlrd读取.xls文件: {e}，尝试使用openpyxl引擎...")
+            df = pd.read_excel(io.BytesIO(content), engine='openpyxl')
+    elif file_ext == '.xlsx':
+        # 处理新版Excel文件
+        df = pd.read_excel(buffer, engine='openpyxl')
+    else:
+        raise ValueError(f"不支持的文件格式: {file_ext}")
+    
+    with _bom_frame_cache_lock:
+        _bom_frame_cache[cache_key] = df
+        while len(_bom_frame_cache) > BOM_FRAME_CACHE_SIZE:
+            _bom_frame_cache.popitem(last=False)
+    return df
+
+def detect_bom_columns(df):
+    """识别 BOM 表格中的型号列、名称列和描述列
+    
+    只需要表头和少量数据行，流式读取时传入文件开头的样本即可。
+    
+    Returns:
+        (型号列, 名称列, 描述列)，未识别的列为 None
+    """
+    # 尝试识别关键列：型号列、名称列、描述列
+    # 可能的列名
+    mpn_columns = []  # 型号列
+    name_columns = []  # 名称列
+    desc_columns = []  # 描述列
+    
+    mpn_keywords = ['mpn', 'part', 'part_number', 'part number', 'partnumber', '型号', '规格型号', '器件型号']
+    name_keywords = ['name', 'component', 'component_name', '名称', '元件名称', '器件名称']
+    desc_keywords = ['description', 'desc', '描述', '规格', '说明', '特性']
+    
+    # 遍历所有列，尝试匹配关键词
+    for col in df.columns:
+        col_lower = str(col).lower()
+        # 检查是否为型号列
+        if any(keyword in col_lower for keyword in mpn_keywords):
+            mpn_columns.append(col)
+        # 检查是否为名称列
+        if any(keyword in col_lower for keyword in name_keywords):
+            name_columns.append(col)
+        # 检查是否为描述列
+        if any(keyword in col_lower for keyword in desc_keywords):
+            desc_columns.append(col)
+    
+    # 如果没有找到明确的列，尝试从所有列中查找最有可能的型号列
+    if not mpn_columns:
         for col in df.columns:
-            col_lower = str(col).lower()
-            # 检查是否为型号列
-            if any(keyword in col_lower for keyword in mpn_keywords):
+            sample_values = df[col].dropna().head(5).astype(str).tolist()
+            # 检查值的特征是否像型号（通常含有数字和字母的组合）
+            if sample_values and all(bool(re.search(r'[A-Za-z].*\d|\d.*[A-Za-z]', val)) for val in sample_values):
                 mpn_columns.append(col)
-            # 检查是否为名称列
-            if any(keyword in col_lower for keyword in name_keywords):
-                name_columns.append(col)
-            # 检查是否为描述列
-            if any(keyword in col_lower for keyword in desc_keywords):
-                desc_columns.append(col)
-        
-        # 如果没有找到明确的列，尝试从所有列中查找最有可能的型号列
-        if not mpn_columns:
-            for col in df.columns:
-                sample_values = df[col].dropna().astype(str).tolist()[:5]
-                # 检查值的特征是否像型号（通常含有数字和字母的组合）
-                if sample_values and all(bool(re.search(r'[A-Za-z].*\d|\d.*[A-Za-z]', val)) for val in sample_values):
-                    mpn_columns.append(col)
-        
-        # 构建元器件列表，包含型号、名称和描述信息
-        component_list = []
+    
+    # 确定最终使用的列
+    mpn_col = mpn_columns[0] if mpn_columns else None
+    name_col = name_columns[0] if name_columns else None
+    desc_col = desc_columns[0] if desc_columns else None
+    
+    # 如果没有找到任何列，使用前几列
+    if not mpn_col and len(df.columns) >= 1:
+        mpn_col = df.columns[0]
+    if not name_col and len(df.columns) >= 2:
+        name_col = df.columns[1]
+    if not desc_col and len(df.columns) >= 3:
+        desc_col = df.columns[2]
+    
+    return mpn_col, name_col, desc_col
+
+def extract_bom_components(df, mpn_col, name_col=None, desc_col=None, as_frame=False):
+    """从 BOM 表格中提取元器件（按列整体处理，不逐行遍历）
+    
+    去掉型号为空的行，批量去除首尾空白，再按规范型号去重。
+    同一器件的多种写法合并为一个元器件，aliases 为各原始写法；
+    首次出现的行缺少名称或描述时，用同组后续行补充。
+    alias_info 记录每种写法自己的名称和描述（该写法各行中第一个非空值），
+    expand_alias_results 据此让别名条目保留所在行的信息。
+    
+    Args:
+        df: BOM 表格
+        mpn_col: 型号列
+        name_col: 名称列，可为 None
+        desc_col: 描述列，可为 None
+        as_frame: 为 True 时返回 DataFrame，否则返回字典列表
         
-        # 确定最终使用的列
-        mpn_col = mpn_columns[0] if mpn_columns else None
-        name_col = name_columns[0] if name_columns else None
-        desc_col = desc_columns[0] if desc_columns else None
+    Returns:
+        元器件列表，每项包含 mpn、name、description、canonical_mpn、aliases、alias_info
+    """
+    columns = ['mpn', 'name', 'description', 'canonical_mpn', 'aliases', 'alias_info']
+    if mpn_col is None or df.empty:
+        empty = pd.DataFrame(columns=columns)
+        return empty if as_frame else []
+    
+    def text_column(col):
+        if col is None:
+            return pd.Series('', index=df.index)
+        values = df[col]
+        return values.where(values.notna(), '').astype(str).str.strip()
+    
+    mpns = df[mpn_col]
+    frame = pd.DataFrame({
+        'mpn': mpns.astype(str).str.strip(),
+        'name': text_column(name_col),
+        'description': text_column(desc_col),
+    }, index=df.index)
+    frame = frame[mpns.notna() & (frame['mpn'] != '')]
+    if frame.empty:
+        empty = pd.DataFrame(columns=columns)
+        return empty if as_frame else []
+    
+    # 规范化只需对不同的写法各做一次
+    unique_mpns = frame['mpn'].unique()
+    canonical_map = dict(zip(unique_mpns, map(canonicalize_mpn, unique_mpns)))
+    frame['canonical_mpn'] = frame['mpn'].map(canonical_map)
+    
+    # 按首次出现的顺序为每个规范型号编号，再按编号把写法分组
+    codes, canonical_keys = pd.factorize(frame['canonical_mpn'])
+    components = frame.drop_duplicates('canonical_mpn').set_index('canonical_mpn')
+    # 名称、描述取组内第一个非空值
+    for field in ('name', 'description'):
+        components[field] = frame[field].where(frame[field] != '').groupby(codes).first() \
+            .reindex(range(len(canonical_keys))).fillna('').to_numpy()
+    distinct = frame.drop_duplicates('mpn')
+    components['aliases'] = _group_values(
+        canonical_keys.get_indexer(distinct['canonical_mpn']), distinct['mpn'].to_numpy(), len(canonical_keys))
+    # 每种写法自己的名称、描述（与 distinct 的行一一对应），只需对不同的写法各整理一次
+    alias_names, alias_descriptions = (
+        frame[field].where(frame[field] != '').groupby(frame['mpn'], sort=False).first()
+        .reindex(distinct['mpn']).fillna('').tolist()
+        for field in ('name', 'description')
+    )
+    distinct_info = {
+        alias: {'name': name, 'description': description}
+        for alias, name, description in zip(distinct['mpn'].tolist(), alias_names, alias_descriptions)
+    }
+    components['alias_info'] = [{alias: distinct_info[alias] for alias in aliases} for aliases in components['aliases']]
+    components = components.reset_index()[columns]
+    
+    if as_frame:
+        return components
+    return components.to_dict('records')
+
+def _group_values(codes, values, group_count):
+    """按分组编号把 values 切分为各组的列表（组内保持原顺序）"""
+    order = np.argsort(codes, kind='stable')
+    boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+    groups = [chunk.tolist() for chunk in np.split(values[order], boundaries)]
+    return groups if len(groups) == group_count else groups + [[]] * (group_count - len(groups))
+
+def process_bom_file(uploaded_file, as_frame=False):
+    """处理上传的BOM文件并返回元器件列表
+    
+    Args:
+        uploaded_file: 上传的 BOM 文件
+        as_frame: 为 True 时以 DataFrame 形式返回元器件（每行一个元器件，列同字典的键）
         
-        # 如果没有找到任何列，使用前几列
-        if not mpn_col and len(df.columns) >= 1:
-            mpn_col = df.columns[0]
-        if not name_col and len(df.columns) >= 2:
-            name_col = df.columns[1]
-        if not desc_col and len(df.columns) >= 3:
-            desc_col = df.columns[2]
+    Returns:
+        (元器件列表或 DataFrame, 识别的列名信息)
+    """
+    try:
+        # 直接从内存解析（与文件预览共用缓存）
+        df = read_bom_dataframe(uploaded_file)
         
-        # 从DataFrame中提取元器件列表
-        for _, row in df.iterrows():
-            component = {}
-            
-            # 提取型号信息
-            if mpn_col and pd.notna(row.get(mpn_col)):
-                component['mpn'] = str(row.get(mpn_col)).strip()
-            else:
-                continue  # 如果没有型号，则跳过该行
-                
-            # 提取名称信息
-            if name_col and pd.notna(row.get(name_col)):
-                component['name'] = str(row.get(name_col)).strip()
-            else:
-                component['name'] = ''
-                
-            # 提取描述信息
-            if desc_col and pd.notna(row.get(desc_col)):
-                component['description'] = str(row.get(desc_col)).strip()
-            else:
-                component['description'] = ''
-                
-            # 仅添加有型号的元器件
-            if component.get('mpn'):
-                component_list.append(component)
+        # 尝试识别关键列：型号列、名称列、描述列
+        mpn_col, name_col, desc_col = detect_bom_columns(df)
         
-        # 去重，通常BOM表中会有重复的元器件
-        unique_components = []
-        seen_mpns = set()
-        for comp in component_list:
-            mpn = comp['mpn']
-            if mpn not in seen_mpns:
-                seen_mpns.add(mpn)
-                unique_components.append(comp)
+        # 从DataFrame中提取元器件列表，并按规范型号去重
+        unique_components = extract_bom_components(df, mpn_col, name_col, desc_col, as_frame=as_frame)
         
         # 返回元器件列表和识别的列名
         columns_info = {
@@ -1019,82 +1801,236 @@ def process_bom_file(uploaded_file):
         return unique_components, columns_info
             
     except Exception as e:
-        st.error(f"处理BOM文件时出错: {e}")
+        event_log.error(f"处理BOM文件时出错: {e}")
         if "Missing optional dependency 'xlrd'" in str(e):
-            st.info("正在尝试安装xlrd依赖...")
+            event_log.info("正在尝试安装xlrd依赖...")
             try:
                 subprocess.check_call([sys.executable, "-m", "pip", "install", "xlrd>=2.0.1"])
-                st.success("xlrd安装成功，请重新上传文件")
+                event_log.success("xlrd安装成功，请重新上传文件")
             except Exception as install_error:
-                st.error(f"自动安装xlrd失败: {install_error}")
-                st.info("请手动运行: pip install xlrd>=2.0.1")
+                event_log.error(f"自动安装xlrd失败: {install_error}，请手动运行: pip install xlrd>=2.0.1")
         if "Missing optional dependency 'openpyxl'" in str(e):
-            st.info("正在尝试安装openpyxl依赖...")
+            event_log.info("正在尝试安装openpyxl依赖...")
             try:
                 subprocess.check_call([sys.executable, "-m", "pip", "install", "openpyxl"])
-                st.success("openpyxl安装成功，请重新上传文件")
+                event_log.success("openpyxl安装成功，请重新上传文件")
             except Exception as install_error:
-                st.error(f"自动安装openpyxl失败: {install_error}")
-                st.info("请手动运行: pip install openpyxl")
-        return [], {}
+                event_log.error(f"自动安装openpyxl失败: {install_error}，请手动运行: pip install openpyxl")
+        return (pd.DataFrame() if as_frame else []), {}
+
+# 流式读取 BOM 时每批处理的行数，以及超过该大小的文件在界面上自动改用流式读取
+BOM_STREAM_CHUNK_ROWS = int(os.getenv("BOM_STREAM_CHUNK_ROWS", "5000"))
+BOM_STREAM_THRESHOLD_BYTES = int(os.getenv("BOM_STREAM_THRESHOLD_BYTES", str(20 * 1024 * 1024)))
+
+def iter_bom_chunks(uploaded_file, chunk_rows=None):
+    """按批读取 BOM 表格，每次产生一个不超过 chunk_rows 行的 DataFrame
+    
+    CSV 使用 pandas 直接从文件对象分块读取（各列按文本读取，与 read_bom_dataframe 一致），
+    .xlsx 使用 openpyxl 的 read_only 模式逐行读取，内存占用只与批大小有关。.xls 格式不支持逐行读取，仍整体解析后再分批。
+    各批 DataFrame 的行索引在整个文件中连续。
+    """
+    chunk_rows = max(1, chunk_rows or BOM_STREAM_CHUNK_ROWS)
+    check_and_install_dependencies()
+    file_ext = os.path.splitext(uploaded_file.name)[1].lower()
+    
+    if file_ext == '.csv':
+        # 直接从文件对象分块读取，不复制整个文件；各列按文本读取，
+        # 否则每块各自推断类型，同一型号可能在一块中是 "12345.0"、另一块中是 "12345"
+        uploaded_file.seek(0)
+        yield from pd.read_csv(uploaded_file, chunksize=chunk_rows, dtype=str)
+    elif file_ext == '.xlsx':
+        yield from _iter_xlsx_chunks(uploaded_file.getvalue(), chunk_rows)
+    elif file_ext == '.xls':
+        df = read_bom_dataframe(uploaded_file)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+    else:
+        raise ValueError(f"不支持的文件格式: {file_ext}")
+
+def _iter_xlsx_chunks(content, chunk_rows):
+    """以 read_only 模式逐行读取 .xlsx 的第一个工作表"""
+    import openpyxl
+    
+    workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        # 与 pandas 一致，空表头命名为 "Unnamed: n"
+        columns = [str(value) if value is not None else f"Unnamed: {i}" for i, value in enumerate(header)]
+        offset = 0
+        batch = []
+        for row in rows:
+            if not any(value is not None for value in row):
+                continue
+            batch.append(row[:len(columns)])
+            if len(batch) >= chunk_rows:
+                yield pd.DataFrame(batch, columns=columns, index=range(offset, offset + len(batch)))
+                offset += len(batch)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns, index=range(offset, offset + len(batch)))
     finally:
-        # 删除临时文件
-        if os.path.exists(tmp_filepath):
-            os.unlink(tmp_filepath)
+        workbook.close()
 
-def batch_get_alternative_parts(component_list, progress_callback=None):
-    """批量获取替代元器件方案
+def read_bom_head(uploaded_file, nrows=200):
+    """只读取 BOM 文件开头的若干行，用于大文件预览"""
+    chunk = next(iter_bom_chunks(uploaded_file, chunk_rows=nrows), None)
+    return chunk if chunk is not None else pd.DataFrame()
+
+def iter_bom_components(uploaded_file, chunk_rows=None):
+    """流式处理BOM文件，逐批产生元器件
+    
+    列识别只使用第一批数据，之后按批提取元器件，并在整个文件范围内按规范型号去重。
+    元器件在首次出现时立即产生；后续批次中的其他写法会追加到已产生的
+    元器件字典的 aliases/alias_info 中，批量查询结束时 expand_alias_results 据此分发结果。
     
     Args:
-        component_list: 包含元器件信息的列表
-        progress_callback: 进度回调函数
+        uploaded_file: 上传的 BOM 文件
+        chunk_rows: 每批读取的行数，默认读取环境变量 BOM_STREAM_CHUNK_ROWS
         
     Returns:
-        批量查询结果字典
+        (元器件生成器, 识别的列名信息)
     """
-    # 初始化结果字典
-    results = {}
-    total = len(component_list)
+    chunks = iter_bom_chunks(uploaded_file, chunk_rows)
+    first = next(chunks, None)
+    if first is None:
+        return iter(()), {}
     
-    error_count = 0
-    success_count = 0
+    mpn_col, name_col, desc_col = detect_bom_columns(first)
+    columns_info = {
+        'mpn_column': mpn_col,
+        'name_column': name_col,
+        'description_column': desc_col
+    }
+    return _iter_unique_components(itertools.chain([first], chunks), mpn_col, name_col, desc_col), columns_info
+
+def _iter_unique_components(chunks, mpn_col, name_col, desc_col):
+    seen = {}
+    for chunk in chunks:
+        for component in extract_bom_components(chunk, mpn_col, name_col, desc_col):
+            existing = seen.get(component['canonical_mpn'])
+            if existing is None:
+                seen[component['canonical_mpn']] = component
+                yield component
+                continue
+            for alias in component['aliases']:
+                if alias not in existing['aliases']:
+                    existing['aliases'].append(alias)
+            for alias, info in component['alias_info'].items():
+                existing_info = existing['alias_info'].setdefault(alias, info)
+                for field, value in info.items():
+                    if not existing_info.get(field) and value:
+                        existing_info[field] = value
+            if not existing['name'] and component['name']:
+                existing['name'] = component['name']
+            if not existing['description'] and component['description']:
+                existing['description'] = component['description']
+
+def _make_executor(max_workers, thread_name_prefix="bom-worker"):
+    """创建线程池，工作线程继承当前 Streamlit 会话上下文，保证线程内的 st 调用和 session_state 可用
     
-    # 设置最大重试次数
-    max_retries = 3
+    后台任务线程没有会话，工作线程改为继承任务绑定的事件日志和测试数据设置。
+    """
+    ctx = get_script_run_ctx(suppress_warning=True)
+    log_binding = event_log.current_binding()
+    use_dummy_data = getattr(_thread_settings, "use_dummy_data", None)
     
-    # 遍历每个元器件
-    for idx, component in enumerate(component_list):
-        mpn = component.get('mpn', '')
-        name = component.get('name', '')
-        description = component.get('description', '')
+    def initializer():
+        if ctx is not None:
+            add_script_run_ctx(None, ctx)
+        event_log.set_binding(log_binding)
+        _thread_settings.use_dummy_data = use_dummy_data
+    
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix, initializer=initializer)
+
+def _process_component(component, max_retries=3):
+    """查询单个BOM元器件的替代方案，所有异常都在内部处理，保证单个元器件失败不影响整批
+    
+    Returns:
+        (mpn, 结果字典, 是否成功)
+    """
+    mpn = component.get('mpn', '')
+    name = component.get('name', '')
+    description = component.get('description', '')
+    
+    try:
+        alternatives = []
         
-        # 更新进度
-        progress = (idx + 1) / total
-        if progress_callback:
-            progress_callback(progress, f"处理第 {idx+1}/{total} 个元器件: {mpn}")
+        for attempt in range(max_retries):
+            try:
+                # 将提示信息移到侧边栏
+                event_log.debug(f"元器件 {mpn} 第 {attempt+1} 次查询中...")
+                alternatives = get_alternatives_direct(mpn, name, description)
+                if alternatives:  # 如果获取到结果，跳出重试循环
+                    event_log.success(f"元器件 {mpn} 查询成功，找到 {len(alternatives)} 个替代方案")
+                    break
+                else:
+                    event_log.warning(f"元器件 {mpn} 第 {attempt+1} 次查询未返回结果，将重试...")
+            except Exception as retry_error:
+                event_log.warning(f"元器件 {mpn} 第 {attempt+1} 次查询失败: {str(retry_error)}")
+                if attempt == max_retries - 1:  # 最后一次尝试失败
+                    raise  # 重新抛出异常给外层处理
         
-        try:
-            alternatives = []
-            
-            for attempt in range(max_retries):
-                try:
-                    # 将提示信息移到侧边栏
-                    st.sidebar.info(f"元器件 {mpn} 第 {attempt+1} 次查询中...")
-                    alternatives = get_alternatives_direct(mpn, name, description)
-                    if alternatives:  # 如果获取到结果，跳出重试循环
-                        st.sidebar.success(f"元器件 {mpn} 查询成功，找到 {len(alternatives)} 个替代方案")
-                        break
-                    else:
-                        st.sidebar.warning(f"元器件 {mpn} 第 {attempt+1} 次查询未返回结果，将重试...")
-                except Exception as retry_error:
-                    st.sidebar.warning(f"元器件 {mpn} 第 {attempt+1} 次查询失败: {str(retry_error)}")
-                    if attempt == max_retries - 1:  # 最后一次尝试失败
-                        raise  # 重新抛出异常给外层处理
-            
-            # 如果所有尝试都失败但启用了测试数据选项
-            if not alternatives and st.session_state.get("use_dummy_data", False):
-                st.sidebar.info(f"元器件 {mpn} 查询失败，使用测试数据")
-                alternatives = [
+        # 如果所有尝试都失败但启用了测试数据选项
+        if not alternatives and _use_dummy_data():
+            event_log.info(f"元器件 {mpn} 查询失败，使用测试数据")
+            alternatives = [
+                {
+                    "model": f"{mpn}_替代1",
+                    "brand": "测试品牌",
+                    "category": "测试类别",
+                    "package": "测试封装",
+                    "parameters": "测试参数数据",
+                    "type": "国产",
+                    "price": "¥8-¥15",
+                    "status": "量产中",
+                    "leadTime": "4-6周",
+                    "pinToPin": True,
+                    "compatibility": "完全兼容",
+                    "datasheet": "https://www.example.com/datasheet"
+                },
+                {
+                    "model": f"{mpn}_替代2",
+                    "brand": "测试品牌2",
+                    "category": "测试类别",
+                    "package": "测试封装",
+                    "parameters": "测试参数数据",
+                    "type": "进口",
+                    "price": "$1.5-$3.0",
+                    "status": "量产中",
+                    "leadTime": "6-8周",
+                    "pinToPin": False,
+                    "compatibility": "需要修改PCB",
+                    "datasheet": "https://www.example.com/datasheet"
+                }
+            ]
+        
+        # 验证每个替代方案是否包含必要字段
+        validated_alternatives = []
+        for alt in alternatives:
+            if isinstance(alt, dict):
+                # 确保所有必要字段存在
+                if "datasheet" not in alt or not alt["datasheet"]:
+                    alt["datasheet"] = "https://www.example.com/datasheet"
+                validated_alternatives.append(alt)
+        
+        return mpn, {
+            'alternatives': validated_alternatives,
+            'name': name,
+            'description': description
+        }, bool(validated_alternatives)
+        
+    except Exception as e:
+        # 捕获每个元器件的处理错误，避免一个错误导致整个批处理失败
+        event_log.error(f"处理元器件 {mpn} 时出错: {e}")
+        
+        # 使用测试数据
+        if _use_dummy_data(True):  # 默认启用测试数据
+            event_log.info(f"元器件 {mpn} 处理出错，使用测试数据")
+            return mpn, {
+                'alternatives': [
                     {
                         "model": f"{mpn}_替代1",
                         "brand": "测试品牌",
@@ -1108,90 +2044,490 @@ def batch_get_alternative_parts(component_list, progress_callback=None):
                         "pinToPin": True,
                         "compatibility": "完全兼容",
                         "datasheet": "https://www.example.com/datasheet"
-                    },
-                    {
-                        "model": f"{mpn}_替代2",
-                        "brand": "测试品牌2",
-                        "category": "测试类别",
-                        "package": "测试封装",
-                        "parameters": "测试参数数据",
-                        "type": "进口",
-                        "price": "$1.5-$3.0",
-                        "status": "量产中",
-                        "leadTime": "6-8周",
-                        "pinToPin": False,
-                        "compatibility": "需要修改PCB",
-                        "datasheet": "https://www.example.com/datasheet"
                     }
-                ]
-            
-            # 验证每个替代方案是否包含必要字段
-            validated_alternatives = []
-            for alt in alternatives:
-                if isinstance(alt, dict):
-                    # 确保所有必要字段存在
-                    if "datasheet" not in alt or not alt["datasheet"]:
-                        alt["datasheet"] = "https://www.example.com/datasheet"
-                    validated_alternatives.append(alt)
-            
-            # 更新统计
-            if validated_alternatives:
-                success_count += 1
-            else:
-                error_count += 1
-                
-            results[mpn] = {
-                'alternatives': validated_alternatives,
+                ],
                 'name': name,
                 'description': description
-            }
-            
-        except Exception as e:
-            # 捕获每个元器件的处理错误，避免一个错误导致整个批处理失败
-            error_count += 1
-            st.error(f"处理元器件 {mpn} 时出错: {e}")
-            
-            # 使用测试数据
-            if st.session_state.get("use_dummy_data", True):  # 默认启用测试数据
-                st.info(f"元器件 {mpn} 处理出错，使用测试数据")
-                results[mpn] = {
-                    'alternatives': [
-                        {
-                            "model": f"{mpn}_替代1",
-                            "brand": "测试品牌",
-                            "category": "测试类别",
-                            "package": "测试封装",
-                            "parameters": "测试参数数据",
-                            "type": "国产",
-                            "price": "¥8-¥15",
-                            "status": "量产中",
-                            "leadTime": "4-6周",
-                            "pinToPin": True,
-                            "compatibility": "完全兼容",
-                            "datasheet": "https://www.example.com/datasheet"
-                        }
-                    ],
-                    'name': name,
-                    'description': description
-                }
+            }, False
+        return mpn, {
+            'alternatives': [],
+            'name': name,
+            'description': description,
+            'error': str(e)
+        }, False
+
+def _process_component_group(components):
+    """用一次 DeepSeek 请求查询一组元器件
+    
+    批量响应中缺失的元器件（如响应被截断）再合并为一个更小的批量请求；
+    整个批量请求失败或模型未给出替代方案的元器件回退为逐个查询。
+    
+    Returns:
+        与输入顺序一致的 [(mpn, 结果字典, 是否成功), ...]
+    """
+    if len(components) == 1:
+        return [_process_component(components[0])]
+    
+    try:
+        batch_alternatives = get_alternatives_batch(components)
+    except Exception as e:
+        event_log.warning(f"批量提示词查询失败，改为逐个查询: {e}")
+        batch_alternatives = {}
+    
+    missing = [c for c in components if c.get('mpn', '') not in batch_alternatives]
+    # 只有部分结果缺失时才再次批量查询，保证每次递归的元器件数都在减少
+    requeried = {}
+    if 1 < len(missing) < len(components):
+        requeried = {mpn: (result, ok) for mpn, result, ok in _process_component_group(missing)}
+    
+    outcomes = []
+    for component in components:
+        mpn = component.get('mpn', '')
+        alternatives = batch_alternatives.get(mpn)
+        if alternatives:
+            outcomes.append((mpn, {
+                'alternatives': alternatives,
+                'name': component.get('name', ''),
+                'description': component.get('description', '')
+            }, True))
+        elif mpn in requeried:
+            outcomes.append((mpn, *requeried[mpn]))
+        else:
+            outcomes.append(_process_component(component))
+    return outcomes
+
+def _plan_work_units(indexed_components, prompt_batch_size):
+    """将 [(序号, 元器件字典), ...] 划分为并发执行的工作单元，每个单元为 [(序号, 元器件字典), ...]"""
+    indexed_components = list(indexed_components)
+    if prompt_batch_size <= 1:
+        return [[item] for item in indexed_components]
+    
+    # 已有缓存的元器件单独成组，直接命中缓存，不占用批量请求的名额
+    cached_units = []
+    pending = []
+    for idx, component in indexed_components:
+        if result_cache.contains("direct", component.get('mpn', '')):
+            cached_units.append([(idx, component)])
+        else:
+            pending.append((idx, component))
+    return cached_units + _plan_prompt_batches(pending, prompt_batch_size)
+
+def _iter_work_units(indexed_components, prompt_batch_size):
+    """逐个读取 (序号, 元器件字典) 并划分工作单元，适用于长度未知的元器件生成器
+    
+    与 _plan_work_units 的划分规则相同，但只缓冲一个批量请求所需的元器件。
+    """
+    pending = []
+    for idx, component in indexed_components:
+        if prompt_batch_size <= 1 or result_cache.contains("direct", component.get('mpn', '')):
+            yield [(idx, component)]
+            continue
+        pending.append((idx, component))
+        if len(pending) >= prompt_batch_size:
+            yield from _plan_prompt_batches(pending, prompt_batch_size)
+            pending = []
+    if pending:
+        yield from _plan_prompt_batches(pending, prompt_batch_size)
+
+def batch_get_alternative_parts(component_list, progress_callback=None, max_workers=None, prompt_batch_size=None,
+                                nexar_enrich=None, total=None, checkpoint=None):
+    """批量获取替代元器件方案
+    
+    多个元器件并发查询，返回结果的顺序与输入顺序保持一致。
+    component_list 也可以是元器件生成器（如 iter_bom_components 的返回值），
+    此时边读取边提交，同时在途的工作单元不超过并发数的两倍，内存占用与文件大小无关。
+    
+    Args:
+        component_list: 包含元器件信息的列表或可迭代对象
+        progress_callback: 进度回调函数，参数为 (进度, 说明文字)；总数未知时进度为 None
+        max_workers: 最大并发数，默认读取环境变量 BATCH_MAX_WORKERS
+        prompt_batch_size: 每次 DeepSeek 请求最多查询的元器件数，默认读取环境变量 BATCH_PROMPT_MAX_PARTS
+        nexar_enrich: 是否附加 Nexar 替代元器件数据（结果中的 nexar_alternatives 字段），
+            默认读取环境变量 BATCH_NEXAR_ENRICH
+        total: 元器件总数，传入列表时默认为列表长度，用于计算进度
+        checkpoint: 断点（BatchCheckpoint），已记录的元器件直接使用记录的结果，
+            新完成的元器件立即写入断点，中断后再次运行时从断点继续
+        
+    Returns:
+        批量查询结果字典
+    """
+    is_list = isinstance(component_list, (list, tuple))
+    if is_list and total is None:
+        total = len(component_list)
+    max_workers = max(1, max_workers or BATCH_MAX_WORKERS)
+    prompt_batch_size = prompt_batch_size or BATCH_PROMPT_MAX_PARTS
+    
+    # 按输入序号保存每个元器件的结果，保证输出顺序稳定
+    outcomes = {}
+    components_seen = []
+    restored_count = 0
+    
+    def pending_components():
+        """产生尚未完成的 (序号, 元器件)，断点中已有结果的元器件直接记入 outcomes"""
+        nonlocal restored_count
+        for idx, component in enumerate(component_list):
+            if not is_list:
+                components_seen.append(component)
+            mpn = component.get('mpn', '')
+            saved = checkpoint.get(mpn) if checkpoint is not None else None
+            if saved is None:
+                yield idx, component
             else:
-                results[mpn] = {
-                    'alternatives': [],
-                    'name': name,
-                    'description': description,
-                    'error': str(e)
-                }
+                outcomes[idx] = (mpn, saved[0], saved[1])
+                restored_count += 1
+    
+    if is_list:
+        work_units = iter(_plan_work_units(pending_components(), prompt_batch_size))
+        components_seen = component_list
+    else:
+        work_units = _iter_work_units(pending_components(), prompt_batch_size)
+    
+    if nexar_enrich is None:
+        nexar_enrich = BATCH_NEXAR_ENRICH
+    nexar_futures = []
+    # 同时在途的工作单元上限，避免一次性把整个生成器读入内存
+    window = max_workers * 2
+    
+    with _make_executor(max_workers) as executor:
+        if nexar_enrich and is_list:
+            # Nexar 批量查询与 DeepSeek 查询并行进行
+            nexar_futures.append(executor.submit(
+                get_nexar_alternatives_bulk, [component.get('mpn', '') for component in component_list]
+            ))
+        
+        futures = {}
+        
+        def submit_next():
+            unit = next(work_units, None)
+            if unit is None:
+                return False
+            unit_components = [component for _, component in unit]
+            if not is_list:
+                if nexar_enrich:
+                    nexar_futures.append(executor.submit(
+                        get_nexar_alternatives_bulk, [component.get('mpn', '') for component in unit_components]
+                    ))
+            futures[executor.submit(_process_component_group, unit_components)] = unit
+            return True
+        
+        reported_restored = 0
+        
+        def report_restored():
+            """断点恢复的元器件在读取时计入进度，全部从断点恢复时进度条也能走完"""
+            nonlocal reported_restored
+            if restored_count == reported_restored:
+                return
+            reported_restored = restored_count
+            if progress_callback:
+                completed = len(outcomes)
+                if total:
+                    progress_callback(min(completed / total, 1.0), f"已从断点恢复 {restored_count}/{total} 个元器件")
+                else:
+                    progress_callback(None, f"已从断点恢复 {restored_count} 个元器件")
+        
+        while len(futures) < window and submit_next():
+            pass
+        report_restored()
+        if is_list and restored_count:
+            # 列表输入在划分工作单元时已读完断点
+            event_log.info(f"{restored_count} 个元器件的结果从断点恢复，不再重复查询")
+        
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit = futures.pop(future)
+                try:
+                    unit_outcomes = future.result()
+                except Exception as e:
+                    # _process_component_group 内部已处理异常，这里只是兜底
+                    unit_outcomes = [(component.get('mpn', ''), {
+                        'alternatives': [],
+                        'name': component.get('name', ''),
+                        'description': component.get('description', ''),
+                        'error': str(e)
+                    }, False) for _, component in unit]
+                
+                for (idx, _), outcome in zip(unit, unit_outcomes):
+                    outcomes[idx] = outcome
+                    if checkpoint is not None:
+                        checkpoint.record(*outcome)
+                    
+                    # 更新进度（包括从断点恢复的元器件）
+                    completed = len(outcomes)
+                    if progress_callback:
+                        if total:
+                            progress_callback(min(completed / total, 1.0), f"已完成 {completed}/{total} 个元器件: {outcome[0]}")
+                        else:
+                            progress_callback(None, f"已完成 {completed} 个元器件: {outcome[0]}")
+            
+            while len(futures) < window and submit_next():
+                pass
+            report_restored()
+    
+    # 初始化结果字典
+    results = {}
+    for idx in sorted(outcomes):
+        mpn, result, _ = outcomes[idx]
+        results[mpn] = result
+    
+    if nexar_futures:
+        nexar_results = {}
+        for nexar_future in nexar_futures:
+            try:
+                nexar_results.update(nexar_future.result())
+            except Exception as e:
+                event_log.warning(f"Nexar 批量查询失败: {e}")
+        for mpn, result in results.items():
+            result['nexar_alternatives'] = nexar_results.get(mpn, [])
+    
+    # 同一器件的其他写法共享查询结果
+    results = expand_alias_results(results, components_seen)
     
     # 在结束时显示批处理统计信息
+    total = len(outcomes)
+    success_count = sum(1 for _, _, ok in outcomes.values() if ok)
+    error_count = total - success_count
+    if restored_count and not is_list:
+        event_log.info(f"其中 {restored_count} 个元器件的结果从断点恢复，未重复查询")
     if error_count > 0:
-        st.sidebar.warning(f"批量处理完成。共 {total} 个元器件，成功 {success_count} 个，失败 {error_count} 个。")
+        event_log.warning(f"批量处理完成。共 {total} 个元器件，成功 {success_count} 个，失败 {error_count} 个。")
     else:
-        st.sidebar.success(f"批量处理完成。成功处理所有 {total} 个元器件。")
+        event_log.success(f"批量处理完成。成功处理所有 {total} 个元器件。")
+    
+    return results
+
+def run_bom_batch(uploaded_file, progress_callback=None, max_workers=None, checkpoint=None, use_dummy_data=None):
+    """读取整个 BOM 文件并批量查询替代方案
+
+    超过 BOM_STREAM_THRESHOLD_BYTES 的文件边读取边查询。该函数不依赖页面组件，
+    可在后台任务线程中运行，识别信息通过事件日志和进度回调报告。
+
+    Args:
+        uploaded_file: BOM 文件对象（需提供 name、size 和 getvalue()）
+        progress_callback: 进度回调函数，参数为 (进度, 说明文字)
+        max_workers: 最大并发数，默认读取环境变量 BATCH_MAX_WORKERS
+        checkpoint: 断点（BatchCheckpoint），见 batch_get_alternative_parts
+        use_dummy_data: 查询失败时是否使用测试数据；为 None 时沿用当前会话的设置
+            （后台任务传入提交任务时会话的设置）
+
+    Returns:
+        (批量查询结果字典, 识别的列名信息)；未识别出元器件时结果为空字典
+    """
+    previous = getattr(_thread_settings, "use_dummy_data", None)
+    if use_dummy_data is not None:
+        _thread_settings.use_dummy_data = use_dummy_data
+    try:
+        if uploaded_file.size > BOM_STREAM_THRESHOLD_BYTES:
+            components, columns_info = iter_bom_components(uploaded_file)
+            first_component = next(components, None)
+            if first_component is None:
+                return {}, columns_info
+            components = itertools.chain([first_component], components)
+            summary = "文件较大，将边读取边查询"
+        else:
+            components, columns_info = process_bom_file(uploaded_file)
+            if not components:
+                return {}, columns_info
+            summary = f"已识别 {len(components)} 个不同的元器件"
+            alias_count = sum(len(component.get('aliases', [])) - 1 for component in components)
+            if alias_count:
+                summary += f"，另有 {alias_count} 个型号写法与已识别器件相同（大小写、全角或包装后缀不同），将共享查询结果"
+
+        event_log.info(summary)
+        event_log.success(f"识别到的关键列: 型号列({columns_info.get('mpn_column', '未识别')}), "
+                          f"名称列({columns_info.get('name_column', '未识别')}), "
+                          f"描述列({columns_info.get('description_column', '未识别')})")
+        if progress_callback:
+            progress_callback(0.0, summary)
+
+        results = batch_get_alternative_parts(components, progress_callback, max_workers=max_workers, checkpoint=checkpoint)
+        return results, columns_info
+    finally:
+        _thread_settings.use_dummy_data = previous
+
+def _estimate_tokens(text):
+    """粗略估算文本的 token 数：中文字符约 1 个 token，其他字符约 4 个字符 1 个 token"""
+    cjk_count = sum(1 for ch in text if '\u3000' <= ch <= '\u9fff' or '\uff00' <= ch <= '\uffef')
+    return cjk_count + (len(text) - cjk_count) // 4 + 1
+
+def _format_component_for_prompt(component):
+    """将单个元器件格式化为批量提示词中的一行，描述过长时截断"""
+    line = f"- 型号: {component.get('mpn', '')}"
+    if component.get('name'):
+        line += f"; 名称: {component['name']}"
+    if component.get('description'):
+        line += f"; 描述: {str(component['description'])[:200]}"
+    return line
+
+BATCH_PROMPT_TEMPLATE = """
+    任务：你是一个专业的电子元器件顾问，专精于国产替代方案。请分别为下面列出的每一个元器件推荐详细的替代产品。
+    
+    输入元器件列表：
+{components}
+    
+    对每个元器件的要求：
+    1. 必须推荐至少一种中国大陆本土品牌的替代方案（如 GigaDevice/兆易创新、WCH/沁恒、复旦微电子、中颖电子、圣邦微电子等）
+    2. 如果能找到多种中国大陆本土品牌的替代产品，优先推荐这些产品，推荐的国产方案数量越多越好
+    3. 如果实在找不到足够三种中国大陆本土品牌的产品，可以推荐国外品牌产品作为补充，但必须明确标注
+    4. 每个元器件推荐 3 种性能相近的替代型号
+    5. 提供每种型号的品牌名称、封装信息和元器件类目（例如：MCU、DCDC、LDO、传感器等）
+    6. 根据元器件类型提供不同的关键参数：
+       - 若是MCU/单片机：提供CPU内核、主频、程序存储容量、RAM大小、IO数量
+       - 若是DCDC：提供输入电压范围、输出电压、最大输出电流、效率
+       - 若是LDO：提供输入电压范围、输出电压、最大输出电流、压差
+       - 若是存储器：提供容量、接口类型、读写速度
+       - 若是传感器：提供测量范围、精度、接口类型
+       - 其他类型提供对应的关键参数
+    7. 在每个推荐方案中明确标注是"国产"还是"进口"产品
+    8. 提供产品官网链接（若无真实链接，可提供示例链接）
+    9. 推荐的型号不能与对应的输入型号相同
+    10. 必须提供价格估算，价格必须包含货币符号：
+       - 对于人民币价格，必须使用"¥"符号（例如：¥10-¥15）
+       - 对于美元价格，必须使用"$"符号（例如：$1.5-$2.0）
+       - 请估算常见采购渠道的批量价格范围
+    11. 必须严格返回一个 JSON 对象，键为输入列表中的元器件型号（与输入完全一致），值为该元器件的替代方案数组，不允许添加额外说明或Markdown格式：
+    {{
+        "输入型号1": [
+            {{"model": "详细型号1", "brand": "品牌名称1", "category": "类别1", "package": "封装1", "parameters": "详细参数1", "type": "国产/进口", "datasheet": "链接1", "price": "¥10-¥15"}},
+            {{"model": "详细型号2", "brand": "品牌名称2", "category": "类别2", "package": "封装2", "parameters": "详细参数2", "type": "国产/进口", "datasheet": "链接2", "price": "$1.5-$2.0"}}
+        ],
+        "输入型号2": [
+            {{"model": "详细型号3", "brand": "品牌名称3", "category": "类别3", "package": "封装3", "parameters": "详细参数3", "type": "国产/进口", "datasheet": "链接3", "price": "¥8-¥12"}}
+        ]
+    }}
+    12. 每个推荐项必须包含 "model"、"brand"、"category"、"package"、"parameters"、"type"、"datasheet"和"price"八个字段
+    13. 如果某个元器件无法找到合适的替代方案，其值为空数组：[]
+    """
+
+def _plan_prompt_batches(indexed_components, max_parts=None):
+    """根据 token 预算将元器件分组，每组用一次 DeepSeek 请求查询
+    
+    Args:
+        indexed_components: [(序号, 元器件字典), ...]
+        max_parts: 每组最多包含的元器件数
+        
+    Returns:
+        分组后的列表，每组为 [(序号, 元器件字典), ...]
+    """
+    max_parts = max_parts or BATCH_PROMPT_MAX_PARTS
+    # 输出 token 上限决定了一次请求最多能容纳多少个元器件的推荐结果
+    parts_by_output = max(1, BATCH_PROMPT_MAX_OUTPUT_TOKENS // BATCH_PROMPT_TOKENS_PER_PART)
+    limit = max(1, min(max_parts, parts_by_output))
+    instruction_tokens = _estimate_tokens(BATCH_PROMPT_TEMPLATE)
+    
+    batches = []
+    current = []
+    input_tokens = instruction_tokens
+    for idx, component in indexed_components:
+        tokens = _estimate_tokens(_format_component_for_prompt(component))
+        if current and (len(current) >= limit or input_tokens + tokens > BATCH_PROMPT_MAX_INPUT_TOKENS):
+            batches.append(current)
+            current = []
+            input_tokens = instruction_tokens
+        current.append((idx, component))
+        input_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def get_alternatives_batch(components):
+    """用一次 DeepSeek 请求查询多个元器件的替代方案
+    
+    Args:
+        components: 元器件字典列表（包含 mpn、name、description）
+        
+    Returns:
+        {mpn: 替代方案列表}，未能从响应中解析出结果的元器件不在字典中
+    """
+    component_lines = "\n".join(f"    {_format_component_for_prompt(c)}" for c in components)
+    prompt = BATCH_PROMPT_TEMPLATE.format(components=component_lines)
+    max_tokens = min(BATCH_PROMPT_MAX_OUTPUT_TOKENS, BATCH_PROMPT_TOKENS_PER_PART * len(components) + 200)
+    
+    response = get_deepseek_client().chat.completions.create(
+        model=DEEPSEEK_MODEL,
+        messages=[
+            {"role": "system", "content": EXPERT_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=False,
+        max_tokens=max_tokens,
+        timeout=DEEPSEEK_TIMEOUT * BATCH_PROMPT_TIMEOUT_FACTOR
+    )
+    raw_content = response.choices[0].message.content
+    
+    parsed = _extract_json_object(raw_content)
+    # 模型返回的键可能在大小写或空白上与输入不同，按规范化型号匹配
+    parsed_by_key = {normalize_mpn(key): value for key, value in parsed.items()}
+    wanted = {normalize_mpn(c.get('mpn', '')) for c in components}
+    if not wanted <= parsed_by_key.keys():
+        # 响应被截断（如达到 max_tokens）时最外层对象不完整，保留已完整输出的型号，缺失的部分由调用方重新查询
+        for key, value in _salvage_keyed_arrays(raw_content).items():
+            parsed_by_key.setdefault(normalize_mpn(key), value)
+        found = len(wanted & parsed_by_key.keys())
+        event_log.warning(f"批量响应不完整，已解析 {found}/{len(wanted)} 个元器件的结果，其余重新查询")
     
+    results = {}
+    for component in components:
+        mpn = component.get('mpn', '')
+        recommendations = parsed_by_key.get(normalize_mpn(mpn))
+        if not isinstance(recommendations, list):
+            continue
+        validated_recommendations = _validate_direct_recommendations(recommendations, mpn)[:3]
+        if validated_recommendations:
+            result_cache.set("direct", mpn, validated_recommendations)
+        results[mpn] = validated_recommendations
     return results
 
+def _validate_direct_recommendations(recommendations, mpn):
+    """补全批量查询推荐结果的必要字段，并过滤掉与输入型号相同的推荐"""
+    validated_recommendations = []
+    for rec in recommendations:
+        if isinstance(rec, dict):
+            # 确保所有必要字段存在
+            rec["model"] = rec.get("model", "未知型号")
+            rec["brand"] = rec.get("brand", "未知品牌")
+            rec["category"] = rec.get("category", "未知类别")
+            rec["package"] = rec.get("package", "未知封装")
+            rec["parameters"] = rec.get("parameters", "参数未知")
+            rec["type"] = rec.get("type", "未知")
+            # 确保datasheet字段存在 - 这是前端显示必需的
+            if "datasheet" not in rec or not rec["datasheet"]:
+                rec["datasheet"] = "https://www.example.com/datasheet"
+            # 添加其他可能需要的字段
+            rec["status"] = rec.get("status", "未知")
+            rec["leadTime"] = rec.get("leadTime", "未知")
+            rec["pinToPin"] = rec.get("pinToPin", False)
+            rec["compatibility"] = rec.get("compatibility", "兼容性未知")
+            rec["price"] = rec.get("price", "未知")
+            
+            # 过滤掉与输入型号相同的推荐
+            if str(rec["model"]).lower() != mpn.lower():
+                # 后处理，识别国产方案
+                if rec["type"] == "未知" and is_domestic_brand(str(rec["model"])):
+                    rec["type"] = "国产"
+                validated_recommendations.append(rec)
+    return validated_recommendations
+
 def get_alternatives_direct(mpn, name="", description=""):
     """直接使用DeepSeek API查询元器件替代方案，不通过Nexar API"""
+    # 优先使用缓存结果
+    cached = result_cache.get("direct", mpn)
+    if cached is not None:
+        return cached[:3]
+
+    key = _flight_key("direct", mpn)
+    future, leader = inflight_queries.begin(key)
+    if not leader:
+        return _wait_for_flight(mpn, future, lambda: _query_alternatives_direct(mpn, name, description))
+
+    recommendations = []
+    try:
+        recommendations = _query_alternatives_direct(mpn, name, description)
+    finally:
+        inflight_queries.finish(key, result=recommendations)
+    return recommendations
+
+def _query_alternatives_direct(mpn, name="", description=""):
     # 构建更全面的查询信息
     query_context = f"元器件型号: {mpn}" + \
                    (f"\n元器件名称: {name}" if name else "") + \
@@ -1236,10 +2572,10 @@ def get_alternatives_direct(mpn, name="", description=""):
     
     try:
         # 调用DeepSeek API
-        response = deepseek_client.chat.completions.create(
-            model="deepseek-chat",
+        response = get_deepseek_client().chat.completions.create(
+            model=DEEPSEEK_MODEL,
             messages=[
-                {"role": "system", "content": "你是一个精通中国电子元器件行业的专家，擅长为各种元器件寻找合适的替代方案，尤其专注于中国大陆本土生产的国产元器件。始终以有效的JSON格式回复，不添加任何额外说明。"},
+                {"role": "system", "content": EXPERT_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
             stream=False,
@@ -1249,45 +2585,22 @@ def get_alternatives_direct(mpn, name="", description=""):
         raw_content = response.choices[0].message.content
         
         # 记录API返回的原始内容以便调试
-        with st.sidebar.expander(f"调试信息 - API原始响应 ({mpn})", expanded=False):
-            st.write(f"**原始响应内容:**")
-            st.code(raw_content, language="text")
+        event_log.debug(f"DeepSeek 原始响应 ({mpn})", payload=raw_content)
         
         # 使用简化版的extract_json_content处理API返回结果
         recommendations = extract_json_content(raw_content, "批量查询")
         
         # 确保所有必要字段都存在
-        validated_recommendations = []
-        for rec in recommendations:
-            if isinstance(rec, dict):
-                # 确保所有必要字段存在
-                rec["model"] = rec.get("model", "未知型号")
-                rec["brand"] = rec.get("brand", "未知品牌")
-                rec["category"] = rec.get("category", "未知类别")
-                rec["package"] = rec.get("package", "未知封装")
-                rec["parameters"] = rec.get("parameters", "参数未知")
-                rec["type"] = rec.get("type", "未知")
-                # 确保datasheet字段存在 - 这是前端显示必需的
-                if "datasheet" not in rec or not rec["datasheet"]:
-                    rec["datasheet"] = "https://www.example.com/datasheet"
-                # 添加其他可能需要的字段
-                rec["status"] = rec.get("status", "未知")
-                rec["leadTime"] = rec.get("leadTime", "未知")
-                rec["pinToPin"] = rec.get("pinToPin", False)
-                rec["compatibility"] = rec.get("compatibility", "兼容性未知")
-                rec["price"] = rec.get("price", "未知")
-                
-                # 过滤掉与输入型号相同的推荐
-                if rec["model"].lower() != mpn.lower():
-                    # 后处理，识别国产方案
-                    if rec["type"] == "未知" and is_domestic_brand(rec["model"]):
-                        rec["type"] = "国产"
-                    validated_recommendations.append(rec)
+        validated_recommendations = _validate_direct_recommendations(recommendations, mpn)
+
+        # 仅缓存真实的查询结果，不包含下面补充的测试数据
+        if validated_recommendations:
+            result_cache.set("direct", mpn, validated_recommendations[:3])
             
-        # 如果没有找到任何有效推荐或推荐数量不足
+        # 推荐数量不足时，仅在页面会话启用测试数据的情况下补充测试数据；
+        # 否则原样返回（可能为空），由调用方重试或记为失败
         if len(validated_recommendations) < 3:
-            # 创建测试数据以确保至少有一些结果
-            if st.session_state.get("use_dummy_data", False) or len(validated_recommendations) == 0:
+            if _use_dummy_data():
                 missing_count = 3 - len(validated_recommendations)
                 for i in range(missing_count):
                     validated_recommendations.append({
@@ -1309,13 +2622,12 @@ def get_alternatives_direct(mpn, name="", description=""):
         return validated_recommendations[:3]
         
     except Exception as e:
-        st.sidebar.error(f"DeepSeek API 查询失败: {e}")
         import traceback
-        st.sidebar.error(f"错误详情: {traceback.format_exc()}")
+        event_log.error(f"DeepSeek API 查询失败: {e}", payload=traceback.format_exc())
         
         # 返回测试数据以保证前端显示正常
-        if st.session_state.get("use_dummy_data", False):
-            st.sidebar.info(f"使用测试数据继续处理 {mpn}")
+        if _use_dummy_data():
+            event_log.info(f"使用测试数据继续处理 {mpn}")
             return [
                 {
                     "model": f"{mpn}_ALT1",
@@ -1348,23 +2660,8 @@ def get_alternatives_direct(mpn, name="", description=""):
             ]
         return []
 
-def chat_with_expert(user_input, history=None):
-    """
-    使用DeepSeek API实现与电子元器件专家的对话
-    
-    参数:
-        user_input (str): 用户的输入/问题
-        history (list): 对话历史记录，格式为[{"role": "user/assistant", "content": "消息内容"}, ...]
-    
-    返回:
-        str 或 Generator: 根据stream参数，返回完整回复或流式回复
-    """
-    if history is None:
-        history = []
-    
-    # 构建完整的消息历史
-    messages = [
-        {"role": "system", "content": """  
+# AI 选型助手的系统提示词；保持不变，使每轮请求的前缀一致
+CHAT_SYSTEM_PROMPT = """  
 您是一名电子元器件选型专家，请严格遵循以下流程：
 
 **处理流程**
@@ -1399,20 +2696,109 @@ def chat_with_expert(user_input, history=None):
   2) 国产方案参数达标但未被选择
   3) 成本敏感场景选用超规格器件
 - 优先推荐已验证的"芯片组"方案（如MCU+配套电源芯片）
-"""}
-    ]
+"""
+
+# 对话历史的 token 预算（不含系统提示词和当前问题），超出部分压缩为摘要
+CHAT_HISTORY_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", "4000"))
+# 早先对话摘要的 token 上限，超出时丢弃最早的摘要条目
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "800"))
+# 无论预算多少，最近的这些消息总是原样保留
+CHAT_MIN_RECENT_MESSAGES = 2
+# 每条消息摘要保留的最大字符数
+CHAT_SUMMARY_LINE_CHARS = 150
+
+def _summarize_chat_message(message):
+    """抽取式摘要：去掉表格、代码块等格式，保留标题和开头的句子"""
+    lines = []
+    in_code = False
+    for line in str(message.get("content", "")).splitlines():
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            in_code = not in_code
+            continue
+        if in_code or not stripped or stripped.startswith("|"):
+            continue
+        lines.append(stripped.lstrip("#>*-• ").strip())
+    text = "；".join(line for line in lines if line)
+    if len(text) > CHAT_SUMMARY_LINE_CHARS:
+        text = text[:CHAT_SUMMARY_LINE_CHARS] + "…"
+    role = "用户" if message.get("role") == "user" else "助手"
+    return f"{role}：{text}"
+
+def _chat_message_digest(message):
+    return hashlib.sha1(f"{message.get('role')}\n{message.get('content')}".encode("utf-8")).hexdigest()
+
+def build_chat_context(history, state):
+    """在 token 预算内构造对话上下文：最近的消息原样保留，更早的消息压缩为滚动摘要
+    
+    摘要是增量维护的：已压缩的消息数和摘要条目保存在 state 中，每轮只需处理新增的消息，
+    因此每轮的耗时和发送的 token 数不随对话长度增长。
+    
+    Args:
+        history: 对话历史，格式为[{"role": "user/assistant", "content": "消息内容"}, ...]
+        state: 保存滚动摘要的字典，跨轮次复用（为空字典时从头开始）
+        
+    Returns:
+        (摘要文本或空字符串, 原样保留的最近消息列表)
+    """
+    count = state.get("count", 0)
+    # 对话被清除或替换后，已有的摘要不再适用
+    if count > len(history) or (count and _chat_message_digest(history[count - 1]) != state.get("digest")):
+        count = 0
+        state["lines"] = []
+    lines = state.setdefault("lines", [])
+    
+    recent = history[count:]
+    tokens = [_estimate_tokens(str(message.get("content", ""))) for message in recent]
+    total = sum(tokens)
+    folded = 0
+    while total > CHAT_HISTORY_MAX_TOKENS and len(recent) - folded > CHAT_MIN_RECENT_MESSAGES:
+        lines.append(_summarize_chat_message(recent[folded]))
+        total -= tokens[folded]
+        folded += 1
+    
+    if folded:
+        count += folded
+        state["digest"] = _chat_message_digest(history[count - 1])
+        # 摘要也有上限，超出时丢弃最早的条目
+        while len(lines) > 1 and _estimate_tokens("\n".join(lines)) > CHAT_SUMMARY_MAX_TOKENS:
+            lines.pop(0)
+    state["count"] = count
+    
+    summary = "\n".join(lines)
+    return summary, [{"role": message["role"], "content": message["content"]} for message in history[count:]]
+
+def chat_with_expert(user_input, history=None, context_state=None):
+    """
+    使用DeepSeek API实现与电子元器件专家的对话
+    
+    参数:
+        user_input (str): 用户的输入/问题
+        history (list): 对话历史记录，格式为[{"role": "user/assistant", "content": "消息内容"}, ...]
+        context_state (dict): 滚动摘要状态，默认保存在当前会话的 session_state 中
+    
+    返回:
+        str 或 Generator: 根据stream参数，返回完整回复或流式回复
+    """
+    if history is None:
+        history = []
+    if context_state is None:
+        context_state = st.session_state.setdefault("chat_context", {}) if get_script_run_ctx() else {}
     
-    # 添加历史对话
-    for msg in history:
-        messages.append({"role": msg["role"], "content": msg["content"]})
+    # 构建消息：系统提示词 + 早先对话摘要 + 最近的对话（总量受 token 预算限制）
+    summary, recent_messages = build_chat_context(history, context_state)
+    messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
+    if summary:
+        messages.append({"role": "system", "content": f"以下是早先对话的摘要，供参考：\n{summary}"})
+    messages.extend(recent_messages)
     
     # 添加当前用户问题
     messages.append({"role": "user", "content": user_input})
     
     try:
         # 调用DeepSeek API获取回复 - 使用流式响应
-        response = deepseek_client.chat.completions.create(
-            model="deepseek-chat",
+        response = get_deepseek_client().chat.completions.create(
+            model=DEEPSEEK_MODEL,
             messages=messages,
             stream=True,
             max_tokens=2000
@@ -1420,12 +2806,13 @@ def chat_with_expert(user_input, history=None):
         return response
     
     except Exception as e:
-        st.error(f"调用DeepSeek API失败: {e}")
         import traceback
-        st.error(f"错误详情: {traceback.format_exc()}")
+        event_log.error(f"调用DeepSeek API失败: {e}", payload=traceback.format_exc())
+        # except 块结束后 e 会被删除，生成器稍后才执行，需先保存错误信息
+        msg = str(e)
         # 返回一个只包含错误信息的生成器，以保持接口一致性
         def error_generator():
-            yield f"很抱歉，我暂时无法回答你的问题。错误信息: {str(e)}"
+            yield f"很抱歉，我暂时无法回答你的问题。错误信息: {msg}"
         return error_generator()
 
 # 格式化响应
@@ -0,0 +1,110 @@
+"""批量查询断点续查：每个元器件查询完成后立即追加写入 JSONL 文件
+
+断点文件以 BOM 文件内容和查询版本（模型、提示词版本、是否测试数据）的哈希命名，
+同一份 BOM 以相同版本再次查询时（进程重启、接口额度用尽、任务失败后重新运行）
+直接复用已完成元器件的结果，只查询剩余部分；也可以只重新查询上次失败的元器件。
+"""
+import hashlib
+import json
+import os
+import threading
+
+import event_log
+
+DEFAULT_CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "checkpoints")
+
+
+def bom_content_hash(content, version=""):
+    """BOM 文件内容与查询版本的哈希，版本不同的结果互不复用"""
+    return hashlib.sha256(content + version.encode("utf-8")).hexdigest()
+
+
+class BatchCheckpoint:
+    """按型号记录批量查询结果的追加式断点文件
+
+    每行一条记录 {"mpn", "ok", "result"}，同一型号以最后一条记录为准。
+    进程在写入中途退出时，最后一行可能不完整，读取时直接跳过。
+    """
+
+    def __init__(self, path, retry_failed=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        # 上次写入中断时文件末尾没有换行，下一条记录需要另起一行
+        self._needs_newline = False
+        # 写入失败只提示一次，避免每个元器件都重复提示
+        self._write_failed = False
+        self._load(retry_failed)
+
+    @classmethod
+    def for_bom(cls, content, checkpoint_dir=None, retry_failed=False, version=""):
+        """返回指定 BOM 文件内容对应的断点
+
+        Args:
+            content: BOM 文件的字节内容
+            checkpoint_dir: 断点目录，默认读取环境变量 BATCH_CHECKPOINT_DIR
+            retry_failed: 为 True 时忽略失败的记录，使这些元器件重新查询
+            version: 查询版本（backend.batch_query_version），换模型、改提示词或切换测试数据后不复用旧断点
+        """
+        checkpoint_dir = checkpoint_dir or os.getenv("BATCH_CHECKPOINT_DIR", DEFAULT_CHECKPOINT_DIR)
+        path = os.path.join(checkpoint_dir, f"{bom_content_hash(content, version)}.jsonl")
+        return cls(path, retry_failed=retry_failed)
+
+    def get(self, mpn):
+        """返回 (结果字典, 是否成功)，该型号尚未完成时返回 None"""
+        with self._lock:
+            entry = self._entries.get(mpn)
+        if entry is None:
+            return None
+        return entry["result"], entry["ok"]
+
+    def record(self, mpn, result, ok):
+        """记录一个元器件的查询结果，立即写入磁盘"""
+        line = json.dumps({"mpn": mpn, "ok": bool(ok), "result": result}, ensure_ascii=False, default=str)
+        with self._lock:
+            self._entries[mpn] = {"result": result, "ok": bool(ok)}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(("\n" if self._needs_newline else "") + line + "\n")
+                self._needs_newline = False
+            except OSError as e:
+                if not self._write_failed:
+                    self._write_failed = True
+                    event_log.warning(f"无法写入批量查询断点 {self.path}: {e}，中断后将无法从断点继续")
+
+    def reset(self):
+        """丢弃已有记录，下次查询从头开始"""
+        with self._lock:
+            self._entries.clear()
+            self._needs_newline = False
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    @property
+    def completed_count(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def failed_count(self):
+        with self._lock:
+            return sum(1 for entry in self._entries.values() if not entry["ok"])
+
+    def _load(self, retry_failed):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        self._needs_newline = bool(lines) and not lines[-1].endswith("\n")
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                self._entries[entry["mpn"]] = {"result": entry["result"], "ok": bool(entry["ok"])}
+            except (ValueError, KeyError, TypeError):
+                continue
+        if retry_failed:
+            self._entries = {mpn: entry for mpn, entry in self._entries.items() if entry["ok"]}
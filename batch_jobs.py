@@ -0,0 +1,306 @@
+"""BOM 批量查询后台任务：任务在进程级线程池中运行，不受 Streamlit 页面重新运行影响
+
+点击"开始批量查询"后只提交任务并记录任务 ID，页面定时读取任务进度。
+控件交互、刷新页面或关闭标签页都不会中断任务，稍后回来即可查看结果。
+任务状态、上传的文件和结果都保存在磁盘上（默认为项目下的 jobs/ 目录），
+任务 ID 由文件内容和查询版本（模型、提示词版本、是否测试数据）的哈希生成，
+同一份 BOM 以相同版本重复提交时直接复用进行中或已完成的任务；
+失败或中断的任务重新运行时从断点（batch_checkpoint）继续，已完成的元器件不会重复查询。
+"""
+import hashlib
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_checkpoint import BatchCheckpoint
+import event_log
+
+DEFAULT_JOB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs")
+# 同时运行的批量任务数，每个任务内部仍按 BATCH_MAX_WORKERS 并发查询
+DEFAULT_MAX_JOBS = int(os.getenv("BATCH_JOB_WORKERS", "1"))
+# 任务及其结果的保留时间（秒）
+DEFAULT_JOB_TTL = int(os.getenv("BATCH_JOB_TTL", str(7 * 24 * 3600)))
+# 进度写入磁盘的最小间隔（秒），内存中的进度实时更新
+PROGRESS_FLUSH_INTERVAL = 1.0
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# 进程在任务运行期间退出，任务未完成
+INTERRUPTED = "interrupted"
+
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+STATUS_LABELS = {
+    QUEUED: "排队中",
+    RUNNING: "查询中",
+    DONE: "已完成",
+    FAILED: "失败",
+    INTERRUPTED: "已中断",
+}
+
+
+def make_job_id(filename, content, version=""):
+    """由文件内容、扩展名和查询版本生成任务 ID，同一份 BOM 以相同版本查询时总是得到同一个 ID"""
+    file_ext = os.path.splitext(filename)[1].lower()
+    return hashlib.sha256(content + file_ext.encode("utf-8") + version.encode("utf-8")).hexdigest()[:16]
+
+
+class StoredBomFile(io.BytesIO):
+    """保存在任务目录中的 BOM 文件，提供与 Streamlit 上传文件相同的 name/size/getvalue()"""
+
+    def __init__(self, name, content):
+        super().__init__(content)
+        self.name = name
+        self.size = len(content)
+
+
+class BatchJobManager:
+    """提交、执行并持久化 BOM 批量查询任务
+
+    每个任务在 job_dir 下对应三个文件：
+        <id>.json        任务状态（状态、进度、说明文字、时间、统计信息）
+        <id>.input       上传的 BOM 文件内容
+        <id>.result.pkl  查询结果（batch_get_alternative_parts 的返回值）
+    逐个元器件的断点保存在 BATCH_CHECKPOINT_DIR 中，以 BOM 内容的哈希命名。
+    Streamlit 的各个会话运行在同一进程中，因此该对象在会话之间共享。
+    """
+
+    def __init__(self, job_dir=DEFAULT_JOB_DIR, max_jobs=DEFAULT_MAX_JOBS, ttl=DEFAULT_JOB_TTL, runner=None,
+                 query_version=None):
+        self.job_dir = job_dir
+        self.ttl = ttl
+        self._runner = runner
+        # 查询版本函数，参数为 use_dummy_data，默认为 backend.batch_query_version
+        self._query_version = query_version
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_jobs), thread_name_prefix="bom-job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._flushed_at = {}
+        # 每个任务最近一次运行的事件日志（仅保存在内存中）
+        self._logs = {}
+        self._load_jobs()
+
+    def submit(self, filename, content, force=False, retry_failed=False, use_dummy_data=False, debug=False):
+        """提交批量查询任务，返回任务状态字典
+
+        同一份 BOM 的任务正在进行或已经完成时直接返回该任务，不会重复查询；
+        之前失败或中断的任务从断点继续。retry_failed=True 时只重新查询上次失败的元器件，
+        force=True 时丢弃已有结果和断点，全部重新查询。
+        use_dummy_data 和 debug 为提交任务的会话的设置，任务运行时沿用；
+        换模型、改提示词或切换测试数据后得到新的任务和断点，不会复用旧结果。
+        """
+        version = self._get_query_version()(use_dummy_data)
+        job_id = make_job_id(filename, content, version)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] in ACTIVE_STATUSES:
+                return dict(job)
+            if (job is not None and job["status"] == DONE and not force and not retry_failed
+                    and os.path.exists(self._path(job_id, ".result.pkl"))):
+                return dict(job)
+
+            now = time.time()
+            job = {
+                "id": job_id,
+                "filename": filename,
+                "size": len(content),
+                "status": QUEUED,
+                "progress": 0.0,
+                "message": STATUS_LABELS[QUEUED],
+                "created": now,
+                "updated": now,
+                "finished": None,
+                "columns_info": {},
+                "part_count": 0,
+                "failed_count": 0,
+                "error": None,
+                "version": version,
+                "checkpoint": BatchCheckpoint.for_bom(content, version=version).path,
+                "retry_failed": retry_failed,
+                "fresh": force,
+                "use_dummy_data": use_dummy_data,
+                "debug": debug,
+            }
+            self._jobs[job_id] = job
+            self._logs[job_id] = event_log.EventLog()
+        self._write_bytes(self._path(job_id, ".input"), content)
+        self._save_state(job)
+        self._executor.submit(self._run, job_id)
+        return dict(job)
+
+    def retry(self, job_id, retry_failed=False, force=False, **options):
+        """重新运行任务（使用任务目录中保存的 BOM 文件），已完成的元器件从断点恢复
+
+        Args:
+            job_id: 任务 ID
+            retry_failed: 为 True 时重新查询上次失败的元器件
+            force: 为 True 时丢弃已有结果和断点，全部重新查询
+            options: 传给 submit 的会话设置（use_dummy_data、debug）
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        try:
+            with open(self._path(job_id, ".input"), "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        return self.submit(job["filename"], content, force=force, retry_failed=retry_failed, **options)
+
+    def get(self, job_id):
+        """返回任务状态的副本，任务不存在时返回 None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def list_jobs(self, limit=None):
+        """按提交时间从新到旧返回任务列表"""
+        with self._lock:
+            jobs = sorted((dict(job) for job in self._jobs.values()), key=lambda job: job["created"], reverse=True)
+        return jobs[:limit] if limit else jobs
+
+    def get_log(self, job_id):
+        """任务最近一次运行的事件日志，服务重启后为空"""
+        with self._lock:
+            return self._logs.setdefault(job_id, event_log.EventLog())
+
+    def load_result(self, job_id):
+        """读取已完成任务的结果，结果不存在时返回 None"""
+        try:
+            with open(self._path(job_id, ".result.pkl"), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _run(self, job_id):
+        job = self.get(job_id)
+        try:
+            with open(self._path(job_id, ".input"), "rb") as f:
+                content = f.read()
+            bom_file = StoredBomFile(job["filename"], content)
+            checkpoint = BatchCheckpoint(job["checkpoint"], retry_failed=job.get("retry_failed", False))
+            if job.get("fresh"):
+                checkpoint.reset()
+            self._update(job_id, status=RUNNING, message="正在读取BOM文件...", flush=True)
+
+            def progress_callback(progress, text):
+                if progress is None:
+                    self._update(job_id, message=text)
+                else:
+                    self._update(job_id, progress=progress, message=text)
+
+            # 任务线程没有页面会话，事件写入任务自己的日志
+            with event_log.bind_log(self.get_log(job_id), debug=job.get("debug", False)):
+                results, columns_info = self._get_runner()(bom_file, progress_callback, checkpoint=checkpoint,
+                                                           use_dummy_data=job.get("use_dummy_data", False))
+            if not results:
+                self._update(job_id, status=FAILED, error="无法从BOM文件中识别元器件型号", message="无法从BOM文件中识别元器件型号",
+                             columns_info=columns_info, finished=time.time(), flush=True)
+                return
+            self._write_bytes(self._path(job_id, ".result.pkl"), pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL))
+            part_count = sum(1 for info in results.values() if not info.get("alias_of"))
+            failed_count = checkpoint.failed_count
+            message = f"批量查询完成，共 {part_count} 个元器件"
+            if failed_count:
+                message += f"，其中 {failed_count} 个未查询到替代方案或查询失败"
+            self._update(job_id, status=DONE, progress=1.0, message=message, columns_info=columns_info,
+                         part_count=part_count, failed_count=failed_count, finished=time.time(), flush=True)
+        except Exception as e:
+            self._update(job_id, status=FAILED, error=str(e), message=f"批量查询失败: {e}", finished=time.time(), flush=True)
+
+    def _get_runner(self):
+        if self._runner is None:
+            # 延迟导入，避免与 backend 循环导入
+            from backend import run_bom_batch
+            self._runner = run_bom_batch
+        return self._runner
+
+    def _get_query_version(self):
+        if self._query_version is None:
+            from backend import batch_query_version
+            self._query_version = batch_query_version
+        return self._query_version
+
+    def _update(self, job_id, flush=False, **changes):
+        now = time.time()
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(changes)
+            job["updated"] = now
+            if not flush and now - self._flushed_at.get(job_id, 0) < PROGRESS_FLUSH_INTERVAL:
+                return
+            self._flushed_at[job_id] = now
+            snapshot = dict(job)
+        self._save_state(snapshot)
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.job_dir, f"{job_id}{suffix}")
+
+    def _save_state(self, job):
+        self._write_bytes(self._path(job["id"], ".json"), json.dumps(job, ensure_ascii=False).encode("utf-8"))
+
+    def _write_bytes(self, path, payload):
+        """先写临时文件再原子替换，避免读到半个文件"""
+        try:
+            os.makedirs(self.job_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.job_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def _load_jobs(self):
+        """载入磁盘上的任务状态，删除过期任务；上次进程退出时未完成的任务标记为已中断"""
+        try:
+            names = os.listdir(self.job_dir)
+        except OSError:
+            return
+        now = time.time()
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            job_id = name[:-len(".json")]
+            try:
+                with open(self._path(job_id, ".json"), "r", encoding="utf-8") as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if self.ttl > 0 and job.get("updated", 0) + self.ttl < now:
+                self._remove_job_files(job_id, job.get("checkpoint"))
+                continue
+            if job.get("status") in ACTIVE_STATUSES:
+                job["status"] = INTERRUPTED
+                job["message"] = "服务重启，任务未完成，重新运行时将从断点继续"
+                self._save_state(job)
+            self._jobs[job_id] = job
+
+    def _remove_job_files(self, job_id, checkpoint_path=None):
+        paths = [self._path(job_id, suffix) for suffix in (".json", ".input", ".result.pkl")]
+        if checkpoint_path:
+            paths.append(checkpoint_path)
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """进程级共享的任务管理器，首次调用时创建"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = BatchJobManager(job_dir=os.getenv("BATCH_JOB_DIR", DEFAULT_JOB_DIR))
+        return _manager
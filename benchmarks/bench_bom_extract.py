@@ -0,0 +1,128 @@
+"""extract_bom_components 基准测试：对比按列处理与旧版 iterrows 逐行提取的耗时
+
+运行方式（项目根目录下）：
+    python benchmarks/bench_bom_extract.py
+    python benchmarks/bench_bom_extract.py --legacy   # 同时对比旧版 iterrows 实现并校验结果一致（100k 行较慢）
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend import canonicalize_mpn, extract_bom_components  # noqa: E402
+
+PREFIXES = ["STM32F103C8T6", "GD32F303RCT6", "LM358DR", "AMS1117-3.3", "GRM188R71H104KA93D",
+            "TPS5430DDAR", "CH340G", "ESP32-S3-WROOM-1", "W25Q128JVSIQ", "SS34"]
+SUFFIXES = ["", "", "", "TR", " ", "-REEL"]
+
+
+def build_bom(rows, unique_ratio=0.2, seed=0):
+    """构造指定行数的 BOM，约 unique_ratio 比例的不同型号，混有大小写/空白/包装后缀写法和空行"""
+    rnd = random.Random(seed)
+    unique = max(1, int(rows * unique_ratio))
+    base = [f"{rnd.choice(PREFIXES)}{i:05d}" for i in range(unique)]
+    mpns, names, descs = [], [], []
+    for _ in range(rows):
+        mpn = rnd.choice(base) + rnd.choice(SUFFIXES)
+        if rnd.random() < 0.1:
+            mpn = mpn.lower()
+        if rnd.random() < 0.02:
+            mpn = None
+        mpns.append(mpn)
+        names.append(rnd.choice(["MCU", "LDO", "电容", None]))
+        descs.append(rnd.choice(["", "3.3V 1A", "0.1uF 50V X7R", None]))
+    return pd.DataFrame({"型号": mpns, "名称": names, "描述": descs})
+
+
+def legacy_extract(df, mpn_col, name_col, desc_col):
+    """旧版逐行提取 + 字典去重实现（与改为按列处理前的 process_bom_file 循环一致），仅用于对比"""
+    component_list = []
+    for _, row in df.iterrows():
+        component = {}
+        
+        # 提取型号信息
+        if mpn_col and pd.notna(row.get(mpn_col)):
+            component['mpn'] = str(row.get(mpn_col)).strip()
+        else:
+            continue  # 如果没有型号，则跳过该行
+            
+        # 提取名称信息
+        if name_col and pd.notna(row.get(name_col)):
+            component['name'] = str(row.get(name_col)).strip()
+        else:
+            component['name'] = ''
+            
+        # 提取描述信息
+        if desc_col and pd.notna(row.get(desc_col)):
+            component['description'] = str(row.get(desc_col)).strip()
+        else:
+            component['description'] = ''
+            
+        # 仅添加有型号的元器件
+        if component.get('mpn'):
+            component_list.append(component)
+
+    unique_components = []
+    canonical_index = {}
+    for comp in component_list:
+        canonical = canonicalize_mpn(comp['mpn'])
+        existing = canonical_index.get(canonical)
+        info = {'name': comp['name'], 'description': comp['description']}
+        if existing is None:
+            comp['canonical_mpn'] = canonical
+            comp['aliases'] = [comp['mpn']]
+            comp['alias_info'] = {comp['mpn']: info}
+            canonical_index[canonical] = comp
+            unique_components.append(comp)
+            continue
+        if comp['mpn'] not in existing['aliases']:
+            existing['aliases'].append(comp['mpn'])
+        # 每种写法保留自己所在行的名称和描述
+        alias_info = existing['alias_info'].setdefault(comp['mpn'], info)
+        for field, value in info.items():
+            if not alias_info[field] and value:
+                alias_info[field] = value
+        # 首次出现的行缺少名称或描述时，用后续行补充
+        if not existing['name'] and comp['name']:
+            existing['name'] = comp['name']
+        if not existing['description'] and comp['description']:
+            existing['description'] = comp['description']
+    return unique_components
+
+
+def time_call(func, *args, repeat=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="1000,10000,100000", help="BOM 行数，逗号分隔")
+    parser.add_argument("--legacy", action="store_true", help="校验与旧版 iterrows 实现的结果一致并对比耗时")
+    args = parser.parse_args()
+
+    print(f"{'行数':>10}{'元器件数':>10}{'字典(ms)':>12}{'DataFrame(ms)':>15}" + (f"{'旧版(ms)':>12}" if args.legacy else ""))
+    for rows in [int(r) for r in args.rows.split(",")]:
+        df = build_bom(rows)
+        components = extract_bom_components(df, "型号", "名称", "描述")
+        line = (f"{rows:>10}{len(components):>10}"
+                f"{time_call(extract_bom_components, df, '型号', '名称', '描述') * 1000:>12.1f}"
+                f"{time_call(extract_bom_components, df, '型号', '名称', '描述', as_frame=True) * 1000:>15.1f}")
+        if args.legacy:
+            # 先确认两种实现的结果完全一致，耗时对比才有意义
+            assert legacy_extract(df, '型号', '名称', '描述') == components, f"{rows} 行: 与旧版实现的结果不一致"
+            line += f"{time_call(legacy_extract, df, '型号', '名称', '描述', repeat=1) * 1000:>12.1f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
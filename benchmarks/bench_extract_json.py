@@ -0,0 +1,74 @@
+"""extract_json_value 微基准测试：验证畸形大输入下的解析耗时有上界
+
+运行方式（项目根目录下）：
+    python benchmarks/bench_extract_json.py
+    python benchmarks/bench_extract_json.py --legacy   # 同时对比旧版贪婪正则的耗时（较慢）
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend import extract_json_value  # noqa: E402
+
+VALID_ITEM = ('{"model": "GD32F103C8T6", "brand": "GigaDevice/兆易创新", "category": "MCU", '
+              '"package": "LQFP48", "parameters": "CPU内核: ARM Cortex-M3, 主频: 72MHz", '
+              '"type": "国产", "price": "¥12-¥15", "datasheet": "https://www.gigadevice.com"}')
+
+# 旧版 extract_json_content 中回溯最严重的两个正则
+LEGACY_PATTERNS = [
+    re.compile(r'\[\s*\{.*\}\s*\]', re.DOTALL),
+    re.compile(r'\[\s*\{\s*"model"\s*:.*?\}\s*\]', re.DOTALL),
+]
+
+
+def build_inputs(size):
+    """构造指定大小的各类输入"""
+    valid = "[" + ", ".join([VALID_ITEM] * 3) + "]"
+    return {
+        "有效响应(带代码块)": "以下是推荐结果：\n```json\n" + valid + "\n```\n",
+        "未闭合的对象数组": ('[{"model": "x", ' * (size // 16))[:size],
+        "大量未闭合方括号": ("[" * size),
+        "大量短方括号片段": ("[注] " * (size // 4))[:size],
+        "垃圾文本后接有效数组": ("说明文字 { ] } [ " * (size // 16))[:size] + valid,
+        "未闭合引号": ('[{"model": "' + "a" * size),
+    }
+
+
+def time_call(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def legacy_extract(content):
+    for pattern in LEGACY_PATTERNS:
+        pattern.search(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100000,500000,1000000", help="输入大小（字节），逗号分隔")
+    parser.add_argument("--legacy", action="store_true", help="对比旧版正则的耗时（仅测试 100KB 以内的输入）")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    print(f"{'输入类型':<20}{'大小':>10}{'耗时(ms)':>12}{'μs/KB':>10}" + (f"{'旧版(ms)':>12}" if args.legacy else ""))
+    for size in sizes:
+        for name, content in build_inputs(size).items():
+            elapsed = time_call(extract_json_value, content)
+            per_kb = elapsed * 1e6 / max(len(content) / 1024, 1)
+            line = f"{name:<20}{len(content):>10}{elapsed * 1000:>12.2f}{per_kb:>10.1f}"
+            if args.legacy and len(content) <= 100000:
+                line += f"{time_call(legacy_extract, content, repeat=1) * 1000:>12.2f}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""BOM 批量查询的命令行与库入口，不需要启动 Streamlit 页面
+
+命令行用法（项目根目录下）：
+    python -m bom_batch BOM.xlsx -o 替代方案.xlsx
+    python -m bom_batch BOM.csv -o 替代方案.csv --workers 16 --cache-dir /data/bom-cache
+    python -m bom_batch BOM.xlsx -o 替代方案.xlsx --resume          # 从上次中断处继续
+    python -m bom_batch BOM.xlsx -o 替代方案.xlsx --retry-failed    # 只重新查询上次失败的元器件
+    python -m bom_batch BOM.xlsx -o 替代方案.xlsx --strict          # 有任何元器件失败即返回非零退出码
+
+运行事件和进度输出到标准错误，可直接用于定时任务的日志。
+退出码：0 成功；1 无法识别元器件、全部元器件查询失败，或使用 --strict 时有元器件查询失败。
+"""
+import argparse
+import os
+import sys
+import time
+
+from batch_checkpoint import BatchCheckpoint
+from batch_jobs import StoredBomFile
+from result_export import EXPORT_FORMATS, export_results
+import event_log
+
+# 命令行输出进度的最小间隔（秒）
+PROGRESS_PRINT_INTERVAL = 2.0
+
+
+def export_format_for(path):
+    """根据输出文件扩展名确定导出格式"""
+    suffix = os.path.splitext(path)[1].lower()
+    for fmt, info in EXPORT_FORMATS.items():
+        if info["suffix"] == suffix:
+            return fmt
+    raise ValueError(f"不支持的输出格式: {suffix}（支持 {', '.join(info['suffix'] for info in EXPORT_FORMATS.values())}）")
+
+
+def process_bom(input_path, output_path=None, workers=None, resume=False, retry_failed=False,
+                progress_callback=None, checkpoint_dir=None):
+    """读取 BOM 文件、批量查询替代方案，并可选地导出结果
+
+    每个元器件的结果都写入断点（以 BOM 内容和查询版本的哈希命名），进程中断后可以继续。
+
+    Args:
+        input_path: BOM 文件路径（.xlsx/.xls/.csv）
+        output_path: 导出文件路径（.xlsx/.csv），为空时不导出
+        workers: 最大并发数，默认读取环境变量 BATCH_MAX_WORKERS
+        resume: 为 True 时复用断点中已完成的结果，否则从头查询
+        retry_failed: 为 True 时复用断点中成功的结果，只重新查询失败的元器件
+        progress_callback: 进度回调函数，参数为 (进度, 说明文字)
+        checkpoint_dir: 断点目录，默认读取环境变量 BATCH_CHECKPOINT_DIR
+
+    Returns:
+        (批量查询结果字典, 识别的列名信息, 查询失败的元器件数)
+    """
+    # 延迟导入：命令行需要先根据参数设置缓存目录等环境变量
+    from backend import batch_query_version, run_bom_batch
+
+    fmt = export_format_for(output_path) if output_path else None
+    with open(input_path, "rb") as f:
+        content = f.read()
+
+    checkpoint = BatchCheckpoint.for_bom(content, checkpoint_dir, retry_failed=retry_failed,
+                                         version=batch_query_version())
+    if not (resume or retry_failed):
+        checkpoint.reset()
+
+    bom_file = StoredBomFile(os.path.basename(input_path), content)
+    results, columns_info = run_bom_batch(bom_file, progress_callback, max_workers=workers, checkpoint=checkpoint)
+
+    if output_path and results:
+        with open(output_path, "wb") as f:
+            f.write(export_results(results, fmt))
+    # 失败的元器件可能带有测试数据，只能以断点中的记录为准
+    return results, columns_info, checkpoint.failed_count
+
+
+def _print_event(event):
+    print(f"[{event['level']}] {event['message']}", file=sys.stderr, flush=True)
+
+
+def _make_progress_printer():
+    last_printed = 0.0
+
+    def print_progress(progress, text):
+        nonlocal last_printed
+        now = time.monotonic()
+        if progress is not None and progress < 1.0 and now - last_printed < PROGRESS_PRINT_INTERVAL:
+            return
+        last_printed = now
+        prefix = f"[{progress:6.1%}] " if progress is not None else ""
+        print(f"{prefix}{text}", file=sys.stderr, flush=True)
+
+    return print_progress
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bom_batch", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="BOM 文件（.xlsx/.xls/.csv）")
+    parser.add_argument("-o", "--output", required=True, help="导出文件（.xlsx/.csv）")
+    parser.add_argument("--workers", type=int, help="最大并发数，默认读取环境变量 BATCH_MAX_WORKERS")
+    parser.add_argument("--cache-dir", help="查询结果缓存目录，默认读取环境变量 BOM_CACHE_DIR")
+    parser.add_argument("--checkpoint-dir", help="断点目录，默认读取环境变量 BATCH_CHECKPOINT_DIR")
+    parser.add_argument("--resume", action="store_true", help="从上次中断处继续，已完成的元器件不再查询")
+    parser.add_argument("--retry-failed", action="store_true", help="复用上次成功的结果，只重新查询失败的元器件")
+    parser.add_argument("--strict", action="store_true", help="有任何元器件查询失败时返回非零退出码")
+    parser.add_argument("-q", "--quiet", action="store_true", help="只输出警告和错误")
+    args = parser.parse_args(argv)
+
+    try:
+        export_format_for(args.output)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.cache_dir:
+        # 结果缓存在导入 backend 时按环境变量创建
+        os.environ["BOM_CACHE_DIR"] = args.cache_dir
+
+    min_level = event_log.LEVELS["warning" if args.quiet else "info"]
+
+    def listener(event):
+        if event_log.LEVELS[event["level"]] >= min_level:
+            _print_event(event)
+
+    event_log.add_listener(listener)
+    started = time.monotonic()
+    try:
+        results, _, failed_count = process_bom(
+            args.input, args.output, workers=args.workers, resume=args.resume, retry_failed=args.retry_failed,
+            progress_callback=None if args.quiet else _make_progress_printer(), checkpoint_dir=args.checkpoint_dir,
+        )
+    finally:
+        event_log.remove_listener(listener)
+
+    if not results:
+        print("无法从BOM文件中识别元器件型号", file=sys.stderr)
+        return 1
+    part_count = sum(1 for info in results.values() if not info.get("alias_of"))
+    print(f"已导出 {part_count} 个元器件的替代方案到 {args.output}（用时 {time.monotonic() - started:.1f} 秒）", file=sys.stderr)
+    if failed_count:
+        print(f"其中 {failed_count} 个元器件未查询到替代方案或查询失败", file=sys.stderr)
+    if failed_count >= part_count or (args.strict and failed_count):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""运行事件日志：有界环形缓冲区 + 调试开关
+
+后端不再为每次调用、每次重试在侧边栏创建提示或调试展开栏，而是把事件写入日志，
+由界面在一个可折叠面板中统一显示。普通模式下调试事件直接丢弃、不保存原始响应等
+附带数据，因此不会有任何大块内容被发送到浏览器。
+没有页面的调用方（命令行、定时任务）可以通过 add_listener 注册回调，实时接收事件；
+后台任务通过 bind_log 把所在线程的事件写入任务自己的日志。
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+LEVELS = {"debug": 10, "info": 20, "success": 25, "warning": 30, "error": 40}
+
+# 每个会话保留的最近事件数
+DEFAULT_CAPACITY = int(os.getenv("EVENT_LOG_CAPACITY", "200"))
+# 设为 1 时所有会话默认开启调试模式
+DEBUG_BY_DEFAULT = os.getenv("BOM_DEBUG", "0") == "1"
+
+
+class EventLog:
+    """线程安全的有界事件日志，超出容量时丢弃最早的事件"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._events = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def add(self, level, message, payload=None):
+        event = {"time": time.time(), "level": level, "message": message, "payload": payload}
+        with self._lock:
+            self._events.append(event)
+        return event
+
+    def entries(self, min_level="debug"):
+        """返回不低于指定级别的事件，按时间从新到旧排列"""
+        threshold = LEVELS[min_level]
+        with self._lock:
+            events = list(self._events)
+        return [event for event in reversed(events) if LEVELS[event["level"]] >= threshold]
+
+    def clear(self):
+        with self._lock:
+            self._events.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._events)
+
+
+# 没有 Streamlit 会话的线程（如命令行、后台任务）共用的日志
+_process_log = EventLog()
+
+# 进程级事件回调，所有会话和线程的事件都会通知
+_listeners = []
+_listeners_lock = threading.Lock()
+
+
+def add_listener(callback):
+    """注册事件回调，参数为事件字典 {time, level, message, payload}
+
+    回调在记录事件的线程中同步调用，应尽快返回。
+    """
+    with _listeners_lock:
+        _listeners.append(callback)
+
+
+def remove_listener(callback):
+    with _listeners_lock:
+        if callback in _listeners:
+            _listeners.remove(callback)
+
+
+# 当前线程绑定的 (日志, 调试开关)，由 bind_log 设置，优先于会话日志
+_thread_binding = threading.local()
+
+
+def current_binding():
+    """返回当前线程绑定的 (日志, 调试开关)，未绑定时为 (None, None)"""
+    return getattr(_thread_binding, "log", None), getattr(_thread_binding, "debug", None)
+
+
+def set_binding(binding):
+    """设置当前线程的绑定，用于把 current_binding() 传递给工作线程"""
+    _thread_binding.log, _thread_binding.debug = binding
+
+
+@contextmanager
+def bind_log(log, debug=None):
+    """在当前线程中把事件写入指定日志
+
+    Args:
+        log: 事件写入的 EventLog
+        debug: 是否记录调试事件，为 None 时沿用会话或全局设置
+    """
+    previous = current_binding()
+    set_binding((log, debug))
+    try:
+        yield log
+    finally:
+        set_binding(previous)
+
+
+def _has_session():
+    return get_script_run_ctx(suppress_warning=True) is not None
+
+
+def debug_enabled():
+    """当前会话是否开启调试模式"""
+    bound_debug = current_binding()[1]
+    if bound_debug is not None:
+        return bound_debug
+    if _has_session():
+        return bool(st.session_state.get("debug_mode", DEBUG_BY_DEFAULT))
+    return DEBUG_BY_DEFAULT
+
+
+def get_event_log():
+    """当前线程绑定的日志，其次是当前会话的事件日志，不在会话中时返回进程级日志"""
+    bound_log = current_binding()[0]
+    if bound_log is not None:
+        return bound_log
+    if not _has_session():
+        return _process_log
+    if "event_log" not in st.session_state:
+        st.session_state.event_log = EventLog()
+    return st.session_state.event_log
+
+
+def log_event(level, message, payload=None):
+    """记录一条事件
+
+    Args:
+        level: 事件级别，见 LEVELS
+        message: 事件说明
+        payload: 附带数据（原始响应、错误堆栈等），仅在调试模式下保存
+    """
+    debug = debug_enabled()
+    if level == "debug" and not debug:
+        return
+    event = get_event_log().add(level, message, payload if debug else None)
+    with _listeners_lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        listener(event)
+
+
+def debug(message, payload=None):
+    log_event("debug", message, payload)
+
+
+def info(message, payload=None):
+    log_event("info", message, payload)
+
+
+def success(message, payload=None):
+    log_event("success", message, payload)
+
+
+def warning(message, payload=None):
+    log_event("warning", message, payload)
+
+
+def error(message, payload=None):
+    log_event("error", message, payload)
@@ -1,11 +1,12 @@
 import streamlit as st
 from datetime import datetime
 import time
-import pandas as pd
-import tempfile  # 用于创建临时文件，支持文件下载功能
 from custom_components.hide_sidebar_items import get_sidebar_hide_code
+from result_export import EXPORT_FORMATS, export_results, has_export_rows
+from batch_jobs import get_job_manager, ACTIVE_STATUSES, DONE, STATUS_LABELS
+import event_log
 
-def render_ui(get_alternative_parts_func):
+def render_ui(get_alternative_parts_func, stream_alternative_parts_func=None):
     # Streamlit 界面 - 确保 set_page_config 是第一个Streamlit命令
     st.set_page_config(page_title="BOM 元器件国产替代推荐工具", layout="wide")
     
@@ -480,8 +481,13 @@ def render_ui(get_alternative_parts_func):
                 st.error("⚠️ 请输入元器件型号！")
             else:
                 with st.spinner(f"🔄 正在查询 {part_number} 的国产替代方案..."):
-                    # 调用后端函数获取替代方案
-                    recommendations = get_alternative_parts_func(part_number)
+                    if stream_alternative_parts_func is not None:
+                        # 流式查询：每解析出一个方案就立即显示
+                        recommendations = display_streaming_results(
+                            part_number, stream_alternative_parts_func(part_number))
+                    else:
+                        # 调用后端函数获取替代方案
+                        recommendations = get_alternative_parts_func(part_number)
                     
                     # 保存到历史记录
                     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -493,7 +499,8 @@ def render_ui(get_alternative_parts_func):
                     })
                     
                     # 显示结果
-                    display_search_results(part_number, recommendations)
+                    if stream_alternative_parts_func is None:
+                        display_search_results(part_number, recommendations)
     
     with tab2:
         # 聊天界面容器
@@ -560,27 +567,27 @@ def render_ui(get_alternative_parts_func):
                             
                             try:
                                 # 调用AI对话函数并处理流式输出
+                                request_started = time.perf_counter()
                                 response_stream = chat_with_expert(
                                     user_input, 
                                     history=st.session_state.chat_messages[:-1]  # 不包括刚刚添加的用户消息
                                 )
                                 
-                                response_container = st.empty()
-                                full_response = ""
+                                # 按时间/字数间隔批量刷新，避免每个 token 都重新渲染整段回答
+                                renderer = ThrottledMarkdown(st.empty())
                                 
                                 # 处理流式响应
                                 for chunk in response_stream:
-                                    if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'content'):
-                                        content = chunk.choices[0].delta.content
-                                        if content:
-                                            full_response += content
-                                            response_container.markdown(full_response + "▌")
+                                    renderer.append(_chunk_text(chunk))
                                 
                                 # 显示最终结果
-                                response_container.markdown(full_response)
+                                full_response = renderer.finish()
+                                latency = renderer.latency(request_started)
                                 
                                 # 将AI回复添加到对话历史
-                                st.session_state.chat_messages.append({"role": "assistant", "content": full_response})
+                                st.session_state.chat_messages.append({
+                                    "role": "assistant", "content": full_response, "latency": latency
+                                })
                             except Exception as e:
                                 error_msg = f"处理您的请求时出现错误: {str(e)}"
                                 st.error(error_msg)
@@ -619,6 +626,8 @@ def render_ui(get_alternative_parts_func):
                         if assistant_msg:
                             with st.chat_message("assistant"):
                                 st.markdown(assistant_msg["content"])
+                                if assistant_msg.get("latency"):
+                                    st.caption(_format_latency(assistant_msg["latency"]))
                 
                 # 添加清除对话按钮
                 st.markdown("<div style='margin-top: 10px;'></div>", unsafe_allow_html=True)
@@ -627,6 +636,7 @@ def render_ui(get_alternative_parts_func):
                         "role": "assistant", 
                         "content": "对话已清除。请告诉我您需要查找什么元器件的替代方案或有什么选型需求？"
                     }]
+                    st.session_state.pop("chat_context", None)
                     st.rerun()
                 
                 # 添加分隔线
@@ -696,10 +706,14 @@ def render_ui(get_alternative_parts_func):
             
             # 如果上传了文件，尝试预览
             try:
-                if uploaded_file.name.endswith('.csv'):
-                    df_preview = pd.read_csv(uploaded_file)  # 移除nrows=5限制，显示所有行
+                from backend import read_bom_dataframe, read_bom_head, BOM_STREAM_THRESHOLD_BYTES
+                if uploaded_file.size > BOM_STREAM_THRESHOLD_BYTES:
+                    # 大文件只预览开头部分，避免整表载入内存
+                    df_preview = read_bom_head(uploaded_file)
+                    st.caption(f"文件较大，仅预览前 {len(df_preview)} 行，批量查询将以流式方式读取全部数据")
                 else:
-                    df_preview = pd.read_excel(uploaded_file) 
+                    # 与批量处理共用同一次解析结果（按文件内容缓存）
+                    df_preview = read_bom_dataframe(uploaded_file)  # 移除nrows=5限制，显示所有行
                 
                 # 直接显示数据框，不使用expander
                 st.subheader("BOM文件预览")
@@ -707,176 +721,22 @@ def render_ui(get_alternative_parts_func):
             except Exception as e:
                 st.error(f"文件预览失败: {e}")
             
-            # 批量处理逻辑
+            # 批量处理逻辑：提交后台任务，页面重新运行或关闭都不会中断查询
             if batch_process_button:
-                # 从backend导入函数
-                import sys
-                import os
-                
-                # 确保backend模块可以被导入
-                sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-                
-                # 现在导入所需函数
-                from backend import process_bom_file, batch_get_alternative_parts
-                
-                # 处理BOM文件，获取更丰富的元器件信息
-                components, columns_info = process_bom_file(uploaded_file)
-                
-                if not components:
-                    st.error("⚠️ 无法从BOM文件中识别元器件型号！")
-                else:
-                    # 将识别信息移至侧边栏
-                    st.sidebar.info(f"已识别 {len(components)} 个不同的元器件")
-                    st.sidebar.success(f"识别到的关键列: 型号列({columns_info.get('mpn_column', '未识别')}), "
-                              f"名称列({columns_info.get('name_column', '未识别')}), "
-                              f"描述列({columns_info.get('description_column', '未识别')})")
-                    
-                    # 创建进度条
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    
-                    # 定义进度回调函数
-                    def update_progress(progress, text):
-                        progress_bar.progress(progress)
-                        status_text.text(text)
-                    
-                    # 批量查询
-                    with st.spinner("批量查询中，请稍候..."):
-                        batch_results = batch_get_alternative_parts(components, update_progress)
-                    
-                    # 完成进度
-                    progress_bar.progress(1.0)
-                    # 隐藏处理完成提示
-                    status_text.empty()
-                    
-                    # 保存到历史记录
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    st.session_state.search_history.append({
-                        "timestamp": timestamp,
-                        "part_number": f"批量查询({len(components)}个)",
-                        "batch_results": batch_results,
-                        "type": "batch"
-                    })
-                    
-                    # 直接显示详细的替代方案结果，不使用摘要表格
-                    st.subheader("批量查询结果")
-                    
-                    # 直接显示详细替代方案，不使用expander
-                    for mpn, result_info in batch_results.items():
-                        alts = result_info.get('alternatives', [])
-                        name = result_info.get('name', '')
-                        
-                        # 显示每个元器件的标题
-                        st.markdown(f"### {mpn} ({name})")
-                        
-                        # 使用与单个查询相同的display_search_results函数来显示结果
-                        if alts:
-                            display_search_results(mpn, alts)
-                        else:
-                            st.info("未找到替代方案")
-                        
-                        st.markdown("---")
-                    
-                    # 提供下载结果的选项
-                    st.subheader("📊 下载查询结果")
-                    
-                    # 将结果转换为可下载的Excel格式
-                    result_data = []
-                    
-                    # 遍历所有批量查询结果
-                    for mpn, result_info in batch_results.items():
-                        alts = result_info.get('alternatives', [])
-                        name = result_info.get('name', '')
-                        description = result_info.get('description', '')
-                        
-                        # 确保alts是列表类型
-                        if not isinstance(alts, list):
-                            alts = []
-                        
-                        # 如果没有替代方案，添加一个"未找到替代方案"的记录
-                        if not alts:
-                            result_data.append({
-                                "原元器件名称": name,
-                                "原型号": mpn,
-                                "原器件描述": description,
-                                "替代方案序号": "-",
-                                "替代型号": "未找到替代方案",
-                                "替代品牌": "-",
-                                "类别": "-",
-                                "封装": "-",
-                                "类型": "-",
-                                "参数": "-",
-                                "数据手册链接": "-"
-                            })
-                        else:
-                            # 添加找到的替代方案
-                            for i, alt in enumerate(alts, 1):
-                                # 确保alt是字典类型
-                                if not isinstance(alt, dict):
-                                    continue
-                                    
-                                result_data.append({
-                                    "原元器件名称": name,
-                                    "原型号": mpn,
-                                    "原器件描述": description,
-                                    "替代方案序号": i,
-                                    "替代型号": alt.get("model", ""),
-                                    "替代品牌": alt.get("brand", "未知品牌"),
-                                    "类别": alt.get("category", "未知类别"),
-                                    "封装": alt.get("package", "未知封装"),
-                                    "类型": alt.get("type", "未知"),
-                                    "参数": alt.get("parameters", ""),
-                                    "数据手册链接": alt.get("datasheet", "")
-                                })
-                    
-                    # 当有结果数据时，生成并提供下载
-                    if result_data:
-                        # 创建DataFrame
-                        df_results = pd.DataFrame(result_data)
-                        
-                        # 添加两种下载格式选项
-                        col1, col2 = st.columns(2)
-                        
-                        # 创建Excel文件
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as excel_file:
-                            with pd.ExcelWriter(excel_file.name, engine='openpyxl') as writer:
-                                df_results.to_excel(writer, sheet_name='替代方案查询结果', index=False)
-                            
-                            # 读取生成的Excel文件
-                            with open(excel_file.name, 'rb') as f:
-                                excel_data = f.read()
-                        
-                        # 创建CSV文件
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as csv_file:
-                            df_results.to_csv(csv_file.name, index=False, encoding='utf-8-sig')  # 使用带BOM的UTF-8编码，Excel可以正确识别中文
-                            
-                            # 读取生成的CSV文件
-                            with open(csv_file.name, 'rb') as f:
-                                csv_data = f.read()
-                        
-                        # 显示两个下载按钮
-                        with col1:
-                            st.download_button(
-                                label="📥 下载为Excel文件 (.xlsx)",
-                                data=excel_data,
-                                file_name=f"元器件替代方案查询结果_{timestamp.replace(':', '-')}.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                use_container_width=True
-                            )
-                        
-                        with col2:
-                            st.download_button(
-                                label="📥 下载为CSV文件 (.csv)",
-                                data=csv_data,
-                                file_name=f"元器件替代方案查询结果_{timestamp.replace(':', '-')}.csv",
-                                mime="text/csv",
-                                use_container_width=True
-                            )
-                    else:
-                        st.warning("⚠️ 没有查询到任何替代方案，无法生成下载文件")
+                job = get_job_manager().submit(uploaded_file.name, uploaded_file.getvalue(), **_batch_job_options())
+                _select_batch_job(job["id"])
+                if job["status"] == DONE:
+                    st.info("该BOM文件已查询过，直接显示已有结果；如需重新查询请点击结果上方的\"重新运行\"")
         else:
             # 空白展示区，不显示任何提示或装饰
             pass
+        
+        # 显示当前批量任务的进度或结果（不依赖是否重新上传文件）
+        job_id = st.session_state.get("batch_job_id") or st.query_params.get("job")
+        if job_id:
+            # 通过网址打开的任务同样归入当前会话的任务列表
+            _select_batch_job(job_id)
+            render_batch_job(job_id)
 
     # 在此处添加历史查询功能
     if 'search_history' not in st.session_state:
@@ -884,6 +744,8 @@ def render_ui(get_alternative_parts_func):
     
     # 将历史查询记录移动到侧边栏中
     with st.sidebar:
+        render_batch_job_list()
+        
         st.title("历史查询记录")
         
         # 历史记录标题和清除按钮
@@ -942,24 +804,7 @@ def render_ui(get_alternative_parts_func):
             
             batch_results = history_item.get('batch_results', {})
             
-            # 直接显示详细的替代方案结果，不使用摘要表格
-            st.subheader("批量查询结果")
-            
-            # 直接显示详细替代方案，不使用expander
-            for mpn, result_info in batch_results.items():
-                alts = result_info.get('alternatives', [])
-                name = result_info.get('name', '')
-                
-                # 显示每个元器件的标题
-                st.markdown(f"### {mpn} ({name})")
-                
-                # 使用与单个查询相同的display_search_results函数来显示结果
-                if alts:
-                    display_search_results(mpn, alts)
-                else:
-                    st.info("未找到替代方案")
-                
-                st.markdown("---")
+            display_batch_results(batch_results, key_prefix="history")
         else:
             # 单个查询结果显示
             st.subheader(f"历史查询结果: {history_item['part_number']}")
@@ -975,72 +820,386 @@ def render_ui(get_alternative_parts_func):
             del st.session_state.selected_history
             st.rerun()
 
+    # 运行日志面板放在侧边栏最后，本次运行中产生的事件都能显示出来
+    with st.sidebar:
+        render_event_log_panel()
+
     # 添加页脚信息 - 降低显示度
     st.markdown("---")
     st.markdown('<p class="footer-text">本工具基于DeepSeek大语言模型和Octopart元件库，提供元器件替代参考</p>', unsafe_allow_html=True)
 
+# 聊天流式输出的刷新间隔：满足任一条件即刷新
+CHAT_RENDER_INTERVAL = 0.1      # 秒
+CHAT_RENDER_MIN_CHARS = 200     # 新增字符数
+
+class ThrottledMarkdown:
+    """按时间和字数间隔刷新的流式 Markdown 渲染器
+    
+    每个 token 都调用 markdown() 会反复重新解析并发送整段回答，总开销与回答长度的平方成正比；
+    按间隔刷新后，刷新次数只与耗时和长度成线性关系。
+    """
+    
+    def __init__(self, container, interval=CHAT_RENDER_INTERVAL, min_chars=CHAT_RENDER_MIN_CHARS):
+        self.container = container
+        self.interval = interval
+        self.min_chars = min_chars
+        self.parts = []
+        self.length = 0
+        self.flushed_length = 0
+        self.flush_count = 0
+        self.last_flush = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+    
+    def append(self, text):
+        if not text:
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.parts.append(text)
+        self.length += len(text)
+        now = time.perf_counter()
+        if now - self.last_flush >= self.interval or self.length - self.flushed_length >= self.min_chars:
+            self._flush("▌")
+    
+    def finish(self):
+        """显示完整回答（不带光标），返回回答全文"""
+        text = self._flush("")
+        self.finished_at = time.perf_counter()
+        return text
+    
+    def latency(self, started):
+        """从发出请求到回答完整显示的耗时统计"""
+        finished = self.finished_at or time.perf_counter()
+        return {
+            "first_token": (self.first_token_at - started) if self.first_token_at else None,
+            "total": finished - started,
+            "chars": self.length,
+            "renders": self.flush_count,
+        }
+    
+    def _flush(self, cursor):
+        text = "".join(self.parts)
+        self.parts = [text]
+        self.container.markdown(text + cursor)
+        self.flushed_length = self.length
+        self.flush_count += 1
+        self.last_flush = time.perf_counter()
+        return text
+
+def _chunk_text(chunk):
+    """取出流式响应块中的文本；chat_with_expert 出错时返回的是纯字符串"""
+    if isinstance(chunk, str):
+        return chunk
+    if not getattr(chunk, "choices", None):
+        return ""
+    delta = getattr(chunk.choices[0], "delta", None)
+    return getattr(delta, "content", None) or ""
+
+def _format_latency(latency):
+    first_token = latency.get("first_token")
+    first_token_text = f"首字 {first_token:.2f}s · " if first_token is not None else ""
+    return f"⏱ {first_token_text}总耗时 {latency['total']:.2f}s · {latency['chars']} 字 · 刷新 {latency['renders']} 次"
+
+# 运行日志面板中可选的最低级别
+EVENT_LOG_LEVEL_OPTIONS = {"全部": "debug", "信息及以上": "info", "警告及以上": "warning", "仅错误": "error"}
+
+def render_event_log_panel():
+    """在一个可折叠面板中显示后端运行事件，调试模式下可查看原始响应等附带数据"""
+    if "debug_mode" not in st.session_state:
+        st.session_state.debug_mode = event_log.DEBUG_BY_DEFAULT
+    st.checkbox("调试模式", key="debug_mode", help="记录 API 原始响应和错误堆栈，便于排查问题")
+    
+    log = event_log.get_event_log()
+    with st.expander(f"运行日志（{len(log)}）", expanded=False):
+        level_label = st.selectbox("显示级别", list(EVENT_LOG_LEVEL_OPTIONS), index=2, key="event_log_level")
+        entries = log.entries(EVENT_LOG_LEVEL_OPTIONS[level_label])
+        if not entries:
+            st.caption("暂无记录")
+        _render_event_entries(entries)
+        if entries and st.button("清空日志", key="clear_event_log"):
+            log.clear()
+            st.rerun()
+
+EVENT_LOG_ICONS = {"debug": "🔧", "info": "ℹ️", "success": "✅", "warning": "⚠️", "error": "❌"}
+
+def _render_event_entries(entries):
+    for entry in entries:
+        timestamp = datetime.fromtimestamp(entry["time"]).strftime("%H:%M:%S")
+        st.markdown(f"{EVENT_LOG_ICONS[entry['level']]} `{timestamp}` {entry['message']}")
+        payload = entry["payload"]
+        if payload is None:
+            continue
+        if isinstance(payload, str):
+            st.code(payload, language="text")
+        else:
+            st.json(payload, expanded=False)
+
+# 批量结果每页显示的元器件数选项
+BATCH_PAGE_SIZES = [5, 10, 20, 50]
+
+# 批量查询结果显示，批量查询页面和历史记录共用
+def display_batch_results(batch_results, key_prefix="batch"):
+    """紧凑显示批量查询结果：一张可排序、可筛选的汇总表 + 分页的方案卡片
+    
+    无论 BOM 有多少个元器件，每次页面运行只渲染一张表格和一页卡片。
+    
+    Args:
+        batch_results: batch_get_alternative_parts 返回的结果字典
+        key_prefix: 控件 key 前缀，同一页面显示多份结果时用于区分
+    """
+    st.subheader("批量查询结果")
+    
+    summary = [_summarize_batch_result(mpn, result_info) for mpn, result_info in batch_results.items()]
+    
+    # 筛选条件
+    filter_col, status_col = st.columns([3, 2])
+    with filter_col:
+        keyword = st.text_input("筛选型号/名称/替代型号", key=f"{key_prefix}_filter",
+                                placeholder="输入关键字筛选").strip().lower()
+    with status_col:
+        status = st.selectbox("结果类型", ["全部", "含国产方案", "无国产方案", "未找到替代方案"],
+                              key=f"{key_prefix}_status")
+    
+    rows = [row for row in summary if _match_batch_summary(row, batch_results[row["原型号"]], keyword, status)]
+    st.caption(f"共 {len(summary)} 个型号，符合条件 {len(rows)} 个（点击表头可排序）")
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+    
+    if not rows:
+        return
+    
+    # 分页显示详细方案卡片
+    size_col, page_col = st.columns([1, 1])
+    with size_col:
+        page_size = st.selectbox("每页显示", BATCH_PAGE_SIZES, index=1, key=f"{key_prefix}_page_size")
+    page_count = (len(rows) + page_size - 1) // page_size
+    with page_col:
+        page = st.number_input(f"页码（共 {page_count} 页）", min_value=1, max_value=page_count, value=1, step=1,
+                               key=f"{key_prefix}_page")
+    page = min(page, page_count)
+    
+    # 样式只需注入一次
+    _render_result_styles()
+    for row in rows[(page - 1) * page_size:page * page_size]:
+        mpn = row["原型号"]
+        result_info = batch_results[mpn]
+        alts = result_info.get('alternatives', [])
+        
+        # 显示每个元器件的标题
+        st.markdown(f"### {mpn} ({result_info.get('name', '')})")
+        
+        if result_info.get('alias_of'):
+            # 同一器件的其他写法，结果与首次出现的型号相同，不重复显示
+            st.caption(f"与 {result_info['alias_of']} 为同一器件，替代方案相同")
+        elif alts:
+            display_search_results(mpn, alts, include_styles=False)
+        else:
+            st.info("未找到替代方案")
+        
+        st.markdown("---")
+
+def _batch_alternatives(result_info):
+    alts = result_info.get('alternatives', [])
+    if not isinstance(alts, list):
+        return []
+    return [alt for alt in alts if isinstance(alt, dict)]
+
+def _summarize_batch_result(mpn, result_info):
+    """批量结果汇总表中的一行"""
+    alts = _batch_alternatives(result_info)
+    first = alts[0] if alts else {}
+    return {
+        "原型号": mpn,
+        "名称": result_info.get('name', ''),
+        "替代方案数": len(alts),
+        "国产方案数": sum(1 for alt in alts if alt.get('type') == "国产"),
+        "首选替代型号": first.get('model', ''),
+        "首选品牌": first.get('brand', ''),
+        "Pin兼容": "是" if any(alt.get('pinToPin') for alt in alts) else "否",
+        "备注": f"同 {result_info['alias_of']}" if result_info.get('alias_of') else result_info.get('error', ''),
+    }
+
+def _match_batch_summary(row, result_info, keyword, status):
+    """判断汇总行是否符合筛选条件"""
+    if status == "含国产方案" and row["国产方案数"] == 0:
+        return False
+    if status == "无国产方案" and (row["国产方案数"] > 0 or row["替代方案数"] == 0):
+        return False
+    if status == "未找到替代方案" and row["替代方案数"] > 0:
+        return False
+    if not keyword:
+        return True
+    haystack = [row["原型号"], row["名称"]] + [str(alt.get('model', '')) for alt in _batch_alternatives(result_info)]
+    return any(keyword in str(value).lower() for value in haystack)
+
+# 批量任务进行中时页面刷新进度的间隔（秒）
+BATCH_JOB_POLL_INTERVAL = 2.0
+
+def render_batch_job(job_id):
+    """显示后台批量任务：进行中时定时刷新进度，完成后显示结果和下载区"""
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    if job is None:
+        st.warning("批量查询任务不存在或已过期，请重新上传BOM文件")
+        st.session_state.pop("batch_job_id", None)
+        st.query_params.pop("job", None)
+        if job_id in st.session_state.get("batch_job_ids", []):
+            st.session_state.batch_job_ids.remove(job_id)
+        return
+    
+    if job["status"] in ACTIVE_STATUSES:
+        _render_batch_job_progress(job_id)
+        return
+    
+    if job["status"] != DONE:
+        st.error(f"⚠️ {job['message']}（{job['filename']}）")
+        if st.button("继续查询（已完成的元器件不会重复查询）", key=f"retry_job_{job_id}"):
+            manager.retry(job_id, **_batch_job_options())
+            st.rerun()
+        _render_batch_job_log(job_id)
+        return
+    
+    # 任务每次完成后，每个会话只载入一次结果并记入历史记录
+    current_batch = st.session_state.get('current_batch')
+    if not current_batch or current_batch.get('job') != (job_id, job["finished"]):
+        batch_results = manager.load_result(job_id)
+        if batch_results is None:
+            st.warning("该任务的结果文件已丢失，请重新运行")
+            if st.button("重新运行该任务", key=f"retry_job_{job_id}"):
+                manager.retry(job_id, **_batch_job_options())
+                st.rerun()
+            return
+        timestamp = datetime.fromtimestamp(job["finished"] or job["updated"]).strftime("%Y-%m-%d %H:%M:%S")
+        st.session_state.setdefault('search_history', []).append({
+            "timestamp": timestamp,
+            "part_number": f"批量查询({job['part_count']}个)",
+            "batch_results": batch_results,
+            "type": "batch"
+        })
+        # 保存当前批次结果，页面重新运行（如点击生成/下载按钮）后仍可查看和导出
+        current_batch = {
+            "job": (job_id, job["finished"]),
+            "timestamp": timestamp,
+            "results": batch_results,
+        }
+        st.session_state.current_batch = current_batch
+        st.session_state.batch_exports = {}
+    
+    columns_info = job.get("columns_info") or {}
+    st.caption(f"{job['filename']} · {job['message']} · 型号列({columns_info.get('mpn_column', '未识别')}), "
+               f"名称列({columns_info.get('name_column', '未识别')}), 描述列({columns_info.get('description_column', '未识别')})")
+    col1, col2 = st.columns(2)
+    with col1:
+        if job.get("failed_count") and st.button(f"重新查询失败的元器件（{job['failed_count']} 个）",
+                                                 key=f"retry_failed_{job_id}"):
+            manager.retry(job_id, retry_failed=True, **_batch_job_options())
+            st.rerun()
+    with col2:
+        # 修改提示词或模型后需要丢弃已有结果和断点，全部重新查询
+        if st.button("重新运行（全部重新查询）", key=f"rerun_job_{job_id}"):
+            manager.retry(job_id, force=True, **_batch_job_options())
+            st.rerun()
+    _render_batch_job_log(job_id)
+    display_batch_results(current_batch['results'])
+    render_batch_export(current_batch)
+
+@st.fragment(run_every=BATCH_JOB_POLL_INTERVAL)
+def _render_batch_job_progress(job_id):
+    """任务进行中时只刷新进度区域，任务结束后重新运行整个页面以显示结果"""
+    job = get_job_manager().get(job_id)
+    if job is None or job["status"] not in ACTIVE_STATUSES:
+        st.rerun()
+    
+    st.progress(job["progress"])
+    elapsed = int(time.time() - job["created"])
+    st.text(f"[{STATUS_LABELS[job['status']]}] {job['message']}")
+    st.caption(f"{job['filename']} · 已用时 {elapsed // 60} 分 {elapsed % 60} 秒 · "
+               "查询在后台进行，可以关闭页面，稍后回来查看结果")
+    _render_batch_job_log(job_id)
+
+def _batch_job_options():
+    """提交后台任务时沿用的当前会话设置"""
+    return {
+        "use_dummy_data": bool(st.session_state.get("use_dummy_data", False)),
+        "debug": event_log.debug_enabled(),
+    }
+
+def _select_batch_job(job_id):
+    """把任务设为当前任务并记入本会话的任务列表；任务 ID 写入网址，刷新页面后仍能找到该任务"""
+    st.session_state.batch_job_id = job_id
+    job_ids = st.session_state.setdefault("batch_job_ids", [])
+    if job_id not in job_ids:
+        job_ids.append(job_id)
+    st.query_params["job"] = job_id
+
+def _render_batch_job_log(job_id):
+    """显示任务自己的运行事件（后台任务没有页面会话，事件不会出现在侧边栏的运行日志中）"""
+    log = get_job_manager().get_log(job_id)
+    with st.expander(f"任务运行日志（{len(log)}）", expanded=False):
+        entries = log.entries()
+        if not entries:
+            st.caption("暂无记录")
+        _render_event_entries(entries)
+
+def render_batch_job_list(limit=5):
+    """侧边栏中本会话提交或打开过的批量任务，可切换查看"""
+    manager = get_job_manager()
+    job_ids = st.session_state.get("batch_job_ids", [])
+    jobs = [job for job in (manager.get(job_id) for job_id in reversed(job_ids)) if job is not None][:limit]
+    if not jobs:
+        return
+    st.subheader("批量查询任务")
+    for job in jobs:
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            progress = f" {job['progress']:.0%}" if job["status"] in ACTIVE_STATUSES else ""
+            st.caption(f"{job['filename']} · {STATUS_LABELS.get(job['status'], job['status'])}{progress}")
+        with col2:
+            if st.button("查看", key=f"view_job_{job['id']}"):
+                _select_batch_job(job["id"])
+                st.rerun()
+
+def render_batch_export(batch):
+    """批量查询结果下载区：用户选择格式后才在内存中生成文件，生成结果按批次缓存，页面重新运行时不会重复生成"""
+    # 提供下载结果的选项
+    st.subheader("📊 下载查询结果")
+    
+    batch_results = batch['results']
+    if not has_export_rows(batch_results):
+        st.warning("⚠️ 没有查询到任何替代方案，无法生成下载文件")
+        return
+    
+    exports = st.session_state.setdefault('batch_exports', {})
+    file_stem = f"元器件替代方案查询结果_{batch['timestamp'].replace(':', '-')}"
+    
+    # 每种格式一列：先生成，再下载
+    cols = st.columns(len(EXPORT_FORMATS))
+    for col, (fmt, info) in zip(cols, EXPORT_FORMATS.items()):
+        with col:
+            cache_key = (batch['timestamp'], fmt)
+            data = exports.get(cache_key)
+            if data is None and st.button(f"生成{info['label']}", key=f"export_{fmt}", use_container_width=True):
+                with st.spinner(f"正在生成{info['label']}..."):
+                    data = export_results(batch_results, fmt)
+                exports[cache_key] = data
+            if data is not None:
+                st.download_button(
+                    label=f"📥 下载为{info['label']}",
+                    data=data,
+                    file_name=file_stem + info['suffix'],
+                    mime=info['mime'],
+                    key=f"download_{fmt}",
+                    use_container_width=True
+                )
+
 # 抽取显示结果的函数，以便重复使用
-def display_search_results(part_number, recommendations):
+def display_search_results(part_number, recommendations, include_styles=True):
     # 结果区域添加容器
     
     if recommendations:
-        # 添加CSS样式 - 调整价格对齐和Pin兼容突出显示
-        st.markdown("""
-        <style>
-            div.card-wrapper {
-                display: flex;
-                flex-direction: row;
-                overflow-x: auto;
-                gap: 15px;
-                padding-bottom: 10px;
-            }
-            .price-value {
-                color: #e53935;
-                font-weight: bold;
-                min-width: 80px; /* 设置最小宽度确保对齐 */
-                display: inline-block; /* 使宽度设置生效 */
-            }
-            /* Pin兼容显示样式 - 移除背景色 */
-            .pin-compatible {
-                border: 1px solid #ccc !important;
-                text-align: left !important; /* 左对齐 */
-            }
-            .non-pin-compatible {
-                border: 1px solid #ccc !important;
-                text-align: left !important; /* 左对齐 */
-            }
-            /* 调整信息行样式确保对齐 */
-            .info-row {
-                display: flex;
-                margin-bottom: 0px;
-            }
-            .info-label {
-                width: 80px;
-                font-weight: 500;
-            }
-            .info-value {
-                flex: 1;
-            }
-            /* 参数内容样式，与其他信息对齐 */
-            .param-content {
-                padding-left: 80px;
-                margin-bottom: 0px;
-                word-wrap: break-word;
-            }
-            /* 修复间距问题 */
-            .element-container {
-                margin-top: 0 !important;
-                margin-bottom: 0 !important;
-            }
-            /* 标签专用样式 */
-            .type-label {
-                margin: 0 !important;
-                padding: 2px 8px !important;
-                border-radius: 4px !important;
-                display: inline-block !important;
-            }
-        </style>
-        """, unsafe_allow_html=True)
+        # 批量结果分页显示时样式已统一注入一次
+        if include_styles:
+            _render_result_styles()
         
         # 创建列容器来强制横向布局
         cols = st.columns(len(recommendations))
@@ -1048,83 +1207,174 @@ def display_search_results(part_number, recommendations):
         # 在每个列中放置一个卡片
         for i, (col, rec) in enumerate(zip(cols, recommendations), 1):
             with col:
-                # 卡片标题栏
-                st.markdown(f"### 方案 {i}")
-                
-                # 型号名称 - 去掉后面的类别
-                st.markdown(f"### {rec.get('model', '未知型号')}")
-                
-                # 品牌显示栏 - 移除背景色
-                st.markdown(f"""
-                <div style='border: 1px solid #ccc; padding: 8px 16px; border-radius: 4px; margin-bottom: 10px;'>
-                    {rec.get('brand', '未知品牌')}
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # Pin-to-Pin兼容性显示 - 使用简单的边框样式而非彩色背景
-                pin_to_pin = rec.get('pinToPin', False)
-                pin_class = "pin-compatible" if pin_to_pin else "non-pin-compatible"
-                pin_text = "Pin兼容" if pin_to_pin else "非Pin兼容"
-                
-                st.markdown(f"""
-                <div class="{pin_class}" style='padding: 8px 16px; border-radius: 4px; margin-bottom: 10px;'>
-                    {pin_text}
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # 国产/进口标签 - 修改为使用专用样式类，并直接与信息表连接
-                type_display = ""
-                if rec['type'] == "国产":
-                    type_display = "<span class='type-label' style='background-color: #ef5350; color: white;'>国产</span>"
-                else:
-                    type_display = "<span class='type-label' style='background-color: #42a5f5; color: white;'>进口</span>"
-                
-                # 参数信息表格 - 直接与标签连接，没有间隔
-                st.markdown(f"""
-                <div style="margin: 0; padding: 0;">
-                {type_display}
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # 使用统一布局确保对齐
-                st.markdown("""
-                <div class="info-row" style="margin-top: 2px;">
-                    <div class="info-label">类型：</div>
-                    <div class="info-value">{}</div>
-                </div>
-                <div class="info-row">
-                    <div class="info-label">封装：</div>
-                    <div class="info-value">{}</div>
-                </div>
-                <div class="info-row">
-                    <div class="info-label">价格：</div>
-                    <div class="info-value price-value">{}</div>
-                </div>
-                """.format(
-                    rec.get('category', 'MCU'), 
-                    rec.get('package', 'LQFP48'),
-                    rec.get('price', '未知')
-                ), unsafe_allow_html=True)
-                
-                # 参数详情 - 调整为与其他信息对齐的样式
-                st.markdown("""
-                <div class="info-row">
-                    <div class="info-label">参数：</div>
-                    <div class="info-value">{}</div>
-                </div>
-                """.format(rec.get('parameters', 'CPU内核: ARM Cortex-M3, 主频: 72MHz, Flash: 64KB, RAM: 20KB, IO: 37')), unsafe_allow_html=True)
-                
-                # 供货周期
-                st.markdown("""
-                <div class="info-row">
-                    <div class="info-label">供货周期：</div>
-                    <div class="info-value">{}</div>
-                </div>
-                """.format(rec.get('leadTime', '3-5周')), unsafe_allow_html=True)
-                
-                # 数据手册链接
-                st.markdown(f"[参考信息]({rec.get('datasheet', 'https://example.com')})")
-                
-                st.markdown("</div>", unsafe_allow_html=True)
+                _render_recommendation_card(i, rec)
     else:
-        st.info("未找到替代方案")
\ No newline at end of file
+        st.info("未找到替代方案")
+
+def display_streaming_results(part_number, recommendation_stream, max_results=3):
+    """边接收边显示替代方案，每收到一个方案就渲染对应的卡片
+    
+    Args:
+        part_number: 查询的元器件型号
+        recommendation_stream: 逐个产生推荐方案的可迭代对象
+        max_results: 最多显示的方案数，用于预先创建列布局
+        
+    Returns:
+        收到的推荐方案列表
+    """
+    _render_result_styles()
+    
+    # 预先创建列容器，方案到达后直接填入，保持与一次性显示相同的横向布局
+    placeholder = st.empty()
+    cols = st.columns(max_results)
+    
+    recommendations = []
+    for rec in recommendation_stream:
+        if len(recommendations) >= max_results:
+            break
+        recommendations.append(rec)
+        with cols[len(recommendations) - 1]:
+            _render_recommendation_card(len(recommendations), rec)
+    
+    if not recommendations:
+        placeholder.info("未找到替代方案")
+    return recommendations
+
+def _render_result_styles():
+    # 添加CSS样式 - 调整价格对齐和Pin兼容突出显示
+    st.markdown("""
+    <style>
+        div.card-wrapper {
+            display: flex;
+            flex-direction: row;
+            overflow-x: auto;
+            gap: 15px;
+            padding-bottom: 10px;
+        }
+        .price-value {
+            color: #e53935;
+            font-weight: bold;
+            min-width: 80px; /* 设置最小宽度确保对齐 */
+            display: inline-block; /* 使宽度设置生效 */
+        }
+        /* Pin兼容显示样式 - 移除背景色 */
+        .pin-compatible {
+            border: 1px solid #ccc !important;
+            text-align: left !important; /* 左对齐 */
+        }
+        .non-pin-compatible {
+            border: 1px solid #ccc !important;
+            text-align: left !important; /* 左对齐 */
+        }
+        /* 调整信息行样式确保对齐 */
+        .info-row {
+            display: flex;
+            margin-bottom: 0px;
+        }
+        .info-label {
+            width: 80px;
+            font-weight: 500;
+        }
+        .info-value {
+            flex: 1;
+        }
+        /* 参数内容样式，与其他信息对齐 */
+        .param-content {
+            padding-left: 80px;
+            margin-bottom: 0px;
+            word-wrap: break-word;
+        }
+        /* 修复间距问题 */
+        .element-container {
+            margin-top: 0 !important;
+            margin-bottom: 0 !important;
+        }
+        /* 标签专用样式 */
+        .type-label {
+            margin: 0 !important;
+            padding: 2px 8px !important;
+            border-radius: 4px !important;
+            display: inline-block !important;
+        }
+    </style>
+    """, unsafe_allow_html=True)
+
+def _render_recommendation_card(i, rec):
+    # 卡片标题栏
+    st.markdown(f"### 方案 {i}")
+
+    # 型号名称 - 去掉后面的类别
+    st.markdown(f"### {rec.get('model', '未知型号')}")
+
+    # 品牌显示栏 - 移除背景色
+    st.markdown(f"""
+    <div style='border: 1px solid #ccc; padding: 8px 16px; border-radius: 4px; margin-bottom: 10px;'>
+        {rec.get('brand', '未知品牌')}
+    </div>
+    """, unsafe_allow_html=True)
+
+    # Pin-to-Pin兼容性显示 - 使用简单的边框样式而非彩色背景
+    pin_to_pin = rec.get('pinToPin', False)
+    pin_class = "pin-compatible" if pin_to_pin else "non-pin-compatible"
+    pin_text = "Pin兼容" if pin_to_pin else "非Pin兼容"
+
+    st.markdown(f"""
+    <div class="{pin_class}" style='padding: 8px 16px; border-radius: 4px; margin-bottom: 10px;'>
+        {pin_text}
+    </div>
+    """, unsafe_allow_html=True)
+
+    # 国产/进口标签 - 修改为使用专用样式类，并直接与信息表连接
+    type_display = ""
+    if rec['type'] == "国产":
+        type_display = "<span class='type-label' style='background-color: #ef5350; color: white;'>国产</span>"
+    else:
+        type_display = "<span class='type-label' style='background-color: #42a5f5; color: white;'>进口</span>"
+
+    # 参数信息表格 - 直接与标签连接，没有间隔
+    st.markdown(f"""
+    <div style="margin: 0; padding: 0;">
+    {type_display}
+    </div>
+    """, unsafe_allow_html=True)
+
+    # 使用统一布局确保对齐
+    st.markdown("""
+    <div class="info-row" style="margin-top: 2px;">
+        <div class="info-label">类型：</div>
+        <div class="info-value">{}</div>
+    </div>
+    <div class="info-row">
+        <div class="info-label">封装：</div>
+        <div class="info-value">{}</div>
+    </div>
+    <div class="info-row">
+        <div class="info-label">价格：</div>
+        <div class="info-value price-value">{}</div>
+    </div>
+    """.format(
+        rec.get('category', 'MCU'), 
+        rec.get('package', 'LQFP48'),
+        rec.get('price', '未知')
+    ), unsafe_allow_html=True)
+
+    # 参数详情 - 调整为与其他信息对齐的样式
+    st.markdown("""
+    <div class="info-row">
+        <div class="info-label">参数：</div>
+        <div class="info-value">{}</div>
+    </div>
+    """.format(rec.get('parameters', 'CPU内核: ARM Cortex-M3, 主频: 72MHz, Flash: 64KB, RAM: 20KB, IO: 37')), unsafe_allow_html=True)
+
+    # 供货周期
+    st.markdown("""
+    <div class="info-row">
+        <div class="info-label">供货周期：</div>
+        <div class="info-value">{}</div>
+    </div>
+    """.format(rec.get('leadTime', '3-5周')), unsafe_allow_html=True)
+
+    # 数据手册链接
+    st.markdown(f"[参考信息]({rec.get('datasheet', 'https://example.com')})")
+
+    st.markdown("</div>", unsafe_allow_html=True)
@@ -1,14 +1,72 @@
 """Resources for making Nexar requests."""
 import requests
 import base64
+import hashlib
 import json
+import logging
+import os
+import tempfile
+import threading
 import time
 from typing import Dict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
 
 NEXAR_URL = "https://api.nexar.com/graphql"
 PROD_TOKEN_URL = "https://identity.nexar.com/connect/token"
 
-def get_token(client_id, client_secret):
+# Transport settings, overridable from the environment
+NEXAR_POOL_SIZE = int(os.getenv("NEXAR_POOL_SIZE", "10"))
+NEXAR_CONNECT_TIMEOUT = float(os.getenv("NEXAR_CONNECT_TIMEOUT", "5"))
+NEXAR_READ_TIMEOUT = float(os.getenv("NEXAR_READ_TIMEOUT", "30"))
+NEXAR_MAX_RETRIES = int(os.getenv("NEXAR_MAX_RETRIES", "3"))
+NEXAR_BACKOFF_FACTOR = float(os.getenv("NEXAR_BACKOFF_FACTOR", "0.5"))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Token cache settings
+NEXAR_TOKEN_CACHE_DIR = os.getenv(
+    "NEXAR_TOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+)
+TOKEN_REFRESH_MARGIN = int(os.getenv("NEXAR_TOKEN_REFRESH_MARGIN", "300"))
+# A token closer than this to expiry is not used at all; callers wait for the refresh
+TOKEN_MIN_VALIDITY = 30
+
+class NexarQueryError(Exception):
+    """The Nexar GraphQL endpoint answered with errors instead of data."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(str(error.get("message", error)) for error in errors) or "Nexar query failed")
+
+def create_session(pool_size=None, max_retries=None, backoff_factor=None):
+    """Return a keep-alive session with a sized connection pool.
+
+    Requests failing with 429/5xx or connection errors are retried with
+    exponential backoff, honouring the Retry-After header when present.
+    """
+    pool_size = pool_size or NEXAR_POOL_SIZE
+    retry = Retry(
+        total=NEXAR_MAX_RETRIES if max_retries is None else max_retries,
+        backoff_factor=NEXAR_BACKOFF_FACTOR if backoff_factor is None else backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        # GraphQL queries and token requests are safe to repeat
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def default_timeout():
+    """Return the (connect, read) timeout tuple used for Nexar requests."""
+    return (NEXAR_CONNECT_TIMEOUT, NEXAR_READ_TIMEOUT)
+
+def get_token(client_id, client_secret, session=None, timeout=None):
     """Return the Nexar token from the client_id and client_secret provided."""
 
     if not client_id or not client_secret:
@@ -16,7 +74,7 @@ def get_token(client_id, client_secret):
 
     token = {}
     try:
-        token = requests.post(
+        token = (session or requests).post(
             url=PROD_TOKEN_URL,
             data={
                 "grant_type": "client_credentials",
@@ -24,6 +82,7 @@ def get_token(client_id, client_secret):
                 "client_secret": client_secret
             },
             allow_redirects=False,
+            timeout=timeout or default_timeout(),
         ).json()
 
     except Exception:
@@ -35,39 +94,164 @@ def decodeJWT(token):
         (base64.urlsafe_b64decode(token.split(".")[1] + "==")).decode("utf-8")
     )
 
+class TokenManager:
+    """Keep a Nexar access token valid without blocking queries.
+
+    The token is cached on disk (keyed by client id) and reused across
+    restarts until it expires. Refreshes are single-flight: one caller
+    fetches a new token while the others wait for it. Once the token is
+    within the refresh margin it is renewed in the background, so queries
+    only block when no usable token exists at all.
+    """
+
+    def __init__(self, client_id, client_secret, session=None, timeout=None,
+                 cache_dir=None, refresh_margin=None) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = session
+        self.timeout = timeout
+        self.cache_dir = cache_dir or NEXAR_TOKEN_CACHE_DIR
+        self.refresh_margin = TOKEN_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+
+        self.access_token = None
+        self.exp = 0
+        self._refresh_lock = threading.Lock()
+        self._background_refresh = None
+        self._timer = None
+
+        self._load()
+        self._schedule_refresh()
+
+    @property
+    def cache_path(self):
+        key = hashlib.sha256(str(self.client_id).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"nexar_token_{key}.json")
+
+    def _remaining(self):
+        return self.exp - time.time()
+
+    def get_access_token(self):
+        """Return a valid access token, refreshing it only when necessary."""
+        remaining = self._remaining()
+        if self.access_token and remaining > self.refresh_margin:
+            return self.access_token
+        if self.access_token and remaining > TOKEN_MIN_VALIDITY:
+            # Still usable: renew in the background and answer immediately
+            self.refresh_in_background()
+            return self.access_token
+        return self.refresh()
+
+    def refresh(self):
+        """Fetch a new token unless another caller already did (single-flight)."""
+        with self._refresh_lock:
+            if self.access_token and self._remaining() > self.refresh_margin:
+                return self.access_token
+            # Another process may have refreshed the cached token meanwhile
+            self._load()
+            if self.access_token and self._remaining() > self.refresh_margin:
+                return self.access_token
+
+            token = get_token(self.client_id, self.client_secret, session=self.session, timeout=self.timeout)
+            self._set(token.get('access_token'))
+            self._save()
+        self._schedule_refresh()
+        return self.access_token
+
+    def refresh_in_background(self):
+        """Start a refresh thread unless one is already running."""
+        thread = self._background_refresh
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target=self._refresh_quietly, name="nexar-token-refresh", daemon=True)
+        self._background_refresh = thread
+        thread.start()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            # The next query retries the refresh synchronously if needed
+            logger.warning("Nexar token refresh failed: %s", e)
+
+    def _schedule_refresh(self):
+        """Arm a timer that renews the token shortly before it enters the refresh margin."""
+        if self._timer is not None:
+            self._timer.cancel()
+        if not self.access_token:
+            return
+        delay = max(self._remaining() - self.refresh_margin, 0)
+        self._timer = threading.Timer(delay, self.refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _set(self, access_token):
+        if not access_token:
+            raise Exception("Nexar token response did not contain an access_token")
+        self.access_token = access_token
+        self.exp = decodeJWT(access_token).get('exp') or 0
+
+    def _load(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cached.get("client_id") != self.client_id:
+            return
+        exp = cached.get("exp") or 0
+        if cached.get("access_token") and exp > self.exp:
+            self.access_token = cached["access_token"]
+            self.exp = exp
+
+    def _save(self):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            # The token is a credential: keep the file private to this user
+            os.chmod(tmp_path, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"client_id": self.client_id, "access_token": self.access_token, "exp": self.exp}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning("Could not cache Nexar token: %s", e)
+
 class NexarClient:
-    def __init__(self, id, secret) -> None:
+    def __init__(self, id, secret, timeout=None, session=None, token_manager=None) -> None:
         self.id = id
         self.secret = secret
-        self.s = requests.session()
-        self.s.keep_alive = False
+        self.timeout = timeout or default_timeout()
+        self.s = session or create_session()
+
+        self.tokens = token_manager or TokenManager(id, secret, session=self.s, timeout=self.timeout)
+        if not self.tokens.access_token:
+            # Fetch the first token off the calling thread; the first query waits for it if needed
+            self.tokens.refresh_in_background()
 
-        self.token = get_token(id, secret)
-        self.s.headers.update({"token": self.token.get('access_token')})
-        self.exp = decodeJWT(self.token.get('access_token')).get('exp')
+    @property
+    def exp(self):
+        return self.tokens.exp
 
     def check_exp(self):
-        if (self.exp < time.time() + 300):
-            self.token = get_token(self.id, self.secret)
-            self.s.headers.update({"token": self.token.get('access_token')})
-            self.exp = decodeJWT(self.token.get('access_token')).get('exp')
+        """Return a valid access token (refreshed in the background near expiry)."""
+        return self.tokens.get_access_token()
 
     def get_query(self, query: str, variables: Dict) -> dict:
         """Return Nexar response for the query."""
         try:
-            self.check_exp()
+            access_token = self.check_exp()
             r = self.s.post(
                 NEXAR_URL,
                 json={"query": query, "variables": variables},
+                headers={"token": access_token},
+                timeout=self.timeout,
             )
 
         except Exception as e:
-            print(e)
-            raise Exception("Error while getting Nexar response")
+            logger.warning("Nexar request failed: %s", e)
+            raise Exception("Error while getting Nexar response") from e
 
         response = r.json()
         if ("errors" in response):
-            for error in response["errors"]: print(error["message"])
-            raise SystemExit
+            raise NexarQueryError(response["errors"])
 
-        return response["data"]
\ No newline at end of file
+        return response["data"]
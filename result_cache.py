@@ -0,0 +1,225 @@
+"""替代方案查询结果的两级缓存：进程内 LRU + 磁盘持久化存储"""
+import copy
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# 默认缓存目录为项目下的 cache/（运行时创建，不纳入版本控制）
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+DEFAULT_TTL = 3 * 24 * 3600            # 3 天，与旧版缓存的 expiry 一致
+DEFAULT_MEMORY_ENTRIES = 512           # 内存 LRU 最多保留的条目数
+DEFAULT_MAX_DISK_BYTES = 64 * 1024 * 1024  # 磁盘缓存总大小上限
+# 本缓存写入的文件名前缀；容量淘汰只处理带该前缀的文件，目录中的其他文件（旧版缓存、令牌等）不受影响
+FILE_PREFIX = "result_"
+
+
+def normalize_mpn(part_number):
+    """规范化元器件型号，用作缓存键：去除首尾及内部多余空白并统一为大写"""
+    return " ".join(str(part_number).split()).upper()
+
+
+class ResultCache:
+    """进程内 LRU 在前、磁盘 pickle 存储在后的两级缓存
+
+    磁盘文件沿用旧版缓存的格式：以 md5 命名的 .pkl 文件（加 FILE_PREFIX 前缀），
+    内容为 {part_number, data, timestamp, expiry}。
+    缓存键由 命名空间 + 提示词/模型版本 + 规范化型号 组成，
+    修改提示词或模型后只需更新版本号即可让旧缓存自然失效。
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL, version="",
+                 max_memory_entries=DEFAULT_MEMORY_ENTRIES, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.version = version
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self._disk_bytes = None  # 首次写入时再统计，避免导入时扫描目录
+
+    @classmethod
+    def from_env(cls, version=""):
+        """根据环境变量创建缓存实例
+
+        支持的环境变量：
+            BOM_CACHE_DIR: 磁盘缓存目录
+            BOM_CACHE_TTL: 缓存有效期（秒），0 表示禁用缓存
+            BOM_CACHE_MEMORY_ENTRIES: 内存 LRU 条目上限
+            BOM_CACHE_MAX_BYTES: 磁盘缓存总大小上限（字节）
+        """
+        return cls(
+            cache_dir=os.getenv("BOM_CACHE_DIR", DEFAULT_CACHE_DIR),
+            ttl=int(os.getenv("BOM_CACHE_TTL", DEFAULT_TTL)),
+            version=version,
+            max_memory_entries=int(os.getenv("BOM_CACHE_MEMORY_ENTRIES", DEFAULT_MEMORY_ENTRIES)),
+            max_disk_bytes=int(os.getenv("BOM_CACHE_MAX_BYTES", DEFAULT_MAX_DISK_BYTES)),
+        )
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def make_key(self, namespace, part_number):
+        raw = f"{namespace}|{self.version}|{normalize_mpn(part_number)}"
+        return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{FILE_PREFIX}{key}.pkl")
+
+    def get(self, namespace, part_number):
+        """读取缓存，未命中或已过期时返回 None；返回值为副本，可放心修改"""
+        if not self.enabled:
+            return None
+
+        key = self.make_key(namespace, part_number)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry["expiry"] > now:
+                    self._memory.move_to_end(key)
+                    return copy.deepcopy(entry["data"])
+                del self._memory[key]
+
+        entry = self._load_from_disk(key)
+        if entry is None:
+            return None
+        if entry.get("expiry", 0) <= now:
+            self._remove_from_disk(key)
+            return None
+
+        with self._lock:
+            self._remember(key, entry)
+        return copy.deepcopy(entry["data"])
+
+    def contains(self, namespace, part_number):
+        """判断是否有未过期的缓存，不读取磁盘文件内容，用于规划查询
+
+        磁盘条目按文件修改时间估算是否过期；结果以 get 为准。
+        """
+        if not self.enabled:
+            return False
+
+        key = self.make_key(namespace, part_number)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                return entry["expiry"] > now
+        try:
+            return os.path.getmtime(self._path(key)) + self.ttl > now
+        except OSError:
+            return False
+
+    def set(self, namespace, part_number, data):
+        """写入缓存（内存 + 磁盘）"""
+        if not self.enabled:
+            return
+
+        key = self.make_key(namespace, part_number)
+        now = time.time()
+        entry = {
+            "part_number": part_number,
+            "data": copy.deepcopy(data),
+            "timestamp": now,
+            "expiry": now + self.ttl,
+        }
+
+        with self._lock:
+            self._remember(key, entry)
+        self._save_to_disk(key, entry)
+
+    def clear(self):
+        """清空内存缓存（磁盘文件保留，按 TTL 自然过期）"""
+        with self._lock:
+            self._memory.clear()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _load_from_disk(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # 损坏的缓存文件直接丢弃
+            self._remove_from_disk(key)
+            return None
+        if not isinstance(entry, dict) or "data" not in entry:
+            return None
+        return entry
+
+    def _save_to_disk(self, key, entry):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            payload = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+            # 先写临时文件再原子替换，避免并发读到半个文件
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            path = self._path(key)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_usage()
+            else:
+                self._disk_bytes += len(payload) - old_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _remove_from_disk(self, key):
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def _list_disk_entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return entries
+        for name in names:
+            if not (name.startswith(FILE_PREFIX) and name.endswith(".pkl")):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_disk_usage(self):
+        return sum(size for _, size, _ in self._list_disk_entries())
+
+    def _evict_disk(self):
+        """按修改时间从旧到新删除文件，直到总大小降到上限的 90% 以下"""
+        entries = sorted(self._list_disk_entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_disk_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                continue
+        self._disk_bytes = total
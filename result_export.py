@@ -0,0 +1,103 @@
+"""批量查询结果导出：按需在内存中生成 Excel / CSV 文件，不落盘"""
+import csv
+import io
+
+# 导出表格的列，顺序即文件中的列顺序
+EXPORT_COLUMNS = [
+    "原元器件名称", "原型号", "原器件描述", "替代方案序号", "替代型号", "替代品牌",
+    "类别", "封装", "类型", "参数", "数据手册链接",
+]
+
+EXPORT_SHEET_NAME = "替代方案查询结果"
+
+# 支持的导出格式：扩展名、MIME 类型及按钮文字
+EXPORT_FORMATS = {
+    "xlsx": {
+        "suffix": ".xlsx",
+        "mime": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "label": "Excel文件 (.xlsx)",
+    },
+    "csv": {
+        "suffix": ".csv",
+        "mime": "text/csv",
+        "label": "CSV文件 (.csv)",
+    },
+}
+
+
+def iter_export_rows(batch_results):
+    """将批量查询结果逐行转换为导出记录（与 EXPORT_COLUMNS 对应的元组）"""
+    for mpn, result_info in batch_results.items():
+        alts = result_info.get('alternatives', [])
+        name = result_info.get('name', '')
+        description = result_info.get('description', '')
+
+        # 确保alts是列表类型
+        if not isinstance(alts, list):
+            alts = []
+
+        # 如果没有替代方案，添加一个"未找到替代方案"的记录
+        if not alts:
+            yield (name, mpn, description, "-", "未找到替代方案", "-", "-", "-", "-", "-", "-")
+            continue
+
+        for i, alt in enumerate(alts, 1):
+            # 确保alt是字典类型
+            if not isinstance(alt, dict):
+                continue
+            yield (
+                name, mpn, description, i,
+                alt.get("model", ""),
+                alt.get("brand", "未知品牌"),
+                alt.get("category", "未知类别"),
+                alt.get("package", "未知封装"),
+                alt.get("type", "未知"),
+                alt.get("parameters", ""),
+                alt.get("datasheet", ""),
+            )
+
+
+def has_export_rows(batch_results):
+    return next(iter_export_rows(batch_results), None) is not None
+
+
+def export_results(batch_results, fmt):
+    """生成指定格式的导出文件内容
+
+    Excel 使用 openpyxl 的 write_only 模式逐行写入，内存占用不随行数增长；
+    CSV 使用带 BOM 的 UTF-8 编码，Excel 可以正确识别中文。
+
+    Args:
+        batch_results: batch_get_alternative_parts 返回的结果字典
+        fmt: 导出格式，"xlsx" 或 "csv"
+
+    Returns:
+        文件内容（bytes）
+    """
+    if fmt == "xlsx":
+        return _export_xlsx(batch_results)
+    if fmt == "csv":
+        return _export_csv(batch_results)
+    raise ValueError(f"不支持的导出格式: {fmt}")
+
+
+def _export_xlsx(batch_results):
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(EXPORT_SHEET_NAME)
+    sheet.append(EXPORT_COLUMNS)
+    for row in iter_export_rows(batch_results):
+        sheet.append(row)
+
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def _export_csv(batch_results):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(iter_export_rows(batch_results))
+    return buffer.getvalue().encode("utf-8-sig")
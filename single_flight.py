@@ -0,0 +1,46 @@
+"""进程级请求合并（single-flight）：相同键的并发查询只执行一次，所有调用方共享结果"""
+import copy
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """按键合并同时进行的调用
+
+    同一时刻第一个到达的调用方（leader）负责执行查询，其余调用方（follower）
+    等待同一个 Future，得到相同的结果或异常。查询结束后键即被移除，
+    之后的调用会重新执行（结果的持久复用由 ResultCache 负责）。
+    Streamlit 的各个会话运行在同一进程的不同线程中，因此该对象可在会话之间共享。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def begin(self, key):
+        """登记一次调用，返回 (future, 是否为 leader)
+
+        leader 必须在结束时调用 finish（通常放在 finally 中），否则 follower 会一直等待。
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._flights[key] = future
+            return future, True
+
+    def finish(self, key, result=None, exception=None):
+        """leader 结束查询，唤醒所有等待中的 follower"""
+        with self._lock:
+            future = self._flights.pop(key, None)
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def wait(self, future, timeout=None):
+        """follower 等待共享结果，返回副本以免各会话相互修改"""
+        return copy.deepcopy(future.result(timeout=timeout))
@@ -0,0 +1,25 @@
+"""canonicalize_mpn 的去重规则：只去掉带分隔符的包装后缀，不误删型号本身的结尾"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend import canonicalize_mpn  # noqa: E402
+
+
+@pytest.mark.parametrize("alias, expected", [
+    ("stm32f103c8t6 ", "STM32F103C8T6"),
+    ("STM32F103C8T6TR", "STM32F103C8T6"),
+    ("AD8605ARTZ-REEL7", "AD8605ARTZ"),
+    ("LM358/TAPE", "LM358"),
+    ("SN74LVC1G14#CUT", "SN74LVC1G14"),
+])
+def test_packaging_suffix_removed(alias, expected):
+    assert canonicalize_mpn(alias) == expected
+
+
+@pytest.mark.parametrize("part_number", ["STM32F4CUT", "ABCREEL", "XYZTAPE13"])
+def test_unseparated_tail_kept(part_number):
+    assert canonicalize_mpn(part_number) == part_number